@@ -18,9 +18,115 @@
 // limitations under the License.
 
 
+#include <algorithm>
+#include <cstdio>
+#include <sstream>
+#include <thread>
+
 #include "tree/tree-renderer.h"
 #include "tree/context-dep.h"
 
+namespace kaldi {
+
+// Writes contexts of one outer phone (left context of triphones, the phone itself
+// of monophones) into a buffer, so that more outer phones can be done in parallel
+struct ContextWriter {
+	const ContextDependency *ctx_dep;
+	const fst::SymbolTable *phones_symtab;
+	std::vector<bool> skip;
+	std::set<int32> silset;
+	int32 silpdfclasses;
+	int32 nonsilpdfclasses;
+	bool binary;
+
+	void Record(int32 l_ctx, int32 ph, int32 p_ctx, int32 pdf_class, int32 pdf_id, std::ostringstream *os) const {
+		if (binary) {
+			int32 rec[5] = {l_ctx, ph, p_ctx, pdf_class, pdf_id};
+			os->write(reinterpret_cast<const char*>(rec), sizeof(rec));
+		} else if (l_ctx < 0) {
+			*os << phones_symtab->Find(ph) << " " << pdf_class << " " << pdf_id << "\n";
+		} else {
+			*os << phones_symtab->Find(l_ctx) << " " << phones_symtab->Find(ph) << " " << phones_symtab->Find(p_ctx) << " " << pdf_class << " " << pdf_id << "\n";
+		}
+	}
+
+	//In the normal case the pdf-class is the same as the HMM state index (e.g. 0, 1 or 2), but pdf classes provide a way for the user to enforce sharing. 
+	// pdf-classes http://kaldi.sourceforge.net/hmm.html
+	int32 NumPdfClasses(int32 ph) const {
+		return silset.find(ph) == silset.end() ? nonsilpdfclasses : silpdfclasses;
+	}
+
+	// all triphones with left context l_ctx
+	void Triphones(int32 l_ctx, std::string *buffer) const {
+		std::ostringstream os;
+		int32 nphones = phones_symtab->NumSymbols();
+		if (!skip[l_ctx]) {
+			for (int32 ph = 1; ph < nphones; ++ph) { // not <eps>
+				if (skip[ph]) continue;
+				for (int32 p_ctx = 0; p_ctx < nphones; ++p_ctx) {
+					if (skip[p_ctx]) continue;
+
+					// triphone context vector
+					std::vector<int32> triphone;
+					triphone.push_back(l_ctx);
+					triphone.push_back(ph);
+					triphone.push_back(p_ctx);
+
+					int32 mpdf = NumPdfClasses(ph);
+					for (int32 pdf_class=0; pdf_class < mpdf; ++pdf_class) {
+						int32 pdf_id;
+						//bool ContextDependency::Compute(const std::vector<int32> &phoneseq, int32 pdf_class, int32 *pdf_id)
+						ctx_dep->Compute(triphone, pdf_class, &pdf_id);
+						Record(l_ctx, ph, p_ctx, pdf_class, pdf_id, &os);
+					}
+				}
+			}
+		}
+		*buffer = os.str();
+	}
+
+	// monophone ph
+	void Monophone(int32 ph, std::string *buffer) const {
+		std::ostringstream os;
+		if (ph > 0) { // not <eps>
+			// mono context vector
+			std::vector<int32> monophone;
+			monophone.push_back(ph);
+
+			int32 mpdf = NumPdfClasses(ph);
+			for (int32 pdf_class=0; pdf_class < mpdf; ++pdf_class) {
+				int32 pdf_id;
+				ctx_dep->Compute(monophone, pdf_class, &pdf_id);
+				Record(-1, ph, -1, pdf_class, pdf_id, &os);
+			}
+		}
+		*buffer = os.str();
+	}
+};
+
+// Contexts of outer phones begin..end-1 in num_threads threads, written in order of the phones
+void WriteContexts(const ContextWriter &writer, bool triphones, int32 begin, int32 end, int32 num_threads) {
+	void (ContextWriter::*contexts)(int32, std::string*) const =
+		triphones ? &ContextWriter::Triphones : &ContextWriter::Monophone;
+	std::vector<std::string> buffers(num_threads);
+	for (int32 first = begin; first < end; first += num_threads) {
+		int32 n = std::min(num_threads, end - first);
+		std::vector<std::thread> threads;
+		for (int32 t = 1; t < n; ++t)
+			threads.push_back(std::thread(contexts, &writer, first + t, &buffers[t]));
+		(writer.*contexts)(first, &buffers[0]);
+		for (size_t t = 0; t < threads.size(); ++t)
+			threads[t].join();
+		for (int32 t = 0; t < n; ++t) {
+			std::cout.write(buffers[t].data(), buffers[t].size());
+			std::string().swap(buffers[t]);
+		}
+	}
+	std::cout.flush();
+}
+
+}  // namespace kaldi
+
 int main(int argc, char **argv) {
   using namespace kaldi;
   try {
@@ -29,11 +135,19 @@ int main(int argc, char **argv) {
 	const char *usage =
 		"Outputs Pdf for all possible triphones\n"
 		"Usage: context-to-pdf <phone-symbols> <tree>\n"
-		"e.g.: context-to-pdf phones.txt tree \n";
+		"e.g.: context-to-pdf phones.txt tree \n"
+		"With --binary writes int32 records (left, phone, right, pdf-class, pdf-id),\n"
+		"left and right are -1 for monophones\n"
+		"With --shard=k/n writes only the k-th of n ranges of left contexts (of phones\n"
+		"for monophones); outputs of shards 0/n .. n-1/n together are the whole output\n";
 	
     std::string silphones = "1,2,3";
     int32 silpdfclasses = 5;
     int32 nonsilpdfclasses = 3;
+    bool binary = false;
+    bool skip_disambig = false;
+    std::string shard = "0/1";
+    int32 num_threads = 1;
 
 	ParseOptions po(usage);
 
@@ -43,12 +157,28 @@ int main(int argc, char **argv) {
                 "Number of pdf-classes for silence phones");
     po.Register("non-sil-pdf-classes", &nonsilpdfclasses,
                 "Number of pdf-classes for non-silence phones");
+    po.Register("binary", &binary,
+                "Write int32 records with phone ids instead of text lines");
+    po.Register("skip-disambig", &skip_disambig,
+                "Skip triphones with disambiguation symbols (#) or <eps>");
+    po.Register("shard", &shard,
+                "Write only shard k/n of the contexts (k-th of n ranges of left-context phones)");
+    po.Register("num-threads", &num_threads,
+                "Number of threads computing the contexts");
 	po.Read(argc, argv);
 
 	if (po.NumArgs() != 2) {
 	  po.PrintUsage();
 	  return -1;
 	}
+	int32 shard_index, num_shards;
+	char rest;
+	if (std::sscanf(shard.c_str(), "%d/%d%c", &shard_index, &num_shards, &rest) != 2 ||
+	    num_shards < 1 || shard_index < 0 || shard_index >= num_shards)
+		KALDI_ERR << "Bad --shard " << shard << ", expected k/n with 0 <= k < n";
+	if (num_threads < 1)
+		KALDI_ERR << "Bad --num-threads " << num_threads;
+
 	std::string phnfile = po.GetArg(1);
 	std::string treefile = po.GetArg(2);
 
@@ -93,68 +223,40 @@ int main(int argc, char **argv) {
 	KALDI_LOG << "Context width:" << ctx_dep.ContextWidth();
 	KALDI_LOG << "Central position:" << ctx_dep.CentralPosition();
 
-	// triphones
-	if((ctx_dep.ContextWidth() == 3) && (ctx_dep.CentralPosition() == 1)){
-		// iter over all possible triphones
-		size_t nphones = phones_symtab->NumSymbols();
-		for (int32 l_ctx = 0; l_ctx < nphones; ++l_ctx) {
-			for (int32 ph = 1; ph < nphones; ++ph) { // not <eps>
-				for (int32 p_ctx = 0; p_ctx < nphones; ++p_ctx) {
-
-					int32 pdf_id;
-
-					//KALDI_LOG << "OK";
-
-					// triphone context vector
-					std::vector<int32> triphone;
-					triphone.push_back(l_ctx);
-					triphone.push_back(ph);
-					triphone.push_back(p_ctx);
+	// phones we do not need in triphones
+	std::vector<bool> skip(phones_symtab->NumSymbols(), false);
+	if (skip_disambig) {
+		for (int32 p = 0; p < skip.size(); ++p) {
+			std::string sym = phones_symtab->Find(p);
+			skip[p] = (sym.find('#') != std::string::npos || sym.find("<eps>") != std::string::npos);
+		}
+	}
 
-					//KALDI_LOG << "OK";
+	ContextWriter writer;
+	writer.ctx_dep = &ctx_dep;
+	writer.phones_symtab = phones_symtab;
+	writer.skip = skip;
+	writer.silset = silset;
+	writer.silpdfclasses = silpdfclasses;
+	writer.nonsilpdfclasses = nonsilpdfclasses;
+	writer.binary = binary;
 
-					//In the normal case the pdf-class is the same as the HMM state index (e.g. 0, 1 or 2), but pdf classes provide a way for the user to enforce sharing. 
-					// pdf-classes http://kaldi.sourceforge.net/hmm.html
-					int32 mpdf = (silset.find(ph) == silset.end() ?
-													nonsilpdfclasses :
-													silpdfclasses);
+	// outer phones of this shard
+	int64 nphones = phones_symtab->NumSymbols();
+	int32 begin = nphones * shard_index / num_shards;
+	int32 end = nphones * (shard_index + 1) / num_shards;
 
-					//KALDI_LOG << mpdf;
-					for (int32 pdf_class=0; pdf_class < mpdf; ++pdf_class) {
-						//bool ContextDependency::Compute(const std::vector<int32> &phoneseq, int32 pdf_class, int32 *pdf_id)
-						ctx_dep.Compute(triphone, pdf_class, &pdf_id);
-						std::cout << phones_symtab->Find(l_ctx) << " " << phones_symtab->Find(ph) << " " << phones_symtab->Find(p_ctx) << " " << pdf_class << " " << pdf_id << "\n";
-					}
-				}
-			}
-		}
+	// triphones
+	if((ctx_dep.ContextWidth() == 3) && (ctx_dep.CentralPosition() == 1)){
+		// iter over all possible triphones
+		WriteContexts(writer, true, begin, end, num_threads);
 	}
 	// mono
 	if((ctx_dep.ContextWidth() == 1) && (ctx_dep.CentralPosition() == 0)){
 		// iter over all possible monophones
-		size_t nphones = phones_symtab->NumSymbols();
-		for (int32 ph = 1; ph < nphones; ++ph) { // not <eps>
-			int32 pdf_id;
-
-			// mono context vector
-			std::vector<int32> triphone;
-			triphone.push_back(ph);
-
-			//In the normal case the pdf-class is the same as the HMM state index (e.g. 0, 1 or 2), but pdf classes provide a way for the user to enforce sharing. 
-			// pdf-classes http://kaldi.sourceforge.net/hmm.html
-			int32 mpdf = (silset.find(ph) == silset.end() ?
-											nonsilpdfclasses :
-											silpdfclasses);
-
-			for (int32 pdf_class=0; pdf_class < mpdf; ++pdf_class) {
-				//bool ContextDependency::Compute(const std::vector<int32> &phoneseq, int32 pdf_class, int32 *pdf_id)
-				ctx_dep.Compute(triphone, pdf_class, &pdf_id);
-				std::cout << phones_symtab->Find(ph) << " " << pdf_class << " " << pdf_id << "\n";
-			}
-		}
+		WriteContexts(writer, false, begin, end, num_threads);
 	}
 
-
  	} catch (const std::exception &e) {
 		std::cerr << e.what();
 	return -1;
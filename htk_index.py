@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Offset index of MMF macros, written next to the MMF as <model>.idx (--index).
+
+The index holds the byte offset and length of every macro (~t, ~s, ~h and the shared ~u,
+~v and ~m) and the tiedlist mapping of logical to physical HMM names, both in open
+addressing hash tables (CRC-32 of the name, linear probing), so MmfIndex gets any macro
+of a memory mapped MMF in O(1).
+
+Layout, little-endian: header (magic, numbers of macros and logical names, sizes of both
+tables and of the name pool), macro records (kind, offset, length, name), macro table,
+logical records (name, macro of physical HMM), logical table and the pool of all names.
+A table slot holds record number + 1, 0 is empty.
+"""
+
+import mmap
+import re
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+MAGIC = b"MMFIDX01"
+HEADER = struct.Struct("<8s5Q")
+
+MACRO_DTYPE = np.dtype([("kind", "S1"), ("offset", "<u8"), ("length", "<u8"), ("name", "<u8"), ("name_len", "<u4")])
+LOGICAL_DTYPE = np.dtype([("name", "<u8"), ("name_len", "<u4"), ("macro", "<u4")])
+
+_references = re.compile(r'~([stuvm]) "([^"]*)"')
+
+# Order of macros in self-contained definition, each defined before it is used
+_DEFINITION_ORDER = "uvmts"
+
+
+class MmfOutput(object):
+	"""MMF file being written, with offsets of its macros when index is on"""
+
+	def __init__(self, fw, index=False):
+		self.fw = fw
+		self.pos = 0
+		self.entries = [] if index else None
+
+	def write(self, text):
+		self.fw.write(text)
+		self.pos += len(text)
+
+	def macro(self, kind, name, text):
+		"""Write one macro ~kind "name" """
+		if self.entries is not None:
+			self.entries.append((kind, name, self.pos, len(text)))
+		self.write(text)
+
+	def macros(self, kind, names, text, lengths):
+		"""Write consecutive macros of given names and lengths, all in text"""
+		if self.entries is not None:
+			pos = self.pos
+			for name, length in zip(names, lengths):
+				self.entries.append((kind, name, pos, length))
+				pos += length
+		self.write(text)
+
+	def flush(self):
+		self.fw.flush()
+
+	def fileno(self):
+		return self.fw.fileno()
+
+	def close(self):
+		self.fw.close()
+
+
+def _hash(key):
+	return zlib.crc32(key) & 0xffffffff
+
+
+def _table_size(n):
+	size = 1
+	while size < 2 * n:
+		size <<= 1
+	return size
+
+
+def _hash_table(keys):
+	"""
+	Open addressing table of distinct keys, slots hold key number + 1. Keys are placed in
+	rounds, every round each key still waiting tries its next slot, so no key is behind
+	an empty slot on the way from its hash, as with one by one insertion.
+	"""
+	size = _table_size(len(keys))
+	table = np.zeros(size, dtype="<u4")
+	waiting = np.arange(len(keys), dtype=np.int64)
+	slots = np.array([_hash(key) for key in keys], dtype=np.int64) & (size - 1)
+	while len(waiting):
+		free = table[slots] == 0
+		_, first = np.unique(slots[free], return_index=True)
+		placed = np.flatnonzero(free)[first]
+		table[slots[placed]] = waiting[placed] + 1
+		left = np.ones(len(waiting), dtype=bool)
+		left[placed] = False
+		waiting = waiting[left]
+		slots = (slots[left] + 1) & (size - 1)
+	return table
+
+
+def _records(dtype, names, pool_start):
+	"""Records of names stored in pool from pool_start, returns them and the pool"""
+	records = np.zeros(len(names), dtype=dtype)
+	lengths = np.array([len(name) for name in names], dtype=np.uint64)
+	records["name_len"] = lengths
+	records["name"] = pool_start + np.cumsum(lengths) - lengths
+	return records, "".join(names)
+
+
+def write_index(fname, entries, tied):
+	"""
+	Write index of macros, list of (kind, name, offset, length), and tiedlist, (logical, physical)
+	pairs in any order, where the first pair of a logical name holds
+	"""
+	first = {}
+	for i, (kind, name, _, _) in enumerate(entries):
+		first.setdefault(kind + name, i)
+	unique = sorted(first.values())  # repeated macros (merged names) are not indexed twice
+	entries = [entries[i] for i in unique]
+
+	macros, macro_pool = _records(MACRO_DTYPE, [name for _, name, _, _ in entries], 0)
+	macros["kind"] = [kind for kind, _, _, _ in entries]
+	macros["offset"] = [offset for _, _, offset, _ in entries]
+	macros["length"] = [length for _, _, _, length in entries]
+	macro_table = _hash_table([kind + name for kind, name, _, _ in entries])
+
+	hmm_of = dict((name, i) for i, (kind, name, _, _) in enumerate(entries) if kind == "h")
+	physical = {}
+	for name, phys in tied:
+		if phys in hmm_of:
+			physical.setdefault(name, phys)
+	names = physical.keys()
+	logical, logical_pool = _records(LOGICAL_DTYPE, names, len(macro_pool))
+	logical["macro"] = [hmm_of[physical[name]] for name in names]
+	logical_table = _hash_table(names)
+
+	with open(fname, "wb") as f:
+		f.write(HEADER.pack(MAGIC, len(macros), len(logical), len(macro_table), len(logical_table),
+			len(macro_pool) + len(logical_pool)))
+		for arr in (macros, macro_table, logical, logical_table):
+			f.write(arr.tostring())
+		f.write(macro_pool)
+		f.write(logical_pool)
+
+
+class MmfIndex(object):
+	"""Memory mapped MMF with its index: macros and definitions of HMMs on demand"""
+
+	def __init__(self, fmmf, findex=None):
+		self.mmf = self._map(fmmf)
+		self.idx = self._map(findex or fmmf + ".idx")
+		magic, n_macros, n_logical, macro_slots, logical_slots, pool_size = HEADER.unpack_from(self.idx, 0)
+		if magic != MAGIC:
+			raise ValueError("%s is not MMF index" % (findex or fmmf + ".idx"))
+		pos = HEADER.size
+		self.macros = np.frombuffer(self.idx, dtype=MACRO_DTYPE, count=n_macros, offset=pos)
+		pos += self.macros.nbytes
+		self.macro_table = np.frombuffer(self.idx, dtype="<u4", count=macro_slots, offset=pos)
+		pos += self.macro_table.nbytes
+		self.logical = np.frombuffer(self.idx, dtype=LOGICAL_DTYPE, count=n_logical, offset=pos)
+		pos += self.logical.nbytes
+		self.logical_table = np.frombuffer(self.idx, dtype="<u4", count=logical_slots, offset=pos)
+		pos += self.logical_table.nbytes
+		self.pool = pos
+
+	@staticmethod
+	def _map(fname):
+		with open(fname, "rb") as f:
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def _name(self, start, length):
+		return self.idx[self.pool + int(start):self.pool + int(start) + int(length)]
+
+	def _find(self, table, records, key, prefix=""):
+		"""Record number of key in hash table, None if not there"""
+		if not len(table):
+			return None
+		mask = len(table) - 1
+		slot = _hash(prefix + key) & mask
+		while table[slot]:
+			i = int(table[slot]) - 1
+			rec = records[i]
+			if prefix == "" or rec["kind"] == prefix:
+				if self._name(rec["name"], rec["name_len"]) == key:
+					return i
+			slot = (slot + 1) & mask
+		return None
+
+	def _text(self, i):
+		rec = self.macros[i]
+		return self.mmf[int(rec["offset"]):int(rec["offset"]) + int(rec["length"])]
+
+	def __contains__(self, key):
+		"""(kind, name) of macro"""
+		return self._find(self.macro_table, self.macros, key[1], prefix=key[0]) is not None
+
+	def macro(self, kind, name):
+		"""Text of macro ~kind "name" (kind t, s, h, u, v or m), KeyError if there is none"""
+		i = self._find(self.macro_table, self.macros, name, prefix=kind)
+		if i is None:
+			raise KeyError((kind, name))
+		return self._text(i)
+
+	def physical(self, name):
+		"""Physical HMM of logical name, by the tiedlist (physical names map to themselves)"""
+		i = self._find(self.logical_table, self.logical, name)
+		if i is not None:
+			rec = self.macros[int(self.logical[i]["macro"])]
+			return self._name(rec["name"], rec["name_len"])
+		if ("h", name) in self:
+			return name
+		raise KeyError(name)
+
+	def hmm(self, name):
+		"""Text of ~h macro of logical or physical HMM"""
+		return self.macro("h", self.physical(name))
+
+	def definition(self, name):
+		"""Self-contained definition of HMM: its ~t and ~s macros (and ~u, ~v, ~m of the states) followed by its ~h"""
+		hmm = self.hmm(name)
+		refs = []
+		pending = _references.findall(hmm)
+		while pending:
+			ref = pending.pop(0)
+			if ref not in refs:
+				refs.append(ref)
+				if ref[0] == "s":
+					pending.extend(_references.findall(self.macro(*ref)))
+		refs.sort(key=lambda r: _DEFINITION_ORDER.index(r[0]))
+		return "".join([self.macro(kind, ref) for kind, ref in refs]) + hmm
+
+	def close(self):
+		self.mmf.close()
+		self.idx.close()
+
+
+if __name__ == "__main__":
+
+	if len(sys.argv) < 3:
+		print >> sys.stderr, "Usage: htk_index.py <model> <hmm> [<hmm> ...]  (prints definitions of HMMs, by <model>.idx)"
+		sys.exit(1)
+
+	index = MmfIndex(sys.argv[1])
+	for name in sys.argv[2:]:
+		try:
+			sys.stdout.write(index.definition(name))
+		except KeyError:
+			print >> sys.stderr, "HMM %s not found" % name
+			sys.exit(1)
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Reader of the HTK MMF files written by convert(), text or binary, and comparison of two models.
+
+load_mmf reads every macro into a dict. load_mmf_arrays reads the same constructs into
+MmfModel, with the mixtures of all states in contiguous arrays: runs of text ~s macros
+are parsed in large blocks by numpy and binary ones are read as packed records, so
+models of several GB load in seconds per GB.
+
+Shared ~u, ~v and ~m macros (--share-vectors) are resolved into the mixtures that use them,
+states of such models are read one by one.
+"""
+
+import mmap
+import multiprocessing
+import re
+import struct
+import sys
+
+import numpy as np
+
+from htk_writer import SYMBOLS, _gmm_dtype, _sym
+
+CODES = dict((v, k) for k, v in SYMBOLS.items())
+
+_space = re.compile(r"\s*")
+_number_end = re.compile(r"[<~]|\Z")
+_number = re.compile(r"\s*(\S+?)(?=[\s<~]|\Z)")
+_state_name = re.compile(r'~s "([^"]*)"')
+_state_markup = re.compile(r'~s "[^"]*"|<[A-Z]+>')
+_not_state = re.compile(r"~[^s]")
+_num_mixes = re.compile(r"<NUMMIXES> (\d+)")
+_mixture_index = re.compile(r"<MIXTURE> (\d+)")
+_state_definition = re.compile(r'~s "([^"]*)"\n(?=<NUMMIXES>|:\x03)')
+
+# Size of text blocks of ~s macros parsed at once
+STATE_BLOCK_SIZE = 64 << 20
+
+
+class MMFReader(object):
+	"""Walks MMF buffer, every keyword may come in text (<NAME>) or binary (:code) form"""
+
+	def __init__(self, buf):
+		self.buf = buf
+		self.pos = 0
+
+	def find(self, sub, pos):
+		"""Position of sub from pos, works also on memory mapped buffer"""
+		end = self.buf.find(sub, pos)
+		if end < 0:
+			raise ValueError("Expected %s after %d" % (sub, pos))
+		return end
+
+	def skip_space(self):
+		self.pos = _space.match(self.buf, self.pos).end()
+
+	def at_end(self):
+		self.skip_space()
+		return self.pos >= len(self.buf)
+
+	def peek(self, n=1):
+		self.skip_space()
+		return self.buf[self.pos:self.pos + n]
+
+	def symbol(self):
+		"""Read keyword, returns (name, binary)"""
+		self.skip_space()
+		if self.buf[self.pos:self.pos + 1] == ":":
+			name = CODES[ord(self.buf[self.pos + 1])]
+			self.pos += 2
+			return name, True
+		end = self.find(">", self.pos)
+		name = self.buf[self.pos + 1:end]
+		self.pos = end + 1
+		return name, False
+
+	def expect(self, expected):
+		name, binary = self.symbol()
+		if name != expected:
+			raise ValueError("Expected <%s>, got <%s> at %d" % (expected, name, self.pos))
+		return binary
+
+	def macro(self):
+		"""Read macro header or reference ~x "name", returns (type, name)"""
+		self.skip_space()
+		if self.buf[self.pos] != "~":
+			raise ValueError("Expected macro at %d" % self.pos)
+		kind = self.buf[self.pos + 1]
+		self.skip_space_at(self.pos + 2)
+		if kind == "o":
+			return kind, None
+		end = self.find('"', self.pos + 1)
+		name = self.buf[self.pos + 1:end]
+		self.pos = end + 1
+		return kind, name
+
+	def skip_space_at(self, pos):
+		self.pos = pos
+		self.skip_space()
+
+	def shorts(self, n, binary):
+		if binary:
+			values = struct.unpack_from(">%dh" % n, self.buf, self.pos)
+			self.pos += 2 * n
+			return values
+		return [int(x) for x in self.floats(n, False)]
+
+	def floats(self, n, binary):
+		if binary:
+			values = np.frombuffer(self.buf, dtype=">f4", count=n, offset=self.pos).astype(np.float64)
+			self.pos += 4 * n
+			return values
+		self.skip_space()
+		end = _number_end.search(self.buf, self.pos).start()
+		values = self.buf[self.pos:end].split()
+		if len(values) == n:  # whole block of numbers
+			self.pos = end
+			return np.array(values, dtype=np.float64)
+		values = []
+		for i in range(n):
+			m = _number.match(self.buf, self.pos)
+			values.append(float(m.group(1)))
+			self.pos = m.end()
+		return np.array(values)
+
+
+def _read_options(r, model):
+	while not r.peek() in ("~", ""):
+		name, binary = r.symbol()
+		if name == "STREAMINFO":
+			nstreams = r.shorts(1, binary)[0]
+			model["streams"] = r.shorts(nstreams, binary)
+		elif name == "VECSIZE":
+			model["vecSize"] = r.shorts(1, binary)[0]
+		else:
+			model["kinds"].append(name)
+
+
+def _read_transp(r):
+	binary = r.expect("TRANSP")
+	n = r.shorts(1, binary)[0]
+	return r.floats(n * n, binary).reshape(n, n)
+
+
+def _read_vector(r, keyword, shared):
+	"""<MEAN> or <VARIANCE> vector, or its ~u or ~v macro from dict shared"""
+	if r.peek() == "~":
+		return shared[r.macro()]
+	binary = r.expect(keyword)
+	return r.floats(r.shorts(1, binary)[0], binary)
+
+
+def _read_mixture(r, shared):
+	"""Mean, variance and gconst of mixture, or of its ~m macro from dict shared"""
+	if r.peek(2) == "~m":
+		return shared[r.macro()]
+	mean = _read_vector(r, "MEAN", shared)
+	variance = _read_vector(r, "VARIANCE", shared)
+	binary = r.expect("GCONST")
+	return mean, variance, r.floats(1, binary)[0]
+
+
+def _read_shared(r, kind, shared):
+	"""Body of ~u, ~v or ~m macro"""
+	if kind == "m":
+		return _read_mixture(r, shared)
+	return _read_vector(r, "MEAN" if kind == "u" else "VARIANCE", shared)
+
+
+def _read_state(r, shared=None):
+	binary = r.expect("NUMMIXES")
+	num_mixes = r.shorts(1, binary)[0]
+	weights = np.zeros(num_mixes)
+	means, variances, gconsts = [None] * num_mixes, [None] * num_mixes, np.zeros(num_mixes)
+	for m in range(num_mixes):
+		binary = r.expect("MIXTURE")
+		idx = r.shorts(1, binary)[0]
+		weights[idx - 1] = r.floats(1, binary)[0]
+		means[idx - 1], variances[idx - 1], gconsts[idx - 1] = _read_mixture(r, shared)
+	return {"weights": weights, "means": np.array(means), "variances": np.array(variances), "gconsts": gconsts}
+
+
+def _read_hmm(r):
+	r.expect("BEGINHMM")
+	binary = r.expect("NUMSTATES")
+	num_states = r.shorts(1, binary)[0]
+	states = []
+	for i in range(num_states - 2):
+		binary = r.expect("STATE")
+		r.shorts(1, binary)
+		states.append(r.macro()[1])
+	trans = r.macro()[1]
+	r.expect("ENDHMM")
+	return {"states": states, "transitions": trans}
+
+
+def load_mmf(fname):
+	"""Load MMF written by convert() into dict of macros"""
+	with open(fname, "rb") as f:
+		buf = f.read()
+	r = MMFReader(buf)
+	model = {"vecSize": None, "streams": None, "kinds": [], "transitions": {}, "states": {}, "hmms": {}}
+	shared = {}  # ~u, ~v and ~m macros, resolved in the states
+	while not r.at_end():
+		kind, name = r.macro()
+		if kind == "o":
+			_read_options(r, model)
+		elif kind == "t":
+			model["transitions"][name] = _read_transp(r)
+		elif kind in ("u", "v", "m"):
+			shared[kind, name] = _read_shared(r, kind, shared)
+		elif kind == "s":
+			model["states"][name] = _read_state(r, shared)
+		elif kind == "h":
+			model["hmms"][name] = _read_hmm(r)
+		else:
+			raise ValueError("Macro ~%s not supported" % kind)
+	return model
+
+
+class MmfModel(object):
+	"""
+	MMF in arrays: mixtures of state i (named state_names[i]) are rows
+	offsets[i]:offsets[i] + counts[i] of weights, means, variances and gconsts.
+	Transitions are dict of matrices, HMMs dict of (list of state names, transition name).
+	"""
+
+	def __init__(self):
+		self.vecSize = None
+		self.streams = None
+		self.kinds = []
+		self.transitions = {}
+		self.hmms = {}
+		self.state_names = []
+		self._blocks = []  # (counts, weights, means, variances, gconsts) of parts of the states
+
+	def _add_states(self, names, counts, weights, means, variances, gconsts):
+		self.state_names.extend(names)
+		self._blocks.append((counts, weights, means, variances, gconsts))
+
+	def _finish(self):
+		dim = self.vecSize or 0
+		blocks = self._blocks or [(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, dim)), np.zeros((0, dim)), np.zeros(0))]
+		self.counts, self.weights, self.means, self.variances, self.gconsts = [np.concatenate(x) for x in zip(*blocks)]
+		self.offsets = np.zeros(len(self.counts), dtype=np.int64)
+		np.cumsum(self.counts[:-1], out=self.offsets[1:])
+		self.state_index = dict((name, i) for i, name in enumerate(self.state_names))
+		self._blocks = []
+
+	def state(self, name):
+		"""Dict of state as load_mmf returns it"""
+		i = self.state_index[name]
+		rows = slice(self.offsets[i], self.offsets[i] + self.counts[i])
+		return {"weights": self.weights[rows], "means": self.means[rows], "variances": self.variances[rows],
+			"gconsts": self.gconsts[rows]}
+
+
+# Bytes of number [-]D.DDDDDDe(+|-)DD[D] around its "e" (column 9)
+_EXP_WINDOW = np.arange(-9, 5)
+_MANTISSA_COLUMNS = [1, 3, 4, 5, 6, 7, 8]
+_MANTISSA_WEIGHTS = 10.0 ** np.arange(6, -1, -1)
+_POWERS_OF_TEN = 10.0 ** np.arange(301)
+
+
+def _parse_exp_floats(text, skip):
+	"""
+	All numbers written as "%.6e" (or "%e") in text, parsed from their bytes at once;
+	skip are (start, end) ranges to leave out. Returns None if any of them has other form.
+	"""
+	x = np.frombuffer(text, dtype=np.uint8)
+	e = np.flatnonzero(x == ord("e"))
+	if len(skip):
+		starts, ends = np.array(skip).T
+		k = np.searchsorted(starts, e, side="right") - 1
+		e = e[(k < 0) | (e >= ends[np.maximum(k, 0)])]
+	if not len(e) or e[0] < 8 or e[-1] + 4 > len(x):
+		return None
+
+	# rows of a sliding window over the text, padded so that every window is inside
+	x = np.concatenate([np.zeros(9, dtype=np.uint8), x, np.zeros(5, dtype=np.uint8)])
+	windows = np.lib.stride_tricks.as_strided(x, shape=(len(x) - len(_EXP_WINDOW) + 1, len(_EXP_WINDOW)), strides=(1, 1))
+	w = windows[e] - np.uint8(ord("0"))
+	digits = w[:, _MANTISSA_COLUMNS]
+	exp_sign = w[:, 10] + np.uint8(ord("0"))
+	negative_exp = exp_sign == ord("-")
+	if (digits > 9).any() or (w[:, 2] != np.uint8(ord(".") - ord("0"))).any() or not (negative_exp | (exp_sign == ord("+"))).all():
+		return None
+	if (w[:, 11] > 9).any() or (w[:, 12] > 9).any():
+		return None
+	three = w[:, 13] <= 9
+	exp = w[:, 11].astype(np.int64) * 10 + w[:, 12]
+	exp[three] = exp[three] * 10 + w[three, 13]
+	scale = np.where(negative_exp, -exp, exp) - 6
+	if (np.abs(scale) > 300).any():
+		return None
+	power = _POWERS_OF_TEN[np.abs(scale)]
+
+	# mantissa (sums of small integers, exact) and powers of ten up to 1e22 are exact, so one
+	# division or multiplication rounds correctly, as strtod does
+	mantissa = digits.astype(np.float64).dot(_MANTISSA_WEIGHTS)
+	values = np.where(scale < 0, mantissa / power, mantissa * power)
+	values[w[:, 0] == np.uint8(ord("-") - ord("0"))] *= -1
+	return values
+
+
+def _read_text_states(buf, start, end, dim):
+	"""Parse text ~s macros of buf[start:end] in one go, returns names, counts and arrays of their mixtures"""
+	text = buf[start:end]
+	headers = [(m.start(), m.end()) for m in _state_name.finditer(text)]
+	names = [text[a + 4:b - 1] for a, b in headers]
+	counts = np.array([int(n) for n in _num_mixes.findall(text)], dtype=np.int64)
+	if len(counts) != len(names):
+		raise ValueError("State macros at %d-%d not understood" % (start, end))
+
+	# every mixture: weight, means, variances and gconst, all in "%e" form
+	width = 2 * dim + 2
+	values = _parse_exp_floats(text, headers)
+	sizes = text.count("<MEAN> %d\n" % dim) + text.count("<VARIANCE> %d\n" % dim)
+	if values is not None and len(values) == counts.sum() * width and sizes == 2 * counts.sum():
+		mix = values.reshape(-1, width)
+		idx = np.array(_mixture_index.findall(text), dtype=np.int64)
+	else:
+		# any other number format: every state: <NUMMIXES> n, then n times: index, weight, dim, means, dim, variances, gconst
+		values = np.fromstring(_state_markup.sub(" ", text), sep=" ")
+		full = 2 * dim + 5
+		rows = []
+		pos = 0
+		for n in counts.tolist():
+			rows.append(values[pos + 1:pos + 1 + n * full])
+			pos += 1 + n * full
+		if pos != len(values):
+			raise ValueError("State macros at %d-%d not understood" % (start, end))
+		mix = np.concatenate(rows).reshape(-1, full) if rows else np.zeros((0, full))
+		if (mix[:, 2] != dim).any() or (mix[:, 3 + dim] != dim).any():
+			raise ValueError("State macros at %d-%d do not have vector size %d" % (start, end, dim))
+		idx = mix[:, 0]
+		mix = np.delete(mix, [0, 2, 3 + dim], axis=1)
+
+	# mixtures in order of their <MIXTURE> index within every state
+	state_of = np.repeat(np.arange(len(names)), counts)
+	mix = mix[np.lexsort((idx, state_of))]
+	return names, counts, mix[:, 0], mix[:, 1:1 + dim], mix[:, 1 + dim:1 + 2 * dim], mix[:, -1]
+
+
+def _read_binary_state(r, dim):
+	"""Read binary mixtures of one state, returns arrays of them"""
+	r.expect("NUMMIXES")
+	n = struct.unpack_from(">h", r.buf, r.pos)[0]
+	rec = np.frombuffer(r.buf, dtype=_gmm_dtype(dim), count=n, offset=r.pos + 2)
+	if n and ((rec["mix"] != _sym("MIXTURE")).any() or (rec["mean_dim"] != dim).any() or (rec["var_dim"] != dim).any()):
+		raise ValueError("Binary state at %d not understood" % r.pos)
+	r.pos += 2 + rec.nbytes
+	rec = rec[np.argsort(rec["idx"], kind="mergesort")]
+	return (rec["weight"].astype(np.float64), rec["mean"].astype(np.float64), rec["var"].astype(np.float64),
+		rec["gconst"].astype(np.float64))
+
+
+# Mapped MMF of the block parsers, set before the pool is forked
+_mmf_buffer = None
+
+
+def _read_text_block(args):
+	start, end, dim = args
+	return _read_text_states(_mmf_buffer, start, end, dim)
+
+
+def load_mmf_arrays(fname, block_size=STATE_BLOCK_SIZE, jobs=1):
+	"""
+	Load MMF written by convert() into MmfModel, the file is memory mapped. With jobs > 1
+	the blocks of text states are parsed on a (forked) process pool.
+	"""
+	global _mmf_buffer
+	with open(fname, "rb") as f:
+		buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		model = MmfModel()
+		blocks = []
+		shared = {}
+		r = MMFReader(buf)
+		while not r.at_end():
+			start = r.pos
+			kind, name = r.macro()
+			if kind == "o":
+				opts = {"vecSize": None, "streams": None, "kinds": model.kinds}
+				_read_options(r, opts)
+				model.vecSize, model.streams = opts["vecSize"], opts["streams"]
+			elif kind == "t":
+				model.transitions[name] = _read_transp(r)
+			elif kind == "h":
+				model.hmms[name] = _read_hmm(r)
+			elif kind in ("u", "v", "m"):
+				shared[kind, name] = _read_shared(r, kind, shared)
+			elif kind == "s" and shared:
+				# states with references to shared macros, one by one
+				state = _read_state(r, shared)
+				model._add_states([name], np.array([len(state["weights"])]), state["weights"], state["means"],
+					state["variances"], state["gconsts"])
+			elif kind == "s" and r.peek() == ":":
+				weights, means, variances, gconsts = _read_binary_state(r, model.vecSize)
+				model._add_states([name], np.array([len(weights)]), weights, means, variances, gconsts)
+			elif kind == "s":
+				# the whole run of text states, in blocks ending before a ~s macro
+				m = _not_state.search(buf, start)
+				run_end = m.start() if m else len(buf)
+				while start < run_end:
+					end = min(start + block_size, run_end)
+					if end < run_end:
+						end = buf.rfind('~s "', start + 1, end + 1)
+						if end <= start:
+							end = buf.find('~s "', start + 1, run_end)
+							end = run_end if end < 0 else end
+					blocks.append((start, end, model.vecSize))
+					start = end
+				r.pos = run_end
+			else:
+				raise ValueError("Macro ~%s not supported" % kind)
+
+		if jobs <= 1 or len(blocks) <= 1:
+			for block in blocks:
+				model._add_states(*_read_text_states(buf, *block))
+		else:
+			_mmf_buffer = buf
+			pool = multiprocessing.Pool(jobs)
+			try:
+				for states in pool.imap(_read_text_block, blocks):
+					model._add_states(*states)
+				pool.close()
+			except:
+				pool.terminate()
+				raise
+			finally:
+				pool.join()
+				_mmf_buffer = None
+
+		model._finish()
+		for name, hmm in model.hmms.items():
+			model.hmms[name] = (hmm["states"], hmm["transitions"])
+		return model
+	finally:
+		buf.close()
+
+
+def mmf_state_names(fname):
+	"""Names of ~s macros defined in MMF written by convert(), in their order, without parsing the states"""
+	with open(fname, "rb") as f:
+		buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		return [m.group(1) for m in _state_definition.finditer(buf)]
+	finally:
+		buf.close()
+
+
+def compare_models(a, b, rtol=1e-5, atol=1e-30):
+	"""Return list of differences between two loaded models, empty if they describe the same model"""
+	diffs = []
+	for key in ("vecSize", "streams", "kinds"):
+		if list(np.atleast_1d(a[key])) != list(np.atleast_1d(b[key])):
+			diffs.append("%s: %s != %s" % (key, a[key], b[key]))
+	for section in ("transitions", "states", "hmms"):
+		missing = set(a[section]) ^ set(b[section])
+		if missing:
+			diffs.append("%s: %d macros only in one model, e.g. %s" % (section, len(missing), sorted(missing)[0]))
+		for name in set(a[section]) & set(b[section]):
+			x, y = a[section][name], b[section][name]
+			if section == "transitions":
+				same = x.shape == y.shape and np.allclose(x, y, rtol=rtol, atol=atol)
+			elif section == "states":
+				same = all(x[k].shape == y[k].shape and np.allclose(x[k], y[k], rtol=rtol, atol=atol) for k in x)
+			else:
+				same = x == y
+			if not same:
+				diffs.append("%s: %s differs" % (section, name))
+	return diffs
+
+
+if __name__ == "__main__":
+
+	if len(sys.argv) != 3:
+		print >> sys.stderr, "Usage: htk_reader.py <model1> <model2>  (checks both MMFs, text or binary, describe the same model)"
+		sys.exit(1)
+
+	diffs = compare_models(load_mmf(sys.argv[1]), load_mmf(sys.argv[2]))
+	for d in diffs:
+		print d
+	if diffs:
+		sys.exit(1)
+	print "Models are identical"
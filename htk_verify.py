@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Verifier of exported MMF and tiedlist against the Kaldi model they were converted from.
+
+The MMF is read by htk_reader.load_mmf_arrays and all mixtures are compared with the
+Kaldi GMMs at once, within a relative tolerance. Every physical HMM must have the
+states and transition matrix of its Kaldi pdfs, and every logical triphone must be
+resolved by the tiedlist to a physical HMM with the same states. Exits with 1 when
+anything differs, so it can gate exports.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from htk_reader import load_mmf_arrays
+from htk_writer import gmm_state_arrays
+from kaldi_convert import load_model, transition_matrices, make_naming, detect_NSE, PROFILES
+from kaldi_cache import DEFAULT_CACHE_SIZE
+from kaldi_mdl import prune_gmm_set
+
+# Examples listed in every problem
+EXAMPLES = 5
+
+
+def problem(what, bad, total, examples):
+	"""Aggregate line of problem: what, how many of total and a few examples"""
+	return "%s: %d of %d, e.g. %s" % (what, bad, total, ", ".join([str(x) for x in examples[:EXAMPLES]]))
+
+
+def read_tiedlist(ftiedname):
+	"""Dict logical name -> physical name of HTK tiedlist (physical names map to themselves)"""
+	tied = {}
+	with open(ftiedname) as f:
+		for line in f:
+			names = line.split()
+			if names:
+				tied[names[0]] = names[-1]
+	return tied
+
+
+def mixture_rows(offsets, counts):
+	"""Rows of all mixtures of states with given offsets and counts, in order"""
+	starts = np.repeat(np.asarray(offsets) - (np.cumsum(counts) - counts), counts)
+	return starts + np.arange(int(np.sum(counts)))
+
+
+def verify_states(mmf, gmms, naming, rtol=1e-5, atol=1e-30):
+	"""Problems of ~s macros against DiagGmmSet: missing states, numbers of mixtures and parameters"""
+	problems = []
+	names = [naming.state_name(s) for s in range(len(gmms))]
+	idx = np.array([mmf.state_index.get(name, -1) for name in names], dtype=np.int64)
+	missing = np.flatnonzero(idx < 0)
+	if len(missing):
+		problems.append(problem("states missing in MMF", len(missing), len(names), [names[s] for s in missing]))
+	extra = len(mmf.state_names) - (len(names) - len(missing))
+	if extra > 0:
+		problems.append("states not in Kaldi model: %d" % extra)
+
+	found = np.flatnonzero(idx >= 0)
+	counts = gmms.counts[found]
+	wrong = found[mmf.counts[idx[found]] != counts]
+	if len(wrong):
+		problems.append(problem("states with other number of mixtures", len(wrong), len(found), [names[s] for s in wrong]))
+	found = found[mmf.counts[idx[found]] == counts]
+
+	# all mixtures of all states at once
+	src = mixture_rows(gmms.offsets[found], gmms.counts[found])
+	dst = mixture_rows(mmf.offsets[idx[found]], gmms.counts[found])
+	means, variances, gconsts = gmm_state_arrays(gmms.means_invvars[src], gmms.inv_vars[src], gmms.dim)
+	close = lambda a, b: np.isclose(a, b, rtol=rtol, atol=atol)
+	ok = close(gmms.weights[src], mmf.weights[dst]) & close(gconsts, mmf.gconsts[dst])
+	ok &= close(means, mmf.means[dst]).all(axis=1) & close(variances, mmf.variances[dst]).all(axis=1)
+	bad = np.unique(np.repeat(found, gmms.counts[found])[~ok])
+	if len(bad):
+		problems.append(problem("states with other mixtures (rtol %g)" % rtol, len(bad), len(found), [names[s] for s in bad]))
+	return problems
+
+
+def physical_names(model, naming):
+	"""Dict name -> physical HMMs of that name (more of them if naming merges contexts, as ap does for noise phones)"""
+	hmms = model["hmms"]
+	names = {}
+	for h in range(len(hmms)):
+		names.setdefault(naming.hmm_name(hmms.name(h, model["int2phones"])), []).append(h)
+	return names
+
+
+def verify_hmms(mmf, model, naming, rtol=1e-5, atol=1e-30):
+	"""
+	Problems of ~h and ~t macros: every physical HMM with its states and transition matrix.
+	An HMM whose name has more physical HMMs may match any of them.
+	"""
+	hmms = model["hmms"]
+	mats, _ = transition_matrices(hmms, model["trans"], model["int2phones"])
+	names = physical_names(model, naming)
+	missing, states, trans = [], [], []
+	for name, phys in sorted(names.items()):
+		if name not in mmf.hmms:
+			missing.append(name)
+			continue
+		state_names, trans_name = mmf.hmms[name]
+		same = [h for h in phys if state_names == [naming.state_name(s) for s in hmms.pdfs[h]]]
+		if not same:
+			states.append(name)
+		mat = mmf.transitions.get(trans_name)
+		if mat is None or not any(mat.shape == mats[h].shape and np.allclose(mat, mats[h], rtol=rtol, atol=atol) for h in same or phys):
+			trans.append(name)
+
+	merged = [name for name, phys in sorted(names.items()) if len(phys) > 1]
+	if merged:
+		print >> sys.stderr, "WARNING: %d physical HMMs have %d names only, %s" % (
+			sum(len(names[name]) for name in merged), len(merged), ", ".join(merged[:EXAMPLES]))
+
+	problems = []
+	if missing:
+		problems.append(problem("physical HMMs missing in MMF", len(missing), len(names), missing))
+	if states:
+		problems.append(problem("HMMs with other states", len(states), len(names), states))
+	if trans:
+		problems.append(problem("HMMs with other transitions (rtol %g)" % rtol, len(trans), len(names), trans))
+	return problems
+
+
+def verify_tiedlist(mmf, tied, model, naming):
+	"""Problems of tiedlist: every logical triphone resolved to a physical HMM of MMF with its states"""
+	hmms = model["hmms"]
+	expected = {}  # logical name -> state names of its physical HMM
+	merged = {}  # logical names of more physical HMMs -> set of their state names
+	for h in range(len(hmms)):
+		states = tuple([naming.state_name(s) for s in hmms.pdfs[h]])
+		for ctx in hmms.names(h, model["int2phones"]):
+			name = naming.hmm_name(ctx)
+			other = expected.setdefault(name, states)
+			if other is not states and other != states:
+				merged.setdefault(name, set([other])).add(states)
+
+	mmf_states = dict((name, tuple(hmm[0])) for name, hmm in mmf.hmms.iteritems())
+	undefined = set([phys for phys in tied.itervalues() if phys not in mmf_states])
+	missing, wrong = [], []
+	for name, states in expected.iteritems():
+		phys = tied.get(name)
+		if phys is None:
+			missing.append(name)
+		elif phys in mmf_states and mmf_states[phys] != states and mmf_states[phys] not in merged.get(name, ()):
+			wrong.append("%s -> %s" % (name, phys))
+	extra = set(tied).difference(expected)
+
+	problems = []
+	if undefined:
+		problems.append(problem("tiedlist entries of HMMs not in MMF", len(undefined), len(tied), sorted(undefined)))
+	if missing:
+		problems.append(problem("logical HMMs missing in tiedlist", len(missing), len(expected), sorted(missing)))
+	if wrong:
+		problems.append(problem("logical HMMs resolved to HMMs with other states", len(wrong), len(expected), sorted(wrong)))
+	if extra:
+		problems.append(problem("tiedlist entries not in Kaldi model", len(extra), len(tied), sorted(extra)))
+	return problems
+
+
+def verify(mmf, tied, model, naming, rtol=1e-5, atol=1e-30):
+	"""List of problems of loaded MMF and tiedlist against loaded Kaldi model, empty if they match"""
+	problems = []
+	gmms = model["gmms"]
+	if mmf.vecSize != gmms["vecSize"]:
+		problems.append("vector size: %s in MMF, %s in Kaldi model" % (mmf.vecSize, gmms["vecSize"]))
+	else:
+		problems.extend(verify_states(mmf, gmms["states"], naming, rtol=rtol, atol=atol))
+	problems.extend(verify_hmms(mmf, model, naming, rtol=rtol, atol=atol))
+	problems.extend(verify_tiedlist(mmf, tied, model, naming))
+	return problems
+
+
+if __name__ == "__main__":
+
+	DESCRIPTION = "Verify HTK model and tiedlist against the Kaldi model they were converted from"
+
+	parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--naming', default="ap", choices=sorted(PROFILES),
+	                    help='Names of HMMs and states, as written by kaldi2AP.py (ap) or kaldi2HTK.py (htk)')
+	parser.add_argument('--nse', default=None, type=str,
+	                    help='Noise phones of ap naming, split by comma (default: detected as kaldi2AP.py does)')
+	parser.add_argument('--silphones', default=None, type=str,
+	                    help='Numbers of silence phones, split by comma (default: detected NSE for ap, 1,2,3 for htk)')
+	parser.add_argument('--sil-pdf-classes', default=3, type=int,
+	                    help='Silphones pdf classes the model was converted with')
+	parser.add_argument('--binary-ctx', action='store_true',
+	                    help='Read integer-coded contexts from context-to-pdf --binary')
+	parser.add_argument('--ctx-shards', default=1, type=int,
+	                    help='Number of context-to-pdf processes computing shards of the contexts at once')
+	parser.add_argument('--ctx-threads', default=1, type=int,
+	                    help='Number of threads of every context-to-pdf process')
+	parser.add_argument('--tree-ctx', action='store_true',
+	                    help='Resolve contexts from the tree by kaldi_tree.py, without context-to-pdf')
+	parser.add_argument('--cache-dir', default=None, type=str,
+	                    help='Directory caching parsed models and contexts between runs')
+	parser.add_argument('--cache-size', default=DEFAULT_CACHE_SIZE >> 20, type=int,
+	                    help='Size limit of the cache in MB')
+	parser.add_argument('--jobs', default=1, type=int,
+	                    help='Number of processes parsing the MMF')
+	parser.add_argument('--min-weight', default=0.0, type=float,
+	                    help='Mixtures pruned by weight in the conversion')
+	parser.add_argument('--max-mixtures', default=0, type=int,
+	                    help='Maximal number of mixtures of state in the conversion (0 for all)')
+	parser.add_argument('--rtol', default=1e-5, type=float,
+	                    help='Relative tolerance of all parameters')
+	parser.add_argument('--atol', default=1e-30, type=float,
+	                    help='Absolute tolerance of all parameters')
+	parser.add_argument("kaldi_model")
+	parser.add_argument("kaldi_phones")
+	parser.add_argument("kaldi_tree")
+	parser.add_argument("htk_model")
+	parser.add_argument("htk_tiedlist")
+	args = parser.parse_args()
+
+	nse, nse_idx = detect_NSE(args.kaldi_phones, min_len=2)
+	if args.nse is not None:
+		nse = args.nse.split(",")
+	silphones = args.silphones
+	if silphones is None:
+		silphones = ",".join([str(x) for x in nse_idx]) if args.naming == "ap" else "1,2,3"
+	naming = make_naming(args.naming, nse=nse)
+
+	start = time.time()
+	model = load_model(args.kaldi_model, args.kaldi_phones, args.kaldi_tree, silphones=silphones, GMM=True,
+		sil_pdf_classes=args.sil_pdf_classes, binary_ctx=args.binary_ctx, cache_dir=args.cache_dir,
+		cache_size=args.cache_size << 20, ctx_shards=args.ctx_shards, ctx_threads=args.ctx_threads,
+		tree_ctx=args.tree_ctx)
+	if args.min_weight > 0 or args.max_mixtures > 0:
+		model["gmms"] = dict(model["gmms"], states=prune_gmm_set(model["gmms"]["states"], min_weight=args.min_weight,
+			max_mixtures=args.max_mixtures))
+	loaded = time.time()
+	mmf = load_mmf_arrays(args.htk_model, jobs=args.jobs)
+	tied = read_tiedlist(args.htk_tiedlist)
+	read = time.time()
+	problems = verify(mmf, tied, model, naming, rtol=args.rtol, atol=args.atol)
+	print >> sys.stderr, "Kaldi model %.1f s, MMF %.1f s, verification %.1f s" % (loaded - start, read - loaded, time.time() - read)
+
+	for p in problems:
+		print p
+	if problems:
+		sys.exit(1)
+	print "%d states, %d physical and %d logical HMMs verified" % (len(mmf.state_names), len(mmf.hmms), len(tied))
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Writer of HTK MMF sections, in text or binary form.
+
+Text numbers are formatted in bulk: for every block shape a single "%"-template is
+built (and cached) and the whole block is filled from one flat tuple of values,
+so the output is byte-identical to formatting every number with "%.6e" one by one.
+
+Binary MMF follows HTK (HModel.c): keywords are ':' followed by one byte symbol code,
+integers are big-endian shorts and reals big-endian floats, macro names stay text.
+"""
+
+import collections
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import struct
+import zlib
+
+import numpy as np
+
+# Size of the output buffer for MMF files
+BUFFER_SIZE = 1 << 20
+
+# Uncompressed size of one gzip member of compressed outputs
+GZIP_BLOCK_SIZE = 1 << 20
+
+# Rows of vectors hashed (and compared) at once when looking for shared vectors
+HASH_BLOCK_ROWS = 1 << 14
+
+# Codes of binary keywords, the HTK Symbol enumeration
+SYMBOLS = {
+	"BEGINHMM": 0, "ENDHMM": 2, "NUMMIXES": 3, "NUMSTATES": 4, "STREAMINFO": 5, "VECSIZE": 6,
+	"STATE": 15, "MIXTURE": 17, "MEAN": 20, "VARIANCE": 21, "GCONST": 24, "TRANSP": 27,
+}
+
+_templates = {}
+
+
+def _sym(name):
+	"""Binary keyword"""
+	return ":" + chr(SYMBOLS[name])
+
+
+def _short(*values):
+	return struct.pack(">%dh" % len(values), *values)
+
+
+def _floats(values):
+	return np.asarray(values, dtype=">f4").tostring()
+
+
+def _gmm_dtype(dim):
+	"""Packed record of one binary mixture: <MIXTURE> i w <MEAN> d m.. <VARIANCE> d v.. <GCONST> g"""
+	key = ("bin", dim)
+	if key not in _templates:
+		_templates[key] = np.dtype([
+			("mix", "S2"), ("idx", ">i2"), ("weight", ">f4"),
+			("mean_sym", "S2"), ("mean_dim", ">i2"), ("mean", ">f4", (dim,)),
+			("var_sym", "S2"), ("var_dim", ">i2"), ("var", ">f4", (dim,)),
+			("gconst_sym", "S2"), ("gconst", ">f4")])
+	return _templates[key]
+
+
+def _matrix_template(rows, cols):
+	"""Return cached "%.6e" template for matrix of given shape"""
+	key = ("mat", rows, cols)
+	if key not in _templates:
+		_templates[key] = "\n".join([" ".join(["%.6e"] * cols)] * rows)
+	return _templates[key]
+
+
+def _gmm_template(num_mixes, dim):
+	"""Return cached template for all mixtures of one state"""
+	key = ("gmm", num_mixes, dim)
+	if key not in _templates:
+		vec = " ".join(["%.6e"] * dim)
+		mix = "<MIXTURE> %%d %%e\n<MEAN> %d\n%s\n<VARIANCE> %d\n%s\n<GCONST> %%e\n" % (dim, vec, dim, vec)
+		_templates[key] = "<NUMMIXES> %d\n" % num_mixes + mix * num_mixes
+	return _templates[key]
+
+
+def mat2str(mat):
+	"""Convert numpy matrix to string"""
+	mat = np.asarray(mat)
+	return _matrix_template(mat.shape[0], mat.shape[1]) % tuple(mat.ravel().tolist())
+
+
+def list2str(l):
+	"""Convert list to matrix-string"""
+	return _matrix_template(1, len(l)) % tuple(l)
+
+
+def gmm_state_arrays(means_invvars, inv_vars, vecSize):
+	"""Compute means, variances and gconsts of all mixtures of one state at once"""
+	inv_vars = np.asarray(inv_vars, dtype=np.float64)
+	means = np.asarray(means_invvars, dtype=np.float64) / inv_vars
+	variances = 1.0 / inv_vars
+	gconsts = np.log(2 * np.pi) * vecSize + np.sum(np.log(variances), axis=1)
+	return means, variances, gconsts
+
+
+def format_gmm_state(weights, means, variances, gconsts):
+	"""Format <NUMMIXES> and all <MIXTURE> blocks of one state"""
+	num_mixes, dim = means.shape
+	values = np.empty((num_mixes, 3 + 2 * dim))
+	values[:, 0] = np.arange(1, num_mixes + 1)
+	values[:, 1] = weights
+	values[:, 2:2 + dim] = means
+	values[:, 2 + dim:2 + 2 * dim] = variances
+	values[:, -1] = gconsts
+	return _gmm_template(num_mixes, dim) % tuple(values.ravel().tolist())
+
+
+def format_gmm_state_binary(weights, means, variances, gconsts):
+	"""Binary <NUMMIXES> and all <MIXTURE> blocks of one state"""
+	num_mixes, dim = means.shape
+	rec = np.empty(num_mixes, dtype=_gmm_dtype(dim))
+	rec["mix"] = _sym("MIXTURE")
+	rec["idx"] = np.arange(1, num_mixes + 1)
+	rec["weight"] = weights
+	rec["mean_sym"] = _sym("MEAN")
+	rec["mean_dim"] = dim
+	rec["mean"] = means
+	rec["var_sym"] = _sym("VARIANCE")
+	rec["var_dim"] = dim
+	rec["var"] = variances
+	rec["gconst_sym"] = _sym("GCONST")
+	rec["gconst"] = gconsts
+	return _sym("NUMMIXES") + _short(num_mixes) + rec.tostring()
+
+
+def format_fake_gmm_state(vecSize):
+	"""Format single mixture state with zero means and unit variances"""
+	key = ("fake", vecSize)
+	if key not in _templates:
+		_templates[key] = "<NUMMIXES> 1\n<MIXTURE> %d %e\n<MEAN> %d\n%s\n<VARIANCE> %d\n%s\n<GCONST> %e\n" % (
+			1, 1.0, vecSize, mat2str(np.zeros((1, vecSize))), vecSize, mat2str(np.ones((1, vecSize))), 1.0)
+	return _templates[key]
+
+
+def format_fake_gmm_state_binary(vecSize):
+	"""Binary single mixture state with zero means and unit variances"""
+	key = ("fakebin", vecSize)
+	if key not in _templates:
+		_templates[key] = format_gmm_state_binary(np.ones(1), np.zeros((1, vecSize)), np.ones((1, vecSize)), np.ones(1))
+	return _templates[key]
+
+
+def write_header(fw, vecSize, binary=False):
+	"""Write ~o global options"""
+	if binary:
+		fw.write("~o\n" + _sym("STREAMINFO") + _short(1, vecSize) + _sym("VECSIZE") + _short(vecSize) + "<NULLD><USER><DIAGC>\n")
+	else:
+		fw.write("~o\n<STREAMINFO> 1 %d\n<VECSIZE> %d<NULLD><USER><DIAGC>\n" % (vecSize, vecSize))
+
+
+def format_transitions(trans_name, trans_mat, binary=False):
+	"""Format ~t transition matrix macro"""
+	if binary:
+		return '~t "T_%s"\n' % trans_name + _sym("TRANSP") + _short(trans_mat.shape[0]) + _floats(trans_mat)
+	return '~t "T_%s"\n<TRANSP> %d\n%s\n' % (trans_name, trans_mat.shape[0], mat2str(trans_mat))
+
+
+def write_transitions(fw, trans_name, trans_mat, binary=False):
+	"""Write ~t transition matrix macro"""
+	fw.write(format_transitions(trans_name, trans_mat, binary=binary))
+
+
+def state_header(state_name):
+	"""Name line of ~s state macro, the same in text and binary MMF"""
+	return '~s "%s"\n' % state_name
+
+
+def format_state_body(weights, means, variances, gconsts, binary=False):
+	"""Format mixtures of ~s state macro (everything after its name)"""
+	if binary:
+		return format_gmm_state_binary(weights, means, variances, gconsts)
+	return format_gmm_state(weights, means, variances, gconsts)
+
+
+def format_fake_state_body(vecSize, binary=False):
+	"""Format mixture of ~s state macro of fake GMM (everything after its name)"""
+	if binary:
+		return format_fake_gmm_state_binary(vecSize)
+	return format_fake_gmm_state(vecSize)
+
+
+def format_state(state_name, weights, means, variances, gconsts, binary=False):
+	"""Format ~s state macro with all its mixtures"""
+	return state_header(state_name) + format_state_body(weights, means, variances, gconsts, binary=binary)
+
+
+def format_fake_state(state_name, vecSize, binary=False):
+	"""Format ~s state macro of fake GMM"""
+	return state_header(state_name) + format_fake_state_body(vecSize, binary=binary)
+
+
+def _row_hashes(block):
+	"""64-bit hash of the bytes of every row of 2-D array"""
+	words = np.ascontiguousarray(block).view(np.uint32).astype(np.uint64)
+	factors = (2 * np.arange(words.shape[1], dtype=np.uint64) + 1) * np.uint64(0x9E3779B97F4A7C15)
+	return ((words ^ (words >> np.uint64(15))) * factors).sum(axis=1)
+
+
+def _duplicates(arrays, rows):
+	"""
+	Number of group of equal rows (equal in all arrays) of every row of rows, -1 if it has
+	no duplicate; groups numbered by their first rows. Rows are grouped by hash, in blocks,
+	then compared to the first row of their group, rows of colliding hashes get -1.
+	"""
+	hashes = np.zeros(len(rows), dtype=np.uint64)
+	for start in range(0, len(rows), HASH_BLOCK_ROWS):
+		block = rows[start:start + HASH_BLOCK_ROWS]
+		for a in arrays:
+			hashes[start:start + len(block)] = hashes[start:start + len(block)] * np.uint64(1000003) + _row_hashes(a[block])
+	_, first, inverse, counts = np.unique(hashes, return_index=True, return_inverse=True, return_counts=True)
+	same = counts[inverse] > 1
+	candidates = np.flatnonzero(same)
+	for start in range(0, len(candidates), HASH_BLOCK_ROWS):
+		c = candidates[start:start + HASH_BLOCK_ROWS]
+		for a in arrays:
+			same[c] &= (a[rows[c]] == a[rows[first[inverse[c]]]]).all(axis=1)
+	uses = np.bincount(inverse[same], minlength=len(counts))
+	dup = np.flatnonzero(uses > 1)
+	number = np.full(len(counts), -1, dtype=np.int64)
+	number[dup[np.argsort(first[dup])]] = np.arange(len(dup))
+	groups = number[inverse]
+	groups[~same] = -1
+	return groups
+
+
+class SharedVectors(object):
+	"""
+	Macros of vectors repeated in mixtures of the model (rows of means, variances and gconsts):
+	~m for mixtures with equal mean, variance and gconst, of the others ~u for equal means and
+	~v for equal variances. Vectors are compared as written (in float32 in binary MMF), a macro
+	is made only where it saves bytes. mixtures, means and variances are numbers of the macros
+	of every mixture, -1 where it is written inline.
+	"""
+	NAMES = {"u": "mean_%d", "v": "var_%d", "m": "mix_%d"}
+
+	def __init__(self, means, variances, gconsts, binary=False):
+		self.binary = binary
+		dtype = np.float32 if binary else np.float64
+		means = np.asarray(means, dtype=dtype)
+		variances = np.asarray(variances, dtype=dtype)
+		gconsts = np.asarray(gconsts, dtype=dtype)
+		self.dim = means.shape[1]
+		self.definitions = []  # (kind, name, text) in the order to write
+		self.saved = 0
+
+		self.mixtures = self._share("m", (means, variances, gconsts[:, None]), np.arange(len(means)),
+			lambda row: self._vector("MEAN", means[row]) + self._vector("VARIANCE", variances[row]) + self._gconst(gconsts[row]))
+		inline = np.flatnonzero(self.mixtures < 0)
+		self.means = np.full(len(means), -1, dtype=np.int64)
+		self.variances = np.full(len(means), -1, dtype=np.int64)
+		self.means[inline] = self._share("u", (means,), inline, lambda row: self._vector("MEAN", means[row]))
+		self.variances[inline] = self._share("v", (variances,), inline, lambda row: self._vector("VARIANCE", variances[row]))
+		self.definitions.sort(key=lambda d: "uvm".index(d[0]))
+
+	def _share(self, kind, arrays, rows, body):
+		"""Add macros of repeated rows of arrays, body(row) is their text; returns numbers of macros of rows"""
+		groups = _duplicates(arrays, rows)
+		uses = np.bincount(groups[groups >= 0])
+		values, first = np.unique(groups, return_index=True)
+		first = rows[first[values >= 0]]
+		numbers = np.full(len(uses) + 1, -1, dtype=np.int64)  # the last one for rows without group
+		ref_len = len(self.reference(kind, len(uses)))  # the longest reference
+		made = 0
+		for g in range(len(uses)):
+			text = body(first[g])
+			if (uses[g] - 1) * len(text) > (uses[g] + 1) * ref_len:
+				numbers[g] = made
+				made += 1
+				header = self.reference(kind, numbers[g])
+				self.definitions.append((kind, self.NAMES[kind] % numbers[g], header + text))
+				self.saved += (uses[g] - 1) * len(text) - (uses[g] + 1) * len(header)
+		return numbers[groups]
+
+	def reference(self, kind, number):
+		"""Macro reference (or header) ~kind "name", the same in text and binary MMF"""
+		return '~%s "%s"\n' % (kind, self.NAMES[kind] % number)
+
+	def _vector(self, keyword, vec):
+		if self.binary:
+			return _sym(keyword) + _short(len(vec)) + _floats(vec)
+		return "<%s> %d\n%s\n" % (keyword, len(vec), list2str(vec.tolist()))
+
+	def _gconst(self, gconst):
+		if self.binary:
+			return _sym("GCONST") + _floats([gconst])
+		return "<GCONST> %e\n" % gconst
+
+	def format_state_body(self, rows, weights, means, variances, gconsts):
+		"""Mixtures of ~s macro (everything after its name), mixture i is row rows[i] of the model"""
+		rows = np.asarray(rows)
+		if (self.mixtures[rows] < 0).all() and (self.means[rows] < 0).all() and (self.variances[rows] < 0).all():
+			return format_state_body(weights, means, variances, gconsts, binary=self.binary)
+		parts = [_sym("NUMMIXES") + _short(len(rows)) if self.binary else "<NUMMIXES> %d\n" % len(rows)]
+		for i, row in enumerate(rows.tolist()):
+			if self.binary:
+				parts.append(_sym("MIXTURE") + _short(i + 1) + _floats([weights[i]]))
+			else:
+				parts.append("<MIXTURE> %d %e\n" % (i + 1, weights[i]))
+			if self.mixtures[row] >= 0:
+				parts.append(self.reference("m", self.mixtures[row]))
+				continue
+			parts.append(self.reference("u", self.means[row]) if self.means[row] >= 0 else self._vector("MEAN", means[i]))
+			parts.append(self.reference("v", self.variances[row]) if self.variances[row] >= 0 else self._vector("VARIANCE", variances[i]))
+			parts.append(self._gconst(gconsts[i]))
+		return "".join(parts)
+
+
+def format_hmm(hmm_name, state_names, trans_name, binary=False):
+	"""Format ~h HMM definition"""
+	if binary:
+		parts = ['~h "%s"\n' % hmm_name, _sym("BEGINHMM"), _sym("NUMSTATES"), _short(len(state_names) + 2)]
+		for idx, s in enumerate(state_names):
+			parts.append(_sym("STATE") + _short(idx + 2))
+			parts.append('~s "%s"\n' % s)
+		parts.append('~t "T_%s"\n' % trans_name)
+		parts.append(_sym("ENDHMM"))
+		return "".join(parts)
+	lines = ['~h "%s"' % hmm_name, "<BEGINHMM>", "<NUMSTATES> %d" % (len(state_names) + 2)]
+	for idx, s in enumerate(state_names):
+		lines.append("<STATE> %d" % (idx + 2))
+		lines.append('~s "%s"' % s)
+	lines.append('~t "T_%s"' % trans_name)
+	lines.append("<ENDHMM>\n")
+	return "\n".join(lines)
+
+
+def write_gmm_state(fw, state_name, weights, means, variances, gconsts, binary=False):
+	"""Write ~s state macro with all its mixtures"""
+	fw.write(format_state(state_name, weights, means, variances, gconsts, binary=binary))
+
+
+def write_fake_gmm_state(fw, state_name, vecSize, binary=False):
+	"""Write ~s state macro of fake GMM"""
+	fw.write(format_fake_state(state_name, vecSize, binary=binary))
+
+
+def write_hmm(fw, hmm_name, state_names, trans_name, binary=False):
+	"""Write ~h HMM definition"""
+	fw.write(format_hmm(hmm_name, state_names, trans_name, binary=binary))
+
+
+def _gzip_member(data, level):
+	z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return z.compress(data) + z.flush()
+
+
+class BlockGzipFile(object):
+	"""
+	Gzip compressed output written as a multi-member stream: every block of block_size
+	bytes is compressed into its own gzip member, by jobs threads (zlib runs without the
+	GIL), and the members are written in order, so gzip and zcat read it as one file.
+	flush() writes all pending blocks and stops the threads, nothing runs across a fork.
+	"""
+
+	def __init__(self, fname, jobs=1, level=6, block_size=GZIP_BLOCK_SIZE):
+		self.fw = open(fname, "wb")
+		self.jobs = jobs
+		self.level = level
+		self.block_size = block_size
+		self.buffer = []
+		self.buffered = 0
+		self.pending = collections.deque()
+		self.pool = None
+		self.softspace = 0  # print >> works on it
+
+	def write(self, text):
+		self.buffer.append(text)
+		self.buffered += len(text)
+		if self.buffered >= self.block_size:
+			self._compress_buffer()
+
+	def _compress_buffer(self):
+		data = "".join(self.buffer)
+		self.buffer = []
+		self.buffered = 0
+		for start in range(0, len(data), self.block_size):
+			block = data[start:start + self.block_size]
+			if self.jobs <= 1:
+				self.fw.write(_gzip_member(block, self.level))
+				continue
+			if self.pool is None:
+				self.pool = multiprocessing.pool.ThreadPool(self.jobs)
+			self.pending.append(self.pool.apply_async(_gzip_member, (block, self.level)))
+			while len(self.pending) > 2 * self.jobs:
+				self.fw.write(self.pending.popleft().get())
+
+	def flush(self):
+		if self.buffered:
+			self._compress_buffer()
+		while self.pending:
+			self.fw.write(self.pending.popleft().get())
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+		self.fw.flush()
+
+	def fileno(self):
+		return self.fw.fileno()
+
+	def close(self):
+		if self.fw.closed:
+			return
+		try:
+			self.flush()
+		finally:
+			if self.pool is not None:
+				self.pool.terminate()
+				self.pool = None
+			self.fw.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def open_output(fname, binary=False, compress=False, jobs=1):
+	"""Open MMF or tiedlist for writing, with compress as gzip (BlockGzipFile compressing by jobs threads)"""
+	if compress:
+		return BlockGzipFile(fname, jobs=jobs)
+	return open(fname, "wb" if binary else "w", BUFFER_SIZE)
+
+
+# Formatter of the chunks, set before the pool is forked
+_chunk_formatter = None
+
+
+def _format_chunk(bounds):
+	return _chunk_formatter(*bounds)
+
+
+def _write_chunk(outputs, chunk):
+	for fw, text in zip(outputs, chunk):
+		fw.write(text)
+
+
+def write_chunks(outputs, formatter, num_items, jobs=1, chunk_size=256, write=None):
+	"""
+	Write consecutive chunks of num_items items to list of files outputs, formatter(start, end)
+	returns list of texts of the chunk, one per output. With jobs > 1 the chunks are formatted
+	on a (forked) process pool, so formatter may use any data of the caller, and they are
+	written in the same order as by the serial path. If given, write(start, end, chunk)
+	writes the chunk instead, formatter may then return anything it understands.
+	"""
+	global _chunk_formatter
+	bounds = [(i, min(i + chunk_size, num_items)) for i in range(0, num_items, chunk_size)]
+	if write is None:
+		write = lambda start, end, chunk: _write_chunk(outputs, chunk)
+	if jobs <= 1 or len(bounds) <= 1:
+		for start, end in bounds:
+			write(start, end, formatter(start, end))
+		return
+
+	_chunk_formatter = formatter
+	for fw in outputs:
+		fw.flush()  # nothing buffered may be inherited by the workers
+	pool = multiprocessing.Pool(jobs)
+	try:
+		for (start, end), chunk in itertools.izip(bounds, pool.imap(_format_chunk, bounds)):
+			write(start, end, chunk)
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+		_chunk_formatter = None
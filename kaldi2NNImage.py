@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Conversion of Kaldi nnet1 network (with its feature transform and pdf counts) to the network
+image our decoder reads (NNIMAGE1 layout), with outputs in the order of states of the HTK model
+converted by kaldi2AP.py (or kaldi2HTK.py). convert.sh writes it for every network of an
+experiment directory.
+
+Image, little-endian: header (magic, number of components, input and output dimension),
+then every component: code, input and output dimension and its parameters as float32.
+
+	SPLC  count (int32) and frame offsets (int32)
+	SHFT  shift of every dimension       SCAL  scale of every dimension
+	AFFN  weights (output x input, by rows) and bias    LINR  weights only
+	SIGM, TANH, SMAX  no parameters
+	PRIO  log-priors of the outputs, the last component
+
+Components of the feature transform come first. The state order file has the name of the
+HTK state of every output, one per line.
+"""
+
+import sys
+import os
+import argparse
+import struct
+
+import numpy as np
+
+from htk_reader import mmf_state_names
+from kaldi_convert import make_naming, PROFILES
+from kaldi_nnet import NnetReader, load_kaldi_counts, log_priors, PRIOR_FLOOR
+from kaldi_profile import Profiler, NO_PROFILER
+
+sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+
+MAGIC = b"NNIMAGE1"
+HEADER = struct.Struct("<8sIII")
+COMPONENT_HEADER = struct.Struct("<4sII")
+
+CODES = {
+	"<Splice>": b"SPLC", "<AddShift>": b"SHFT", "<Rescale>": b"SCAL", "<AffineTransform>": b"AFFN",
+	"<LinearTransform>": b"LINR", "<Sigmoid>": b"SIGM", "<Tanh>": b"TANH", "<Softmax>": b"SMAX",
+}
+PRIORS_CODE = b"PRIO"
+
+# Bytes of weights written at once
+ROW_BLOCK_BYTES = 16 << 20
+
+
+def state_order(fmmf, num_pdfs, naming):
+	"""Names of states of HTK model and their pdfs, in the order of the model"""
+	pdf_of = dict((naming.state_name(p), p) for p in range(num_pdfs))
+	names = mmf_state_names(fmmf)
+	missing = [name for name in names if name not in pdf_of]
+	if missing:
+		raise ValueError("%d states of %s are not outputs of the network, e.g. %s" % (len(missing), fmmf, missing[0]))
+	return names, np.array([pdf_of[name] for name in names], dtype=np.int64)
+
+
+def write_rows(fw, mat, rows=None):
+	"""Write matrix (or its rows in given order) as float32, in blocks of rows"""
+	num_rows = mat.shape[0] if rows is None else len(rows)
+	step = max(1, ROW_BLOCK_BYTES // (4 * max(1, int(np.prod(mat.shape[1:])))))
+	for start in range(0, num_rows, step):
+		end = min(start + step, num_rows)
+		block = mat[start:end] if rows is None else mat[rows[start:end]]
+		fw.write(np.ascontiguousarray(block, dtype="<f4").tostring())
+
+
+def write_image(fimage, components, order, priors):
+	"""
+	Write image of components, rows of the last transform (and dimensions of the components
+	after it) follow order, priors are log-priors in that order. Returns image size.
+	"""
+	last = max(i for i, c in enumerate(components) if "linearity" in c.params)
+	for c in components[last + 1:]:
+		if c.params:
+			raise ValueError("Component %s after the output transform not supported" % c.kind)
+	with open(fimage, "wb") as fw:
+		fw.write(HEADER.pack(MAGIC, len(components) + 1, components[0].dim_in, len(order)))
+		for i, c in enumerate(components):
+			rows = order if i >= last else None
+			dim_out = c.dim_out if rows is None else len(rows)
+			dim_in = c.dim_in if i <= last else len(rows)
+			fw.write(COMPONENT_HEADER.pack(CODES[c.kind], dim_in, dim_out))
+			if c.kind == "<Splice>":
+				fw.write(np.array([len(c.params["offsets"])], dtype="<i4").tostring())
+				fw.write(np.asarray(c.params["offsets"], dtype="<i4").tostring())
+			for name in ("shift", "scale"):
+				if name in c.params:
+					write_rows(fw, c.params[name])
+			if "linearity" in c.params:
+				write_rows(fw, c.params["linearity"], rows)
+			if "bias" in c.params:
+				write_rows(fw, c.params["bias"], rows)
+		fw.write(COMPONENT_HEADER.pack(PRIORS_CODE, len(order), len(order)))
+		write_rows(fw, priors)
+		return fw.tell()
+
+
+def check_dimensions(components):
+	"""Every component takes the output of the previous one"""
+	for prev, c in zip(components, components[1:]):
+		if c.dim_in != prev.dim_out:
+			raise ValueError("%s takes %d inputs, but %s gives %d" % (c.kind, c.dim_in, prev.kind, prev.dim_out))
+	for c in components:
+		if c.kind == "<Splice>" and c.dim_out != c.dim_in * len(c.params["offsets"]):
+			raise ValueError("Splice of %d frames gives %d, not %d outputs" % (len(c.params["offsets"]), c.dim_in * len(c.params["offsets"]), c.dim_out))
+
+
+def convert(fmmf, fnnet, ftransform, fcounts, fimage, forder, naming="ap", prior_floor=PRIOR_FLOOR, tmpdir=None, profile=None):
+	"""Convert Kaldi network with feature transform and pdf counts to image and state order of HTK model fmmf"""
+	profiler = NO_PROFILER
+	if profile:
+		profiler = Profiler()
+		profiler.start()
+
+	readers = []
+	try:
+		with profiler.stage("read_nnet") as stage:
+			components = []
+			for fname in (ftransform, fnnet):
+				reader = NnetReader(fname, tmpdir=tmpdir)
+				readers.append(reader)
+				components.extend(reader)
+			check_dimensions(components)
+			stage.counts["components"] = len(components)
+			stage.counts["parameters"] = sum(int(p.size) for c in components for p in c.params.values())
+
+		with profiler.stage("priors") as stage:
+			counts = load_kaldi_counts(fcounts)
+			if len(counts) != components[-1].dim_out:
+				raise ValueError("%d pdf counts for %d outputs of the network" % (len(counts), components[-1].dim_out))
+			priors, floored = log_priors(counts, floor=prior_floor)
+			stage.counts["floored_priors"] = floored
+			if floored:
+				print >> sys.stderr, "INFO: %d of %d priors floored" % (floored, len(priors))
+
+		with profiler.stage("write_image") as stage:
+			names, order = state_order(fmmf, len(counts), make_naming(naming))
+			if len(order) < len(counts):
+				print >> sys.stderr, "INFO: %d outputs of the network have no state in %s, left out" % (len(counts) - len(order), fmmf)
+			stage.counts["image_bytes"] = write_image(fimage, components, order, priors[order])
+			with open(forder, "w") as fw:
+				for name in names:
+					print >> fw, name
+			stage.counts["states"] = len(names)
+	finally:
+		for reader in readers:
+			reader.close()
+
+	if profiler.enabled:
+		profiler.stop()
+		profiler.write(profile)
+
+
+if __name__ == "__main__":
+
+	DESCRIPTION = "Script for converting Kaldi nnet1 network to network image of our decoder"
+
+	parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--naming', default="ap", choices=sorted(PROFILES),
+	                    help='Naming of states of the HTK model, as it was converted')
+	parser.add_argument('--prior-floor', default=PRIOR_FLOOR, type=float,
+	                    help='Outputs with smaller prior get prior sqrt(FLT_MAX), i.e. are never recognized')
+	parser.add_argument('--tmp-dir', default=None, type=str,
+	                    help='Directory for memory mapped layers of text networks')
+	parser.add_argument('--profile', default=None, type=str,
+	                    help='Write JSON report of time, memory and item counts of every stage to file ("-" for stderr)')
+	parser.add_argument("htk_model")
+	parser.add_argument("kaldi_nnet", help="Network, binary or text (nnet-copy --binary=false)")
+	parser.add_argument("kaldi_feature_transform")
+	parser.add_argument("kaldi_counts", help="Pdf counts, e.g. ali_train_pdf.counts")
+	parser.add_argument("output_image")
+	parser.add_argument("output_state_order")
+	args = parser.parse_args()
+
+	convert(args.htk_model, args.kaldi_nnet, args.kaldi_feature_transform, args.kaldi_counts,
+			args.output_image, args.output_state_order, naming=args.naming, prior_floor=args.prior_floor,
+			tmpdir=args.tmp_dir, profile=args.profile)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Batch conversion of many experiment directories (each with final.mdl, phones.txt and tree).
+
+Every directory is converted by kaldi2AP.py (or kaldi2HTK.py) in its own process, at most
+--workers at once, into its own temporary directory; the outputs are moved into the
+experiment directory only when the conversion succeeds. Failed jobs are retried.
+
+All jobs share one model cache: of the jobs with the same phones table and tree only one
+runs at first, the others start as soon as it has cached the context grouping (while it
+still converts), so every tree is parsed only once. A JSON manifest summarizes all jobs.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from kaldi_cache import ModelCache, DEFAULT_CACHE_SIZE
+
+# Converter scripts, next to this one
+SCRIPTS = {
+	"ap": os.path.join(os.path.dirname(os.path.abspath(__file__)), "kaldi2AP.py"),
+	"htk": os.path.join(os.path.dirname(os.path.abspath(__file__)), "kaldi2HTK.py"),
+}
+
+# Seconds between polls of the running jobs
+POLL_INTERVAL = 0.05
+
+# Lines of the log of a failed job kept in the manifest
+LOG_TAIL_LINES = 20
+
+
+class Job(object):
+	"""Conversion of one experiment directory"""
+
+	def __init__(self, directory, mdl="final.mdl", phones="phones.txt", tree="tree"):
+		self.directory = directory
+		self.fmdl = os.path.join(directory, mdl)
+		self.fphones = os.path.join(directory, phones)
+		self.ftree = os.path.join(directory, tree)
+		self.group = None
+		self.leader = False
+		self.attempts = 0
+		self.status = "pending"
+		self.proc = None
+		self.tmpdir = None
+		self.log = None
+		self.start = None
+		self.wall = 0.0
+		self.returncode = None
+		self.error = None
+
+	def missing(self):
+		"""Input files that do not exist"""
+		return [f for f in (self.fmdl, self.fphones, self.ftree) if not os.path.isfile(f)]
+
+
+def log_tail(fname, lines=LOG_TAIL_LINES):
+	"""Last lines of file"""
+	try:
+		with open(fname) as f:
+			return f.read().splitlines()[-lines:]
+	except IOError:
+		return []
+
+
+class BatchConverter(object):
+	"""
+	Worker pool of conversion processes. Jobs of one group (same phones, tree and options)
+	wait while another job of the group is running for the first time, until its context
+	grouping appears in the cache.
+	"""
+
+	def __init__(self, script, options, workers, retries, cache_dir, cache_size=DEFAULT_CACHE_SIZE, model_name="HTKmodels",
+	             tiedlist_name="tiedlist", tmp_root=None):
+		self.script = script
+		self.options = options
+		self.workers = workers
+		self.retries = retries
+		self.cache = ModelCache(cache_dir, cache_size)
+		self.model_name = model_name
+		self.tiedlist_name = tiedlist_name
+		self.tmp_root = tmp_root
+		self.groups = {}  # group -> "pending", "running", "cached" or "done"
+		self.group_start = {}  # group -> start of its running leader
+
+	def command(self, job):
+		out = [os.path.join(job.tmpdir, self.model_name), os.path.join(job.tmpdir, self.tiedlist_name)]
+		return ([sys.executable, self.script] + self.options + ["--cache-dir", self.cache.root,
+			"--cache-size", str(self.cache.max_bytes >> 20), job.fmdl, job.fphones, job.ftree] + out)
+
+	def ready(self, job):
+		"""Job may start: its group is parsed (the leader cached its contexts), or no other job of its group runs"""
+		if self.groups[job.group] == "running" and self.cache.find_hmms(job.group, since=self.group_start[job.group]):
+			self.groups[job.group] = "cached"
+		return self.groups[job.group] != "running"
+
+	def launch(self, job):
+		job.attempts += 1
+		job.tmpdir = tempfile.mkdtemp(prefix="kaldi_batch-", dir=self.tmp_root)
+		job.log = os.path.join(job.tmpdir, "convert.log")
+		if self.groups[job.group] == "pending":
+			self.groups[job.group] = "running"
+			self.group_start[job.group] = time.time()
+			job.leader = True
+		else:
+			job.leader = False
+		env = dict(os.environ, TMPDIR=job.tmpdir)
+		with open(job.log, "w") as log:
+			job.proc = subprocess.Popen(self.command(job), stdout=log, stderr=subprocess.STDOUT, env=env)
+		job.start = time.time()
+		job.status = "running"
+		print >> sys.stderr, "START %s (attempt %d)" % (job.directory, job.attempts)
+
+	def finish(self, job):
+		"""Collect finished job, returns True if it is done (succeeded or out of retries)"""
+		job.wall += time.time() - job.start
+		job.returncode = job.proc.returncode
+		job.proc = None
+		ok = job.returncode == 0
+		if ok:
+			try:
+				# model and tiedlist with their sidecar files (.idx, .tables, ...)
+				outputs = [name for name in sorted(os.listdir(job.tmpdir)) if name.startswith((self.model_name, self.tiedlist_name))
+					and os.path.isfile(os.path.join(job.tmpdir, name))]
+				for prefix in (self.model_name, self.tiedlist_name):
+					if not any(name.startswith(prefix) for name in outputs):
+						raise IOError("Missing output %s" % os.path.join(job.tmpdir, prefix))
+				for name in outputs:
+					shutil.move(os.path.join(job.tmpdir, name), os.path.join(job.directory, name))
+				shutil.copy(job.log, os.path.join(job.directory, self.model_name + ".log"))
+			except (IOError, OSError) as e:
+				ok = False
+				job.error = str(e)
+		if not ok and job.error is None:
+			job.error = "\n".join(log_tail(job.log))
+		if job.leader and self.groups[job.group] == "running":
+			# on failure before the contexts were cached another job of the group parses the tree
+			self.groups[job.group] = "done" if ok else "pending"
+		shutil.rmtree(job.tmpdir, ignore_errors=True)
+		job.tmpdir = None
+
+		if ok:
+			job.status = "ok"
+			job.error = None
+		elif job.attempts > self.retries:
+			job.status = "failed"
+		else:
+			job.status = "pending"
+		print >> sys.stderr, "%s %s (attempt %d, %.1f s)" % ("DONE" if ok else "FAIL", job.directory, job.attempts, job.wall)
+		return job.status != "pending"
+
+	def run(self, jobs):
+		"""Run all jobs, returns them with their status, attempts and times"""
+		queue = []
+		for job in jobs:
+			missing = job.missing()
+			if missing:
+				job.status = "failed"
+				job.error = "Missing %s" % ", ".join(missing)
+				continue
+			job.group = (self.cache.digest(job.fphones), self.cache.digest(job.ftree))
+			self.groups.setdefault(job.group, "pending")
+			queue.append(job)
+
+		running = []
+		try:
+			while queue or running:
+				for job in list(queue):
+					if len(running) >= self.workers:
+						break
+					if self.ready(job):
+						queue.remove(job)
+						self.launch(job)
+						running.append(job)
+				time.sleep(POLL_INTERVAL)
+				for job in list(running):
+					if job.proc.poll() is not None:
+						running.remove(job)
+						if not self.finish(job):
+							queue.append(job)
+		finally:
+			for job in running:
+				job.proc.kill()
+				job.proc.wait()
+				shutil.rmtree(job.tmpdir, ignore_errors=True)
+		return jobs
+
+
+def manifest(jobs, wall):
+	"""Summary of batch: every job and totals"""
+	return {
+		"wall": wall,
+		"jobs_wall": sum(job.wall for job in jobs),
+		"ok": sum(job.status == "ok" for job in jobs),
+		"failed": sum(job.status == "failed" for job in jobs),
+		"jobs": [{"directory": job.directory, "status": job.status, "attempts": job.attempts, "wall": job.wall,
+			"returncode": job.returncode, "error": job.error} for job in jobs],
+	}
+
+
+def read_dirs(args):
+	"""Experiment directories from arguments and --list file"""
+	dirs = list(args.dirs)
+	if args.list:
+		with open(args.list) as f:
+			dirs.extend([line.strip() for line in f if line.strip() and not line.startswith("#")])
+	return dirs
+
+
+if __name__ == "__main__":
+
+	DESCRIPTION = "Convert Kaldi models of many experiment directories in parallel"
+
+	parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--list', default=None, type=str,
+	                    help='File with experiment directories, one per line')
+	parser.add_argument('--converter', default="ap", choices=sorted(SCRIPTS),
+	                    help='Convert by kaldi2AP.py (ap) or kaldi2HTK.py (htk)')
+	parser.add_argument('--options', default="", type=str,
+	                    help='More options of the converter, e.g. "--binary --jobs 2"')
+	parser.add_argument('--workers', default=max(1, os.sysconf("SC_NPROCESSORS_ONLN")), type=int,
+	                    help='Conversions running at once')
+	parser.add_argument('--retries', default=1, type=int,
+	                    help='Retries of a failed conversion')
+	parser.add_argument('--mdl', default="final.mdl", type=str,
+	                    help='Model file in every directory')
+	parser.add_argument('--phones', default="phones.txt", type=str,
+	                    help='Phones table in every directory')
+	parser.add_argument('--tree', default="tree", type=str,
+	                    help='Tree in every directory')
+	parser.add_argument('--model-name', default="HTKmodels", type=str,
+	                    help='Output model written into every directory')
+	parser.add_argument('--tiedlist-name', default="tiedlist", type=str,
+	                    help='Output tiedlist written into every directory')
+	parser.add_argument('--cache-dir', default=None, type=str,
+	                    help='Model cache shared by the jobs (default: temporary, removed)')
+	parser.add_argument('--cache-size', default=DEFAULT_CACHE_SIZE >> 20, type=int,
+	                    help='Size limit of the cache in MB')
+	parser.add_argument('--tmp-dir', default=None, type=str,
+	                    help='Directory for temporary directories of the jobs')
+	parser.add_argument('--manifest', default="batch_manifest.json", type=str,
+	                    help='JSON summary of all jobs')
+	parser.add_argument("dirs", nargs="*", help="Experiment directories")
+	args = parser.parse_args()
+
+	dirs = read_dirs(args)
+	if not dirs:
+		parser.error("no experiment directories given")
+
+	cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="kaldi_batch_cache-", dir=args.tmp_dir)
+	try:
+		batch = BatchConverter(SCRIPTS[args.converter], shlex.split(args.options), args.workers, args.retries, cache_dir,
+			cache_size=args.cache_size << 20, model_name=args.model_name, tiedlist_name=args.tiedlist_name,
+			tmp_root=args.tmp_dir)
+		wall = time.time()
+		jobs = batch.run([Job(d, mdl=args.mdl, phones=args.phones, tree=args.tree) for d in dirs])
+		wall = time.time() - wall
+	finally:
+		if args.cache_dir is None:
+			shutil.rmtree(cache_dir, ignore_errors=True)
+
+	summary = manifest(jobs, wall)
+	with open(args.manifest, "w") as f:
+		json.dump(summary, f, indent=1)
+	print >> sys.stderr, "%d ok, %d failed, %.1f s (%.1f s of jobs)" % (summary["ok"], summary["failed"], wall, summary["jobs_wall"])
+	if summary["failed"]:
+		sys.exit(1)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmark of the conversion stages on synthetic Kaldi models.
+
+The generators write the same formats the loaders read: phones table, gmm-copy
+--binary=false text, print-transitions lines and context-to-pdf lines. Every phone
+has 3 pdf classes and every (phone, pdf class) is split into clusters pdfs by its
+left and right context, so there are (number of phones) * 3 * clusters pdfs.
+
+Every size tier runs in its own process, each stage is timed (wall and CPU) and its
+peak RSS is measured. Results can be saved as a baseline and later runs compared
+against it.
+
+The stream_mmf stage converts with --stream before the GMMs are loaded; its RSS growth
+(peak minus RSS at its start) should stay flat over the tiers, --max-stream-rss checks it.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from kaldi_mdl import load_kaldi_transitions, load_kaldi_gmms
+from kaldi_ctx import load_kaldi_hmms
+from kaldi_convert import load_kaldi_phones, HtkNaming, GmmStream, write_mmf, write_tiedlist
+from kaldi_profile import current_rss, peak_rss, reset_peak_rss, cpu_time
+
+# name: (phones, clusters per phone state, mixtures, dimension)
+TIERS = {
+	"tiny": (10, 2, 2, 13),
+	"small": (30, 4, 8, 39),
+	"medium": (60, 8, 16, 39),
+	"large": (100, 27, 32, 39),
+}
+
+def synth_phones(num_phones):
+	"""Phones table of synthetic model: <eps>, silences, phones and disambig symbols"""
+	return ["<eps>", "SIL", "SPN", "NSN"] + ["p%d" % i for i in range(num_phones)] + ["#0", "#1"]
+
+
+def pdf_of(left, phone, right, pdf_class, clusters):
+	"""Synthetic tree: pdf of context (arrays of phone ids)"""
+	return ((phone - 1) * 3 + pdf_class) * clusters + (left * 31 + right * 17 + pdf_class) % clusters
+
+
+def write_phones(fname, phones):
+	with open(fname, "w") as f:
+		for i, ph in enumerate(phones):
+			f.write("%s %d\n" % (ph, i))
+
+
+def write_contexts(fname, phones, clusters):
+	"""Lines of context-to-pdf for all triphones (disambig and <eps> included, as the binary writes them)"""
+	n = len(phones)
+	lines = 0
+	with open(fname, "w") as f:
+		for left in range(n):
+			right = np.repeat(np.arange(n), 3)
+			pdf_class = np.tile(np.arange(3), n)
+			for phone in range(1, n):
+				pdfs = pdf_of(left, phone, right, pdf_class, clusters).tolist()
+				prefix = "%s %s " % (phones[left], phones[phone])
+				f.write("".join(["%s%s %d %d\n" % (prefix, phones[r], k, p)
+					for r, k, p in zip(right.tolist(), pdf_class.tolist(), pdfs)]))
+				lines += len(pdfs)
+	return lines
+
+
+def write_transitions(fname, phones, clusters):
+	"""Lines of print-transitions: self-loop and forward transition of every pdf"""
+	lines = []
+	tid = 1
+	for phone in range(1, len(phones)):
+		for pdf_class in range(3):
+			for c in range(clusters):
+				pdf = ((phone - 1) * 3 + pdf_class) * clusters + c
+				for trans_idx, prob in enumerate((0.75, 0.25)):
+					lines.append("%d %d %d %d %d %d %g %d %d\n" % (tid, pdf, phone, pdf_class, trans_idx, tid, prob, 1 - trans_idx, 0))
+					tid += 1
+	with open(fname, "w") as f:
+		f.write("".join(lines))
+	return len(lines)
+
+
+def write_gmms(fname, num_pdfs, mixtures, dim, seed=0):
+	"""Text model as gmm-copy --binary=false writes it (transition model left out, the loader skips it)"""
+	rng = np.random.RandomState(seed)
+	vec = " ".join(["%g"] * dim)
+	with open(fname, "w") as f:
+		f.write("<TransitionModel> \n</TransitionModel> \n<DIMENSION> %d <NUMPDFS> %d <DiagGMM> \n" % (dim, num_pdfs))
+		for pdf in range(num_pdfs):
+			if pdf:
+				f.write("<DiagGMM> \n")
+			weights = rng.rand(mixtures) + 0.1
+			weights /= weights.sum()
+			inv_vars = rng.rand(mixtures, dim) + 0.5
+			means_invvars = rng.randn(mixtures, dim) * inv_vars
+			gconsts = -rng.rand(mixtures) * 100
+			rows = lambda m: "\n".join(["  " + vec % tuple(row) for row in m.tolist()])
+			f.write("<GCONSTS>  [ %s ]\n" % " ".join(["%g" % x for x in gconsts]))
+			f.write("<WEIGHTS>  [ %s ]\n" % " ".join(["%g" % x for x in weights]))
+			f.write("<MEANS_INVVARS>  [\n%s ]\n" % rows(means_invvars))
+			f.write("<INV_VARS>  [\n%s ]\n" % rows(inv_vars))
+			f.write("</DiagGMM> \n")
+
+
+def generate(directory, num_phones, clusters, mixtures, dim):
+	"""Write synthetic model into directory, returns its sizes and dict of file names"""
+	phones = synth_phones(num_phones)
+	num_pdfs = (len(phones) - 1) * 3 * clusters
+	files = dict((k, os.path.join(directory, k)) for k in ("phones.txt", "ctx", "transitions", "final.mdl.txt"))
+	write_phones(files["phones.txt"], phones)
+	info = {
+		"phones": len(phones),
+		"pdfs": num_pdfs,
+		"ctx_lines": write_contexts(files["ctx"], phones, clusters),
+		"transition_lines": write_transitions(files["transitions"], phones, clusters),
+	}
+	write_gmms(files["final.mdl.txt"], num_pdfs, mixtures, dim)
+	info["files"] = files
+	return info
+
+
+def timed(stage, func, items, nbytes=None):
+	"""Run func, returns (result, stage report)"""
+	reset_peak_rss()
+	rss = current_rss()
+	cpu = cpu_time()
+	wall = time.time()
+	result = func()
+	wall = time.time() - wall
+	cpu = cpu_time() - cpu
+	report = {"stage": stage, "wall": wall, "cpu": cpu, "items": items, "items_per_s": items / max(wall, 1e-9),
+		"peak_rss": peak_rss()}
+	report["rss_growth"] = report["peak_rss"] - rss
+	if nbytes is not None:
+		report["mb_per_s"] = nbytes / 1e6 / max(wall, 1e-9)
+	return result, report
+
+
+def run_tier(name, params, workdir, repeat=1):
+	"""Generate tier and time all stages, the fastest of repeat runs counts"""
+	directory = os.path.join(workdir, name)
+	os.makedirs(directory)
+	info = generate(directory, *params)
+	files = info["files"]
+	size = lambda k: os.path.getsize(files[k])
+	phones2int, int2phones = load_kaldi_phones(files["phones.txt"])
+	naming = HtkNaming()
+	fout = os.path.join(directory, "HTKmodels")
+	ftied = os.path.join(directory, "tiedlist")
+
+	best = {}
+	for r in range(repeat):
+		reports = []
+		trans, rep = timed("load_kaldi_transitions", lambda: load_kaldi_transitions(files["transitions"]),
+			info["transition_lines"], size("transitions"))
+		reports.append(rep)
+		hmms, rep = timed("load_kaldi_hmms", lambda: load_kaldi_hmms(files["ctx"], phones2int), info["ctx_lines"], size("ctx"))
+		reports.append(rep)
+		info["physical_hmms"] = len(hmms)
+		info["logical_hmms"] = hmms.num_logical
+
+		# before the GMMs are loaded, only the transitions and HMMs are in memory
+		stream_model = {"phones2int": phones2int, "int2phones": int2phones, "hmms": hmms, "trans": trans, "gmms": None}
+		_, rep = timed("stream_mmf", lambda: write_mmf(dict(stream_model, gmms=GmmStream(files["final.mdl.txt"], read_text=True)),
+			[(naming, fout + ".stream", ftied)], GMM=True), info["pdfs"])
+		rep["mb_per_s"] = os.path.getsize(fout + ".stream") / 1e6 / max(rep["wall"], 1e-9)
+		reports.append(rep)
+
+		gmms, rep = timed("load_kaldi_gmms", lambda: load_kaldi_gmms(files["final.mdl.txt"]), info["pdfs"], size("final.mdl.txt"))
+		reports.append(rep)
+
+		model = {"phones2int": phones2int, "int2phones": int2phones, "hmms": hmms, "trans": trans, "gmms": gmms}
+		_, rep = timed("write_mmf", lambda: write_mmf(model, [(naming, fout, ftied)], GMM=True), info["pdfs"])
+		rep["mb_per_s"] = os.path.getsize(fout) / 1e6 / max(rep["wall"], 1e-9)
+		reports.append(rep)
+		_, rep = timed("write_tiedlist", lambda: write_tiedlist(ftied, hmms, int2phones, naming), hmms.num_logical)
+		rep["mb_per_s"] = os.path.getsize(ftied) / 1e6 / max(rep["wall"], 1e-9)
+		reports.append(rep)
+
+		for rep in reports:
+			if rep["stage"] not in best or rep["wall"] < best[rep["stage"]]["wall"]:
+				best[rep["stage"]] = rep
+		gmms = model = None
+
+	del info["files"]
+	return {"tier": name, "params": dict(zip(("phones", "clusters", "mixtures", "dim"), params)), "info": info,
+		"stages": [best[rep["stage"]] for rep in reports]}
+
+
+def _run_tier_process(queue, name, params, workdir, repeat):
+	try:
+		queue.put(run_tier(name, params, workdir, repeat))
+	except Exception as e:
+		queue.put(e)
+
+
+def run_tier_isolated(name, params, workdir, repeat=1):
+	"""Run tier in a child process, so that memory of one tier does not count in the next one"""
+	queue = multiprocessing.Queue()
+	proc = multiprocessing.Process(target=_run_tier_process, args=(queue, name, params, workdir, repeat))
+	proc.start()
+	result = queue.get()
+	proc.join()
+	if isinstance(result, Exception):
+		raise result
+	return result
+
+
+def compare_baseline(results, baseline, tolerance=0.2, min_seconds=0.05):
+	"""List of regressions: stages slower than baseline by more than tolerance (and min_seconds)"""
+	regressions = []
+	for res in results:
+		base = baseline.get(res["tier"], {})
+		for rep in res["stages"]:
+			if rep["stage"] not in base:
+				continue
+			old = base[rep["stage"]]
+			if rep["wall"] > old * (1 + tolerance) and rep["wall"] - old > min_seconds:
+				regressions.append("%s %s: %.3f s, baseline %.3f s (+%.0f%%)" % (
+					res["tier"], rep["stage"], rep["wall"], old, 100 * (rep["wall"] / old - 1)))
+	return regressions
+
+
+def check_stream_rss(results, max_growth):
+	"""List of tiers whose stream_mmf stage grew RSS by more than max_growth bytes"""
+	failures = []
+	for res in results:
+		for rep in res["stages"]:
+			if rep["stage"] == "stream_mmf" and rep["rss_growth"] > max_growth:
+				failures.append("%s stream_mmf: RSS grew by %.1f MB, limit %.1f MB" % (res["tier"], rep["rss_growth"] / 1e6,
+					max_growth / 1e6))
+	return failures
+
+
+def baseline_of(results):
+	"""Baseline (tier -> stage -> wall time) of results"""
+	return dict((res["tier"], dict((rep["stage"], rep["wall"]) for rep in res["stages"])) for res in results)
+
+
+def print_report(results, out=sys.stdout):
+	for res in results:
+		info = res["info"]
+		print >> out, "%s: %d phones, %d pdfs, %d mixtures, dim %d, %d context lines, %d/%d physical/logical HMMs" % (
+			res["tier"], info["phones"], info["pdfs"], res["params"]["mixtures"], res["params"]["dim"], info["ctx_lines"],
+			info["physical_hmms"], info["logical_hmms"])
+		for rep in res["stages"]:
+			print >> out, "  %-24s %8.3f s wall %8.3f s cpu %12.0f items/s %8.1f MB/s %8.1f MB peak RSS %+8.1f MB" % (rep["stage"],
+				rep["wall"], rep["cpu"], rep["items_per_s"], rep.get("mb_per_s", 0.0), rep["peak_rss"] / 1e6,
+				rep["rss_growth"] / 1e6)
+
+
+if __name__ == "__main__":
+
+	DESCRIPTION = "Benchmark of conversion stages on synthetic Kaldi models"
+
+	parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--tiers', default="tiny,small", type=str,
+	                    help='Size tiers to run, split by comma, from: %s' % ", ".join(sorted(TIERS)))
+	parser.add_argument('--custom', nargs=4, type=int, metavar=('PHONES', 'CLUSTERS', 'MIXTURES', 'DIM'),
+	                    help='Run also custom tier')
+	parser.add_argument('--repeat', default=1, type=int,
+	                    help='Runs of every stage, the fastest counts')
+	parser.add_argument('--baseline', default=None, type=str,
+	                    help='JSON baseline to compare with, exits with 1 on regression')
+	parser.add_argument('--save-baseline', default=None, type=str,
+	                    help='Save times of this run as JSON baseline')
+	parser.add_argument('--tolerance', default=0.2, type=float,
+	                    help='Allowed slowdown against baseline (0.2 = 20%%)')
+	parser.add_argument('--max-stream-rss', default=None, type=float,
+	                    help='Exit with 1 when the stream_mmf stage of any tier grows RSS by more MB than this')
+	parser.add_argument('--json', default=None, type=str,
+	                    help='Write full results as JSON')
+	parser.add_argument('--workdir', default=None, type=str,
+	                    help='Keep generated models in this directory (default: temporary, removed)')
+	args = parser.parse_args()
+
+	tiers = [(name, TIERS[name]) for name in args.tiers.split(",") if name]
+	if args.custom:
+		tiers.append(("custom", tuple(args.custom)))
+
+	workdir = args.workdir or tempfile.mkdtemp(prefix="kaldi_bench-")
+	try:
+		results = [run_tier_isolated(name, params, workdir, args.repeat) for name, params in tiers]
+	finally:
+		if args.workdir is None:
+			shutil.rmtree(workdir)
+
+	print_report(results)
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump(results, f, indent=1)
+	if args.save_baseline:
+		with open(args.save_baseline, "w") as f:
+			json.dump(baseline_of(results), f, indent=1)
+
+	failed = False
+	if args.max_stream_rss is not None:
+		for r in check_stream_rss(results, args.max_stream_rss * 1e6):
+			print "MEMORY:", r
+			failed = True
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compare_baseline(results, json.load(f), tolerance=args.tolerance)
+		for r in regressions:
+			print "REGRESSION:", r
+			failed = True
+	if failed:
+		sys.exit(1)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+On-disk cache of parsed Kaldi models and context groupings.
+
+Every entry is a directory of .npy arrays and a manifest.json, named by the SHA-1 of
+the content of its source files and of the options it depends on:
+
+	mdl entries (transitions and GMMs) depend on the model only,
+	ctx entries (HMM grouping) on phones, tree, silence phones and their pdf classes.
+
+So a retrained final.mdl reuses the context grouping, and a different naming of the
+output (HTK or AP) reuses both. Arrays are loaded memory mapped. The least recently
+used entries are removed when the cache grows over its size limit.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from kaldi_ctx import HmmGroups
+from kaldi_mdl import DiagGmmSet, TransitionTable
+
+# Bump when the layout of the entries changes
+CACHE_VERSION = 3
+
+# Default size limit of the cache
+DEFAULT_CACHE_SIZE = 4 << 30
+
+# Read size when hashing files
+HASH_BLOCK_SIZE = 1 << 20
+
+MANIFEST = "manifest.json"
+
+
+def file_digest(fname):
+	"""SHA-1 of file content"""
+	h = hashlib.sha1()
+	with open(fname, "rb") as f:
+		while True:
+			block = f.read(HASH_BLOCK_SIZE)
+			if not block:
+				break
+			h.update(block)
+	return h.hexdigest()
+
+
+class ModelCache(object):
+	"""Content-addressed cache of transitions, GMMs and HMM groupings in directory root"""
+
+	def __init__(self, root, max_bytes=DEFAULT_CACHE_SIZE):
+		self.root = root
+		self.max_bytes = max_bytes
+		self._digests = {}
+		if not os.path.isdir(root):
+			os.makedirs(root)
+
+	def digest(self, fname):
+		"""Content hash of file, computed once per file"""
+		path = os.path.realpath(fname)
+		if path not in self._digests:
+			self._digests[path] = file_digest(path)
+		return self._digests[path]
+
+	def key(self, kind, files, options=()):
+		"""Key of entry of given kind from source files and options"""
+		h = hashlib.sha1("%s %d" % (kind, CACHE_VERSION))
+		for fname in files:
+			h.update(" " + self.digest(fname))
+		for opt in options:
+			h.update(" " + repr(opt))
+		return "%s-%s" % (kind, h.hexdigest())
+
+	def _path(self, key):
+		return os.path.join(self.root, key)
+
+	def load(self, key):
+		"""Dict of memory mapped arrays and manifest of entry, None if not cached"""
+		path = self._path(key)
+		try:
+			with open(os.path.join(path, MANIFEST)) as f:
+				manifest = json.load(f)
+			arrays = dict((name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r")) for name in manifest["arrays"])
+		except (IOError, OSError, ValueError):
+			return None
+		os.utime(os.path.join(path, MANIFEST), None)  # last use, for eviction
+		return arrays, manifest
+
+	def manifest(self, key):
+		"""Manifest of entry, None if not cached"""
+		try:
+			with open(os.path.join(self._path(key), MANIFEST)) as f:
+				return json.load(f)
+		except (IOError, OSError, ValueError):
+			return None
+
+	def store(self, key, arrays, replace=False, **info):
+		"""
+		Store dict of arrays (and json-serializable info) under key, then evict old entries.
+		An existing entry is kept, with replace it is replaced by the new one.
+		"""
+		path = self._path(key)
+		if os.path.isdir(path) and not replace:
+			return
+		tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+		try:
+			nbytes = 0
+			for name, arr in arrays.items():
+				arr = np.ascontiguousarray(arr)
+				np.save(os.path.join(tmp, name + ".npy"), arr)
+				nbytes += arr.nbytes
+			manifest = dict(info, key=key, version=CACHE_VERSION, arrays=sorted(arrays), nbytes=nbytes, created=time.time())
+			with open(os.path.join(tmp, MANIFEST), "w") as f:
+				json.dump(manifest, f)
+			# entries appear complete or not at all, also for concurrent conversions
+			if replace and os.path.isdir(path):
+				# a directory cannot be renamed over another one, the old entry goes aside first
+				old = tempfile.mkdtemp(prefix=".old-", dir=self.root)
+				os.rename(path, os.path.join(old, key))
+				shutil.rmtree(old, ignore_errors=True)
+			os.rename(tmp, path)
+		except OSError:
+			if not os.path.isdir(path):
+				raise
+		finally:
+			if os.path.isdir(tmp):
+				shutil.rmtree(tmp)
+		self.evict()
+
+	def entries(self):
+		"""List of (last use, size, key) of all entries"""
+		result = []
+		for key in os.listdir(self.root):
+			fname = os.path.join(self.root, key, MANIFEST)
+			if key.startswith(".") or not os.path.isfile(fname):
+				continue
+			size = sum(os.path.getsize(os.path.join(self.root, key, x)) for x in os.listdir(os.path.join(self.root, key)))
+			result.append((os.path.getmtime(fname), size, key))
+		return result
+
+	def evict(self):
+		"""Remove least recently used entries until the cache fits in max_bytes"""
+		entries = sorted(self.entries())
+		total = sum(size for _, size, _ in entries)
+		for _, size, key in entries[:-1]:  # the newest entry stays even if it is too big
+			if total <= self.max_bytes:
+				break
+			shutil.rmtree(self._path(key), ignore_errors=True)
+			total -= size
+
+	def load_model(self, key, with_gmms=True):
+		"""Cached (transitions, gmms) of model, None if not cached (or cached without GMMs)"""
+		entry = self.load(key)
+		if entry is None:
+			return None
+		arrays, manifest = entry
+		if with_gmms and not manifest["gmms"]:
+			return None
+		trans = TransitionTable(arrays["trans_probs"], arrays["trans_valid"], arrays["trans_tids"])
+		gmms = None
+		if manifest["gmms"]:
+			gmms = {"vecSize": manifest["vecSize"], "states": DiagGmmSet(arrays["weights"], arrays["gconsts"],
+				arrays["means_invvars"], arrays["inv_vars"], arrays["counts"])}
+		return trans, gmms
+
+	def store_model(self, key, trans, gmms=None):
+		"""
+		Cache TransitionTable and GMMs (as load_kaldi_gmms returns them) of model. An entry
+		cached without GMMs (e.g. by --stream) is replaced when the GMMs are given.
+		"""
+		arrays = {"trans_probs": trans.probs, "trans_valid": trans.valid, "trans_tids": trans.tids}
+		info = {"gmms": gmms is not None, "vecSize": None}
+		if gmms is not None:
+			st = gmms["states"]
+			arrays.update(weights=st.weights, gconsts=st.gconsts, means_invvars=st.means_invvars,
+				inv_vars=st.inv_vars, counts=st.counts)
+			info["vecSize"] = gmms["vecSize"]
+		cached = self.manifest(key)
+		self.store(key, arrays, replace=gmms is not None and cached is not None and not cached.get("gmms"), **info)
+
+	def load_hmms(self, key):
+		"""Cached HmmGroups, None if not cached"""
+		entry = self.load(key)
+		if entry is None:
+			return None
+		arrays, manifest = entry
+		seq = arrays["pdf_seq"].tolist()
+		ends = np.cumsum(arrays["pdf_len"]).tolist()
+		pdfs = [tuple(seq[e - n:e]) for e, n in zip(ends, arrays["pdf_len"].tolist())]
+		return HmmGroups(pdfs, arrays["contexts"], arrays["members"], arrays["offsets"])
+
+	def store_hmms(self, key, hmms, sources=()):
+		"""Cache HmmGroups, sources are digests of its phones table and tree (for find_hmms)"""
+		arrays = {
+			"pdf_seq": np.array([pdf for hmm in hmms.pdfs for pdf in hmm], dtype=np.int32),
+			"pdf_len": np.array([len(hmm) for hmm in hmms.pdfs], dtype=np.int32),
+			"contexts": hmms.contexts,
+			"members": hmms.members,
+			"offsets": hmms.offsets,
+		}
+		self.store(key, arrays, sources=list(sources))
+
+	def find_hmms(self, sources, since=0.0):
+		"""True if HmmGroups of sources (digests of phones table and tree) were cached at time since or later"""
+		for key in os.listdir(self.root):
+			if key.startswith("ctx-"):
+				manifest = self.manifest(key)
+				if manifest is not None and manifest.get("sources") == list(sources) and manifest["created"] >= since:
+					return True
+		return False
@@ -0,0 +1,746 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Conversion engine shared by kaldi2HTK.py and kaldi2AP.py.
+
+The Kaldi model is loaded once and written to any number of targets, each one an MMF
+and tiedlist pair with its own naming profile (HTK or AP names of HMMs and states).
+Transition matrices and state mixtures do not depend on the names, so they are
+formatted once and the same text is written to all targets. Options of the conversion
+common to both scripts are added to their parsers by add_options and passed on by options_of.
+
+In streaming mode (--stream) the GMMs are not loaded: every state is written as soon
+as it is parsed from the gmm-copy output (or from the mapped binary model), so only
+the transitions and the HMM grouping stay in memory.
+"""
+
+import itertools
+import os
+import sys
+
+import numpy as np
+
+from htk_writer import open_output, gmm_state_arrays, write_header, write_chunks, SharedVectors
+from htk_writer import format_transitions, state_header, format_state_body, format_fake_state_body, format_hmm
+from htk_index import MmfOutput, write_index
+from kaldi_tables import lookup_tables, write_tables
+from kaldi_mdl import is_kaldi_binary, load_kaldi_model, load_kaldi_gmms, load_kaldi_transitions
+from kaldi_mdl import iter_kaldi_gmms, iter_kaldi_model_gmms, prune_gmm_set, iter_pruned_gmms
+from kaldi_pipes import HelperPipeline
+from kaldi_ctx import load_kaldi_hmms, load_kaldi_hmms_binary, load_kaldi_hmms_shards, read_context_records, read_context_text
+from kaldi_tree import load_kaldi_tree, tree_hmms
+from kaldi_cache import ModelCache, DEFAULT_CACHE_SIZE
+from kaldi_profile import Profiler, NO_PROFILER, MemoryLimit, NO_LIMIT, counted_lines
+
+# Path to bin
+print_transitions_bin = "print-transitions"
+context_to_pdf_bin = "context-to-pdf"
+gmm_copy_bin = "gmm-copy"
+
+# Streamed GMM states between checks of the memory limit
+MEMORY_CHECK_INTERVAL = 256
+
+# Noise phones of the AP decoder
+AP_NSE = "CG ER GR HM LA LB LS NS SIL".split()
+
+
+def load_kaldi_phones(fphones):
+	"""Load Kaldi phones table"""
+	phones2int = {}
+	int2phones = {}
+
+	for line in open(fphones):
+		lx = line.strip().split()
+		ph = lx[0]
+		i = int(lx[1])
+		phones2int[ph] = i
+		int2phones[i] = ph
+
+	return phones2int, int2phones
+
+
+def to_htk_name(lst):
+	# original names
+	if len(lst) == 3:
+		return lst[0]+"-"+lst[1]+"+"+lst[2]
+	elif len(lst) == 1:
+		return lst[0]
+	else:
+		raise ValueError("Only monophone/triphone models allowed.")
+
+
+def phone_to_AP(ph, nse=AP_NSE):
+	if ph in nse:
+		return "_"+ph.lower()+"_"
+	else:
+		return ph
+
+
+def to_ap_name(lst, nse=AP_NSE):
+	# AP conversion
+	if lst[1] in nse:			# NSE as mono
+		return phone_to_AP(lst[1], nse=nse)
+	else:
+		return phone_to_AP(lst[0], nse=nse) + "-" + phone_to_AP(lst[1], nse=nse) + "+" + phone_to_AP(lst[2], nse=nse)
+
+
+def detect_NSE(phones_file, min_len=3):
+	"""
+	All phones in upper case, longer then MIN_LEN and without # in name
+	"""
+	phones = [x.strip().split()[0] for x in open(phones_file).readlines()]
+	nse = [x for x in phones if (len(x) >= min_len) and (x.upper() == x) and ("#" not in x)]
+	idx = [phones.index(x) for x in nse]
+	return nse, idx
+
+
+class HtkNaming(object):
+	"""HTK names: Kaldi phone names l-p+r, states state_N"""
+	state_format = "state_%d"
+
+	def hmm_name(self, ctx):
+		return to_htk_name(ctx)
+
+	def state_name(self, s):
+		return self.state_format % s
+
+
+class APNaming(HtkNaming):
+	"""Names for our decoder: noise phones _nse_ as monophones, states state_NNNN"""
+	state_format = "state_%04d"
+
+	def __init__(self, nse=AP_NSE):
+		self.nse = nse
+
+	def hmm_name(self, ctx):
+		return to_ap_name(ctx, nse=self.nse)
+
+
+PROFILES = {"htk": HtkNaming, "ap": APNaming}
+
+
+def make_naming(profile, nse=AP_NSE):
+	"""Naming of profile "htk" or "ap", nse are the noise phones of AP names"""
+	if profile not in PROFILES:
+		raise ValueError("Unknown naming profile %s, use one of %s" % (profile, ", ".join(sorted(PROFILES))))
+	if profile == "ap":
+		return APNaming(nse)
+	return HtkNaming()
+
+
+def load_model(fmdl, fphones, ftree, silphones="", GMM=False, sil_pdf_classes=3, binary_ctx=False, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+               profiler=NO_PROFILER, memory=NO_LIMIT, ctx_shards=1, ctx_threads=1, tree_ctx=False):
+	"""
+	Load phones, HMM grouping, transitions and (with GMM) GMMs of Kaldi model.
+	With ctx_shards > 1 that many context-to-pdf --shard run at once and their outputs are merged,
+	every one computes its contexts in ctx_threads threads. With tree_ctx the contexts are resolved
+	from the tree by kaldi_tree, without context-to-pdf.
+	"""
+
+	# binary models are read directly, text ones through Kaldi binaries
+	binary_mdl = is_kaldi_binary(fmdl)
+
+	# phones
+	with profiler.stage("load_phones") as stage:
+		phones2int, int2phones = load_kaldi_phones(fphones)
+		stage.counts["phones"] = len(phones2int)
+
+	# parsed models and contexts are reused from the cache, when they did not change
+	hmms = trans = gmms = None
+	cache = None
+	if cache_dir is not None:
+		with profiler.stage("cache_load") as stage:
+			cache = ModelCache(cache_dir, cache_size)
+			ctx_key = cache.key("ctx", [fphones, ftree], [sil_pdf_classes, silphones])
+			mdl_key = cache.key("mdl", [fmdl])
+			hmms = cache.load_hmms(ctx_key)
+			cached = cache.load_model(mdl_key, with_gmms=GMM)
+			if cached is not None:
+				trans, gmms = cached
+			stage.counts["cache_hits"] = (hmms is not None) + (cached is not None)
+
+	# output lines of the helpers are counted only when profiling
+	counts = {}
+	lines = lambda source, key: counted_lines(source, counts, key) if profiler.enabled else source
+
+	# all helpers run at once, their output is parsed as it comes
+	with profiler.stage("load_model") as stage:
+		helpers = HelperPipeline()
+		tree_groups = None
+		try:
+			if hmms is None and not tree_ctx:
+				# print all triphones
+				ctx_cmd = ["./" + context_to_pdf_bin, "--sil-pdf-classes=%d" % sil_pdf_classes, "--sil-phones=%s" % silphones]
+				if ctx_threads > 1:
+					ctx_cmd.append("--num-threads=%d" % ctx_threads)
+				if ctx_shards > 1:
+					# shards of left contexts, parsed to records and merged in load_kaldi_hmms_shards
+					for k in range(ctx_shards):
+						shard_cmd = ctx_cmd + ["--shard=%d/%d" % (k, ctx_shards)]
+						if binary_ctx:
+							helpers.start("hmms_%d" % k, shard_cmd + ["--binary=true", "--skip-disambig=true", fphones, ftree], read_context_records)
+						else:
+							helpers.start("hmms_%d" % k, shard_cmd + [fphones, ftree],
+								lambda out, k=k: read_context_text(lines(out, "context_lines_%d" % k), phones2int))
+				elif binary_ctx:
+					helpers.start("hmms", ctx_cmd + ["--binary=true", "--skip-disambig=true", fphones, ftree], load_kaldi_hmms_binary)
+				else:
+					helpers.start("hmms", ctx_cmd + [fphones, ftree], lambda out: load_kaldi_hmms(lines(out, "context_lines"), phones2int))
+
+			if trans is None and not binary_mdl:
+				# print all transitions
+				helpers.start("trans", ["./" + print_transitions_bin, fmdl], lambda out: load_kaldi_transitions(lines(out, "transition_lines")))
+				if GMM:
+					helpers.start("gmms", [gmm_copy_bin, "--binary=false", fmdl, "-"], lambda out: load_kaldi_gmms(lines(out, "gmm_lines")))
+			elif trans is None:
+				trans, gmms = load_kaldi_model(fmdl, with_gmms=GMM)
+
+			if hmms is None and tree_ctx:
+				# equivalence classes of contexts from the tree, while the helpers run
+				tree_groups = tree_hmms(load_kaldi_tree(ftree), int2phones, silphones=[int(x) for x in silphones.split(",") if x],
+					sil_pdf_classes=sil_pdf_classes)
+		except:
+			helpers.kill()
+			raise
+
+		loaded = helpers.wait()
+		if tree_groups is not None:
+			loaded["hmms"] = tree_groups
+		elif ctx_shards > 1 and hmms is None:
+			shards = [loaded.pop("hmms_%d" % k) for k in range(ctx_shards)]
+			loaded["hmms"] = load_kaldi_hmms_shards(shards, int2phones=None if binary_ctx else int2phones)
+			stage.counts["context_shards"] = ctx_shards
+			if profiler.enabled and not binary_ctx:
+				counts["context_lines"] = sum(counts.pop("context_lines_%d" % k, 0) for k in range(ctx_shards))
+		if "hmms" in loaded:
+			hmms = loaded["hmms"]
+		if "trans" in loaded:
+			trans = loaded["trans"]
+			gmms = loaded.get("gmms")
+
+		stage.times.update(helpers.elapsed)
+		stage.counts.update(counts)
+		stage.counts.update(transitions=len(trans), physical_hmms=len(hmms), logical_hmms=hmms.num_logical)
+		if gmms is not None:
+			stage.counts.update(gmm_states=len(gmms["states"]), gmm_mixtures=int(gmms["states"].counts.sum()))
+	memory.check("load_model")
+
+	if cache is not None:
+		with profiler.stage("cache_store"):
+			if "hmms" in loaded:
+				cache.store_hmms(ctx_key, hmms, sources=[cache.digest(fphones), cache.digest(ftree)])
+			if cached is None:
+				cache.store_model(mdl_key, trans, gmms)
+
+	return {"phones2int": phones2int, "int2phones": int2phones, "hmms": hmms, "trans": trans, "gmms": gmms}
+
+
+class GmmStream(object):
+	"""
+	GMM states of model read one by one while they are written, only the current state is
+	in memory. Text models are read from gmm-copy, binary ones from the mapped file.
+	"""
+
+	def __init__(self, fmdl, read_text=False, min_weight=0.0, max_mixtures=0):
+		"""
+		With read_text, text model fmdl (as gmm-copy --binary=false writes it) is parsed without gmm-copy.
+		Mixtures are pruned by min_weight and max_mixtures (kaldi_mdl.prune_mixtures), sizes then gets
+		numbers of mixtures of every state before and after pruning.
+		"""
+		self.helpers = HelperPipeline()
+		self.sizes = []
+		if is_kaldi_binary(fmdl):
+			states = iter_kaldi_model_gmms(fmdl)
+		elif read_text:
+			states = iter_kaldi_gmms(fmdl)
+		else:
+			states = iter_kaldi_gmms(self.helpers.open("gmms", [gmm_copy_bin, "--binary=false", fmdl, "-"]))
+		if min_weight > 0 or max_mixtures > 0:
+			states = iter_pruned_gmms(states, min_weight=min_weight, max_mixtures=max_mixtures, sizes=self.sizes)
+		try:
+			first = next(states, None)
+		except:
+			self.helpers.kill()
+			raise
+		if first is None:
+			self.helpers.kill()
+			raise ValueError("No GMMs in %s" % fmdl)
+		self.vecSize = first[0]
+		self.states = itertools.chain([first], states)
+
+	def __iter__(self):
+		"""Tuples (dim, weights, gconsts, means_invvars, inv_vars) of all states in pdf order"""
+		return self.states
+
+	def close(self):
+		"""Wait for gmm-copy to finish, raises if it failed"""
+		self.helpers.wait()
+
+	def kill(self):
+		self.helpers.kill()
+
+
+def transition_matrices(hmms, trans, int2phones, counts=None):
+	"""
+	Transition matrix of every physical HMM, with pdfs of all its states. Matrices of all
+	HMMs of one length are gathered from TransitionTable at once. Transitions not found
+	are reported together (and counted in counts, if given), their probability is 0.
+	"""
+	mats = [None] * len(hmms)
+	lengths = np.array([len(hmm) for hmm in hmms.pdfs])
+	phones = hmms.contexts[hmms.members[hmms.offsets[:-1]], 1]
+	missing = []
+	for length in np.unique(lengths).tolist():
+		sel = np.flatnonzero(lengths == length)
+		pdfs = np.array([hmms.pdfs[h] for h in sel.tolist()])
+		states = np.arange(length)
+
+		# probs[k, i, b]: transition b (0 self-loop, 1 forward) of state i of HMM sel[k]
+		probs, found = trans.lookup(pdfs[:, :, None], states[None, :, None], np.arange(2)[None, None, :])
+		batch = np.zeros((len(sel), length + 2, length + 2))
+		batch[:, 0, 1] = 1.
+		batch[:, states + 1, states + 1] = probs[:, :, 0]
+		batch[:, states + 1, states + 2] = probs[:, :, 1]
+		for k, h in enumerate(sel.tolist()):
+			mats[h] = batch[k]
+
+		k, i, b = np.nonzero(~found)
+		if len(k):
+			missing.append(np.column_stack([pdfs[k, i], phones[sel[k]], i, b]))
+	states = [state for hmm in hmms.pdfs for state in hmm]
+
+	missing = np.concatenate(missing) if missing else np.zeros((0, 4), dtype=np.int64)
+	disambig = np.array(["#" in int2phones.get(ph, "") for ph in missing[:, 1].tolist()], dtype=bool)
+	report_missing("INFO", missing[disambig])
+	report_missing("ERROR", missing[~disambig])
+	if len(missing) > len(missing[disambig]):
+		print "This could be bad error, probably some mistake in conversion?"
+	if counts is not None:
+		counts["missing_transitions"] = len(missing)
+	return mats, states
+
+
+def report_missing(level, missing, examples=10):
+	"""Print one report of missing transitions, rows of (pdf, phone, hmm_state, transition_index)"""
+	if not len(missing):
+		return
+	rows = ", ".join(["pdf %d with phone %d at %d %d" % tuple(row) for row in missing[:examples].tolist()])
+	more = ", ..." if len(missing) > examples else ""
+	print "%s: Not found %d transitions: %s%s" % (level, len(missing), rows, more)
+
+
+def report_pruning(before, after, freport=None, counts=None):
+	"""
+	Print summary of pruned mixtures, before and after are numbers of mixtures of every state
+	(pdf); freport gets line "pdf before after" of every state with removed mixtures
+	"""
+	before = np.asarray(before, dtype=np.int64)
+	after = np.asarray(after, dtype=np.int64)
+	removed = before - after
+	pruned = np.flatnonzero(removed)
+	print >> sys.stderr, "INFO: %d of %d mixtures pruned in %d of %d states (at most %d, on average %.2f per state)" % (
+		removed.sum(), before.sum(), len(pruned), len(before), removed.max() if len(removed) else 0,
+		removed.mean() if len(removed) else 0.0)
+	if freport is not None:
+		with open(freport, "w") as fw:
+			for pdf in pruned.tolist():
+				print >> fw, pdf, before[pdf], after[pdf]
+	if counts is not None:
+		counts["pruned_mixtures"] = int(removed.sum())
+		counts["pruned_states"] = len(pruned)
+
+
+def shared_transitions(trans_mats, tolerance=0.0):
+	"""
+	Index of the HMM whose ~t macro every HMM uses: the first HMM with the same transition
+	matrix (equal after rounding to multiples of tolerance, if tolerance > 0)
+	"""
+	owner = np.arange(len(trans_mats))
+	sizes = np.array([len(m) for m in trans_mats])
+	for size in np.unique(sizes).tolist():
+		sel = np.flatnonzero(sizes == size)
+		mats = np.array([trans_mats[h].ravel() for h in sel.tolist()])
+		if tolerance > 0:
+			mats = np.round(mats / tolerance)
+		_, first, inverse = np.unique(mats, axis=0, return_index=True, return_inverse=True)
+		owner[sel] = sel[first[inverse.ravel()]]
+	return owner
+
+
+def write_model(model, targets, vecSize=39, GMM=False, binary=False, jobs=1, share_transitions=False, trans_tolerance=0.0,
+                profiler=NO_PROFILER, memory=NO_LIMIT, index=False, compress=False, tables=False, share_vectors=False):
+	"""
+	Write MMF and tiedlist of every target (naming, foutname, ftiedname), with index also
+	<foutname>.idx, with tables <foutname>.tables, with compress both gzip compressed (in jobs threads)
+	"""
+	state_ids, macros = write_mmf(model, targets, vecSize=vecSize, GMM=GMM, binary=binary, jobs=jobs, share_transitions=share_transitions,
+		trans_tolerance=trans_tolerance, profiler=profiler, memory=memory, index=index, compress=compress, share_vectors=share_vectors)
+	tied = [[] if index else None for _ in targets]
+	with profiler.stage("write_tiedlist") as stage:
+		stage.counts["tiedlist_entries"] = 0  # of all targets
+		for (naming, _, ftiedname), pairs in zip(targets, tied):
+			stage.counts["tiedlist_entries"] += write_tiedlist(ftiedname, model["hmms"], model["int2phones"], naming, pairs=pairs,
+				compress=compress, jobs=jobs)
+	if index:
+		with profiler.stage("write_index") as stage:
+			stage.counts["indexed_macros"] = 0  # of all targets
+			for (_, foutname, _), entries, pairs in zip(targets, macros, tied):
+				write_index(foutname + ".idx", entries, pairs)
+				stage.counts["indexed_macros"] += len(entries)
+	if tables:
+		with profiler.stage("write_tables") as stage:
+			arrays = lookup_tables(model["trans"], model["hmms"], state_ids)
+			for _, foutname, _ in targets:
+				write_tables(foutname + ".tables", arrays)
+			stage.counts["transition_ids"] = len(arrays["tid2pdf"]) - 1
+
+
+def write_mmf(model, targets, vecSize=39, GMM=False, binary=False, jobs=1, share_transitions=False, trans_tolerance=0.0,
+              profiler=NO_PROFILER, memory=NO_LIMIT, index=False, compress=False, share_vectors=False):
+	"""
+	Write MMF of every target (naming, foutname, ftiedname). With share_transitions HMMs
+	with the same transition matrix (within trans_tolerance) share one ~t macro. GMMs of
+	model may be a GmmStream, its states are then written as they are read (serially).
+	With share_vectors repeated means, variances and mixtures are written once, as ~u, ~v
+	and ~m macros (not with GmmStream, the macros must precede the states).
+	Returns pdfs of the ~s macros in their order and, with index, list of (kind, name, offset,
+	length) of all macros of every target. With compress the MMFs are gzip compressed.
+	"""
+	hmms = model["hmms"]
+	gmms = model["gmms"]
+	int2phones = model["int2phones"]
+	namings = [naming for naming, _, _ in targets]
+
+	stream = isinstance(gmms, GmmStream)
+	if GMM:
+		vecSize = gmms.vecSize if stream else gmms["vecSize"]
+	if share_vectors and GMM and stream:
+		raise ValueError("Shared vectors need all GMMs, they cannot be streamed")
+
+	# Write HTK models
+	outputs = [MmfOutput(open_output(foutname, binary=binary, compress=compress, jobs=jobs), index=index)
+		for _, foutname, _ in targets]
+	try:
+		for fw in outputs:
+			write_header(fw, vecSize, binary=binary)
+
+		with profiler.stage("transition_matrices") as stage:
+			trans_mats, states = transition_matrices(hmms, model["trans"], int2phones, counts=stage.counts)
+			trans_names = ["_".join([str(x) for x in hmm]) for hmm in hmms.pdfs]
+			if share_transitions:
+				owner = shared_transitions(trans_mats, tolerance=trans_tolerance).tolist()
+				trans_names = [trans_names[o] for o in owner]
+				num_shared = len(owner) - len(set(owner))
+				stage.counts["shared_transition_macros"] = num_shared
+				print >> sys.stderr, "INFO: %d of %d transition macros shared" % (num_shared, len(owner))
+			else:
+				owner = range(len(trans_mats))
+
+		# Write transitions, the same for all targets
+		with profiler.stage("write_transitions") as stage:
+			macros = 0
+			for h, trans_mat in enumerate(trans_mats):
+				if owner[h] != h:
+					continue
+				text = format_transitions(trans_names[h], trans_mat, binary=binary)
+				for fw in outputs:
+					fw.macro("t", "T_" + trans_names[h], text)
+				macros += 1
+			stage.counts["transition_macros"] = macros
+		memory.check("write_transitions")
+
+		# GMMs and HMMs are formatted in chunks, in parallel with jobs > 1
+		shared = None  # SharedVectors with share_vectors, set below
+		if GMM and stream:
+			# Write GMMs as they come
+			state_ids = None
+		elif GMM:
+			# Write GMMs
+			state_ids = gmms["states"].keys()
+			offsets, counts = gmms["states"].offsets, gmms["states"].counts
+
+			def format_body(i):
+				st = gmms["states"][state_ids[i]]
+				means, variances, gconsts = gmm_state_arrays(st["MeansInvVars"], st["InvVars"], vecSize)
+				if shared is not None:
+					rows = np.arange(offsets[state_ids[i]], offsets[state_ids[i]] + counts[state_ids[i]])
+					return shared.format_state_body(rows, st["Weights"], means, variances, gconsts)
+				return format_state_body(st["Weights"], means, variances, gconsts, binary=binary)
+		else:
+			# Write fake GMMs, state i has mixture i
+			state_ids = list(set(states))
+
+			def format_body(i):
+				if shared is not None:
+					return shared.format_state_body([i], np.ones(1), np.zeros((1, vecSize)), np.ones((1, vecSize)), np.ones(1))
+				return format_fake_state_body(vecSize, binary=binary)
+
+		if share_vectors:
+			with profiler.stage("write_shared_vectors") as stage:
+				if GMM:
+					st = gmms["states"]
+					shared = SharedVectors(*gmm_state_arrays(st.means_invvars, st.inv_vars, vecSize), binary=binary)
+				else:
+					n = len(state_ids)
+					shared = SharedVectors(np.zeros((n, vecSize)), np.ones((n, vecSize)), np.ones(n), binary=binary)
+				for kind, name, text in shared.definitions:
+					for fw in outputs:
+						fw.macro(kind, name, text)
+				for kind in "uvm":
+					stage.counts["%s_macros" % kind] = sum(1 for d in shared.definitions if d[0] == kind)
+				stage.counts["bytes_saved"] = shared.saved
+				print >> sys.stderr, "INFO: %d mean, %d variance and %d mixture macros shared, %d bytes saved" % (
+					stage.counts["u_macros"], stage.counts["v_macros"], stage.counts["m_macros"], shared.saved)
+			memory.check("write_shared_vectors")
+
+		def format_states(start, end):
+			ids = state_ids[start:end]
+			bodies = [format_body(i) for i in range(start, end)]
+			return [macro_texts([state_header(naming.state_name(s)) + body for s, body in zip(ids, bodies)]) for naming in namings]
+
+		def write_states(start, end, chunk):
+			for naming, fw, (text, lengths) in zip(namings, outputs, chunk):
+				fw.macros("s", [naming.state_name(s) for s in state_ids[start:end]], text, lengths)
+
+		with profiler.stage("write_states") as stage:
+			if GMM and stream:
+				num_states, mixtures = write_stream_states(outputs, namings, gmms, binary=binary, memory=memory)
+				state_ids = range(num_states)
+				stage.counts["state_macros"] = num_states
+				stage.counts["mixtures"] = mixtures
+			else:
+				write_chunks(outputs, format_states, len(state_ids), jobs=jobs, write=write_states)
+				stage.counts["state_macros"] = len(state_ids)
+				stage.counts["mixtures"] = int(gmms["states"].counts.sum()) if GMM else len(state_ids)
+		memory.check("write_states")
+
+		# Write HMMs
+		def format_hmms(start, end):
+			chunks = []
+			for naming in namings:
+				chunk = []
+				for h in range(start, end):
+					hmm = hmms.pdfs[h]
+					hmm_name = naming.hmm_name(hmms.name(h, int2phones))
+					chunk.append(format_hmm(hmm_name, [naming.state_name(s) for s in hmm], trans_names[h], binary=binary))
+				chunks.append(macro_texts(chunk))
+			return chunks
+
+		def write_hmms(start, end, chunk):
+			for naming, fw, (text, lengths) in zip(namings, outputs, chunk):
+				fw.macros("h", [naming.hmm_name(hmms.name(h, int2phones)) for h in range(start, end)], text, lengths)
+
+		with profiler.stage("write_hmms") as stage:
+			write_chunks(outputs, format_hmms, len(hmms), jobs=jobs, write=write_hmms)
+
+			for fw in outputs:
+				fw.flush()
+				os.fsync(fw)
+			stage.counts["hmm_macros"] = len(hmms)
+		memory.check("write_hmms")
+	finally:
+		for fw in outputs:
+			fw.close()
+	return state_ids, [fw.entries for fw in outputs] if index else None
+
+
+def macro_texts(texts):
+	"""Joined texts of consecutive macros and their lengths"""
+	return "".join(texts), [len(text) for text in texts]
+
+
+def write_stream_states(outputs, namings, gmms, binary=False, memory=NO_LIMIT):
+	"""Write ~s macros of all states of GmmStream to outputs, returns numbers of states and mixtures"""
+	num_states = mixtures = 0
+	for s, (_, weights, _, means_invvars, inv_vars) in enumerate(gmms):
+		means, variances, gconsts = gmm_state_arrays(means_invvars, inv_vars, gmms.vecSize)
+		body = format_state_body(weights, means, variances, gconsts, binary=binary)
+		for naming, fw in zip(namings, outputs):
+			name = naming.state_name(s)
+			fw.macro("s", name, state_header(name) + body)
+		num_states += 1
+		mixtures += len(weights)
+		if num_states % MEMORY_CHECK_INTERVAL == 0:
+			memory.check("write_states")
+	gmms.close()
+	return num_states, mixtures
+
+
+def write_tiedlist(ftiedname, hmms, int2phones, naming, pairs=None, compress=False, jobs=1):
+	"""
+	Write HTK tiedlist: physical HMM names and logical name -> physical name lines, returns
+	number of lines. List pairs gets (logical, physical) names of all HMMs. With compress
+	the tiedlist is gzip compressed in jobs threads.
+	"""
+	written = set()  # just in case, we are writing something second time
+	entries = 0
+	with open_output(ftiedname, compress=compress, jobs=jobs) as fw:
+		for h in range(len(hmms)):
+			names = [naming.hmm_name(ctx) for ctx in hmms.names(h, int2phones)]
+			if pairs is not None:
+				pairs.extend([(name, names[0]) for name in names])
+			if len(names) > 1:
+				print >> fw, names[0]
+				entries += 1
+				for name in names[1:]:
+					if (name, names[0]) not in written and name != names[0]:
+						print >> fw, name, names[0]
+						written.add((name, names[0]))
+						entries += 1
+			else:
+				print >> fw, names[0]
+				entries += 1
+	return entries
+
+
+def convert_targets(fmdl, fphones, ftree, targets, vecSize=39, silphones="", GMM=False, sil_pdf_classes=3, binary=False, jobs=1,
+                    binary_ctx=False, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, share_transitions=False, trans_tolerance=0.0,
+                    profile=None, cprofile=None, trace_malloc=False, stream=False, max_memory=None, index=False,
+                    compress=False, tables=False, share_vectors=False, min_weight=0.0, max_mixtures=0, prune_report=None,
+                    ctx_shards=1, ctx_threads=1, tree_ctx=False):
+	"""
+	Convert Kaldi model once into all targets, list of (naming, foutname, ftiedname).
+	With profile (file name, "-" for stderr) writes JSON report of all stages, cprofile is
+	file for cProfile stats of the whole run. With stream the GMMs are written as they
+	are parsed, max_memory (bytes) stops the conversion with MemoryError when exceeded.
+	With index every MMF gets <foutname>.idx, offsets of its macros and its tiedlist (htk_index).
+	With compress all MMFs and tiedlists are written gzip compressed. With tables every MMF gets
+	<foutname>.tables, int32 lookup tables of transition-ids, pdfs, states and HMMs (kaldi_tables).
+	With share_vectors repeated vectors and mixtures become ~u, ~v and ~m macros.
+	GMM mixtures lighter than min_weight are pruned and at most max_mixtures heaviest kept
+	(0 for all), the weights renormalized; prune_report gets removed mixtures of every state.
+	Contexts are computed by ctx_shards context-to-pdf processes of ctx_threads threads each,
+	or with tree_ctx from the tree by kaldi_tree.
+	"""
+	if index and compress:
+		raise ValueError("Index of macros needs uncompressed MMF")
+	if share_vectors and stream and GMM:
+		raise ValueError("Shared vectors need all GMMs, they cannot be streamed")
+
+	profiler = NO_PROFILER
+	if profile or cprofile:
+		profiler = Profiler(cprofile=cprofile, trace_malloc=trace_malloc)
+		profiler.start()
+
+	memory = MemoryLimit(max_memory)
+
+	# gmm-copy of the stream starts with the other helpers, it waits until its states are read
+	gmm_stream = GmmStream(fmdl, min_weight=min_weight, max_mixtures=max_mixtures) if stream and GMM else None
+	pruning = GMM and (min_weight > 0 or max_mixtures > 0)
+	try:
+		model = load_model(fmdl, fphones, ftree, silphones=silphones, GMM=GMM and gmm_stream is None,
+			sil_pdf_classes=sil_pdf_classes, binary_ctx=binary_ctx, cache_dir=cache_dir, cache_size=cache_size,
+			profiler=profiler, memory=memory, ctx_shards=ctx_shards, ctx_threads=ctx_threads, tree_ctx=tree_ctx)
+		if gmm_stream is not None:
+			model["gmms"] = gmm_stream
+		elif pruning:
+			with profiler.stage("prune_mixtures") as stage:
+				states = model["gmms"]["states"]
+				pruned = prune_gmm_set(states, min_weight=min_weight, max_mixtures=max_mixtures)
+				model["gmms"] = dict(model["gmms"], states=pruned)
+				report_pruning(states.counts, pruned.counts, freport=prune_report, counts=stage.counts)
+		write_model(model, targets, vecSize=vecSize, GMM=GMM, binary=binary, jobs=jobs, share_transitions=share_transitions,
+			trans_tolerance=trans_tolerance, profiler=profiler, memory=memory, index=index, compress=compress, tables=tables,
+			share_vectors=share_vectors)
+		if gmm_stream is not None and pruning:
+			with profiler.stage("prune_mixtures") as stage:
+				before, after = zip(*gmm_stream.sizes) if gmm_stream.sizes else ((), ())
+				report_pruning(before, after, freport=prune_report, counts=stage.counts)
+	finally:
+		if gmm_stream is not None:
+			gmm_stream.kill()
+
+	if profiler.enabled:
+		profiler.stop()
+		if profile:
+			profiler.write(profile)
+
+
+def parse_targets(specs, nse=AP_NSE):
+	"""Targets from --target PROFILE MODEL TIEDLIST arguments"""
+	return [(make_naming(profile, nse=nse), foutname, ftiedname) for profile, foutname, ftiedname in specs or []]
+
+
+def add_options(parser):
+	"""Add options of the conversion (common to kaldi2HTK.py and kaldi2AP.py) to argparse parser"""
+	parser.add_argument('--binary', action='store_true',
+	                    help='Write HTK model in binary MMF format')
+	parser.add_argument('--jobs', default=1, type=int,
+	                    help='Number of processes formatting the HTK model')
+	parser.add_argument('--binary-ctx', action='store_true',
+	                    help='Read integer-coded contexts from context-to-pdf --binary')
+	parser.add_argument('--cache-dir', default=None, type=str,
+	                    help='Directory caching parsed models and contexts between runs')
+	parser.add_argument('--cache-size', default=DEFAULT_CACHE_SIZE >> 20, type=int,
+	                    help='Size limit of the cache in MB')
+	parser.add_argument('--target', nargs=3, action='append', metavar=('PROFILE', 'MODEL', 'TIEDLIST'),
+	                    help='Write also MODEL and TIEDLIST with naming PROFILE (htk or ap) from the same conversion')
+	parser.add_argument('--share-transitions', action='store_true',
+	                    help='Write one ~t macro for all HMMs with the same transition matrix')
+	parser.add_argument('--trans-tolerance', default=0.0, type=float,
+	                    help='With --share-transitions, matrices equal after rounding to multiples of this are shared')
+	parser.add_argument('--profile', default=None, type=str,
+	                    help='Write JSON report of time, memory and item counts of every stage to file ("-" for stderr)')
+	parser.add_argument('--cprofile', default=None, type=str,
+	                    help='Write cProfile stats of the whole conversion to file')
+	parser.add_argument('--tracemalloc', action='store_true',
+	                    help='List largest allocations of every stage in the profile (needs tracemalloc module)')
+	parser.add_argument('--stream', action='store_true',
+	                    help='Write GMM states as they are parsed, without loading the whole model into memory')
+	parser.add_argument('--max-memory', default=None, type=int,
+	                    help='Stop the conversion when its resident memory grows over this many MB')
+	parser.add_argument('--index', action='store_true',
+	                    help='Write also <model>.idx, offsets of all macros and the tiedlist for random access (htk_index.py)')
+	parser.add_argument('--gzip', action='store_true',
+	                    help='Write model and tiedlist gzip compressed, in blocks compressed by --jobs threads')
+	parser.add_argument('--tables', action='store_true',
+	                    help='Write also <model>.tables, int32 lookup tables of transition-ids, pdfs, states and HMMs')
+	parser.add_argument('--share-vectors', action='store_true',
+	                    help='Write repeated mean and variance vectors and mixtures once, as ~u, ~v and ~m macros')
+	parser.add_argument('--min-weight', default=0.0, type=float,
+	                    help='Prune mixtures of smaller weight (the heaviest one of every state is kept), renormalize the rest')
+	parser.add_argument('--max-mixtures', default=0, type=int,
+	                    help='Keep at most this many heaviest mixtures of every state, renormalized (0 keeps all)')
+	parser.add_argument('--prune-report', default=None, type=str,
+	                    help='Write "pdf before after" line (mixtures before and after pruning) of every pruned state to file')
+	parser.add_argument('--ctx-shards', default=1, type=int,
+	                    help='Number of context-to-pdf processes computing shards of the contexts at once')
+	parser.add_argument('--ctx-threads', default=1, type=int,
+	                    help='Number of threads of every context-to-pdf process')
+	parser.add_argument('--tree-ctx', action='store_true',
+	                    help='Resolve contexts from the tree by kaldi_tree.py, without context-to-pdf')
+
+
+def options_of(args):
+	"""Keyword arguments of convert_targets from options added by add_options"""
+	return dict(binary=args.binary, jobs=args.jobs, binary_ctx=args.binary_ctx, cache_dir=args.cache_dir,
+		cache_size=args.cache_size << 20, share_transitions=args.share_transitions, trans_tolerance=args.trans_tolerance,
+		profile=args.profile, cprofile=args.cprofile, trace_malloc=args.tracemalloc, stream=args.stream,
+		max_memory=args.max_memory << 20 if args.max_memory else None, index=args.index, compress=args.gzip, tables=args.tables,
+		share_vectors=args.share_vectors, min_weight=args.min_weight, max_mixtures=args.max_mixtures,
+		prune_report=args.prune_report, ctx_shards=args.ctx_shards, ctx_threads=args.ctx_threads, tree_ctx=args.tree_ctx)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Loaders of context-to-pdf output and grouping of contexts into physical HMMs.
+
+Contexts are kept as int32 records: left phone, phone, right phone, pdf-class, pdf-id
+(left and right are -1 for monophones), which is also the format written by
+context-to-pdf --binary. Phone names from the phones table are used only when
+the HTK names are written.
+
+Contexts with the same pdf sequence share one physical HMM; the grouping is done
+for all contexts at once with np.unique over the pdf sequences of every length.
+"""
+
+from itertools import imap, islice
+
+import numpy as np
+
+from kaldi_mdl import iter_lines
+
+# int32 numbers in one record of context-to-pdf --binary
+RECORD_WIDTH = 5
+
+# Lines of text output converted at once
+TEXT_BLOCK_LINES = 1 << 20
+
+
+class HmmGroups(object):
+	"""
+	Physical HMMs and their logical contexts.
+
+	pdfs[h] is the pdf sequence (tuple) of physical HMM h, contexts is (N, 3) int32 array
+	of all logical contexts and members[offsets[h]:offsets[h + 1]] are the indices of the
+	contexts of HMM h, in the order in which context-to-pdf wrote them.
+	"""
+	__slots__ = ("pdfs", "contexts", "members", "offsets")
+
+	def __init__(self, pdfs, contexts, members, offsets):
+		self.pdfs = pdfs
+		self.contexts = contexts
+		self.members = members
+		self.offsets = offsets
+
+	def __len__(self):
+		return len(self.pdfs)
+
+	def logical(self, h):
+		"""Indices of contexts of physical HMM h"""
+		return self.members[self.offsets[h]:self.offsets[h + 1]]
+
+	def phone(self, h):
+		"""Central phone id of physical HMM h"""
+		return int(self.contexts[self.members[self.offsets[h]], 1])
+
+	def name(self, h, int2phones):
+		"""Context naming physical HMM h (the first one) as tuple of phone names"""
+		return context_names(self.contexts[self.members[self.offsets[h]]].tolist(), int2phones)
+
+	def names(self, h, int2phones):
+		"""All contexts of physical HMM h as tuples of phone names"""
+		return [context_names(ctx, int2phones) for ctx in self.contexts[self.logical(h)].tolist()]
+
+	@property
+	def num_logical(self):
+		return len(self.contexts)
+
+
+def read_context_records(source):
+	"""Records as (N, 5) int32 array, from file name or binary stream (e.g. helper pipe)"""
+	if isinstance(source, basestring):
+		data = np.fromfile(source, dtype=np.int32)
+	else:
+		data = np.frombuffer(source.read(), dtype=np.int32)
+	if len(data) % RECORD_WIDTH:
+		raise ValueError("Context records truncated.")
+	return data.reshape(-1, RECORD_WIDTH)
+
+
+def skip_mask(int2phones):
+	"""Phone ids we do not need in triphones: disambig phones and <eps>"""
+	mask = np.zeros(max(int2phones) + 1, dtype=bool)
+	for i, ph in int2phones.items():
+		mask[i] = "#" in ph or "<eps>" in ph
+	return mask
+
+
+def context_names(ctx, int2phones):
+	"""Context of phone ids to context of phone names"""
+	if ctx[0] < 0:
+		return (int2phones[ctx[1]],)
+	return (int2phones[ctx[0]], int2phones[ctx[1]], int2phones[ctx[2]])
+
+
+def read_context_text(source, phones2int):
+	"""Records as (N, 5) int32 array from text output of context-to-pdf (file name or iterable of lines)"""
+	lines = iter_lines(source)
+	blocks = []
+	while True:
+		block = list(islice(lines, TEXT_BLOCK_LINES))
+		if not block:
+			break
+		width = len(block[0].split())
+		if width not in (3, 5):
+			raise ValueError("Data not understood.")
+		tokens = " ".join(block).split()
+		if len(tokens) != width * len(block):
+			raise ValueError("Data not understood.")
+
+		# column by column: phone names through the table, numbers parsed at once
+		rec = np.empty((len(block), RECORD_WIDTH), dtype=np.int32)
+		names = range(3) if width == 5 else [1]
+		for k, col in enumerate(names):
+			rec[:, col] = np.fromiter(imap(phones2int.__getitem__, tokens[k::width]), dtype=np.int32, count=len(block))
+		if width == 3:
+			rec[:, 0] = -1
+			rec[:, 2] = -1
+		for k in (3, 4):
+			rec[:, k] = np.fromstring(" ".join(tokens[width - 5 + k::width]), dtype=np.int32, sep=" ")
+		blocks.append(rec)
+	if not blocks:
+		return np.zeros((0, RECORD_WIDTH), dtype=np.int32)
+	return np.concatenate(blocks)
+
+
+def skip_contexts(rec, int2phones):
+	"""Drop triphones with disambig phones or <eps>"""
+	skip = skip_mask(int2phones)
+	triphone = rec[:, 0] >= 0
+	return rec[~(triphone & (skip[rec[:, 0]] | skip[rec[:, 1]] | skip[rec[:, 2]]))]
+
+
+def group_hmms(rec):
+	"""Group context records into physical HMMs (one vectorized pass per HMM length)"""
+	# every HMM starts with pdf-class 0
+	starts = np.flatnonzero(rec[:, 3] == 0)
+	lengths = np.diff(np.append(starts, len(rec)))
+	# context of the last record of every HMM, as the loop over context-to-pdf lines did
+	contexts = rec[starts + lengths - 1, :3]
+
+	pdfs = []
+	hmm_of = np.empty(len(starts), dtype=np.int64)
+	for length in np.unique(lengths).tolist():
+		sel = np.flatnonzero(lengths == length)
+		seqs = rec[starts[sel][:, None] + np.arange(length), 4]
+		uniq, inverse = np.unique(seqs, axis=0, return_inverse=True)
+		hmm_of[sel] = len(pdfs) + inverse.ravel()
+		pdfs.extend([tuple(row) for row in uniq.tolist()])
+	return hmm_groups(pdfs, contexts, hmm_of)
+
+
+def hmm_groups(pdfs, contexts, hmm_of):
+	"""HmmGroups of physical HMMs pdfs, contexts (N, 3) and the physical HMM hmm_of[i] of context i"""
+	# stable sort keeps the contexts of every HMM in input order
+	members = np.argsort(hmm_of, kind="mergesort")
+	offsets = np.zeros(len(pdfs) + 1, dtype=np.int64)
+	np.cumsum(np.bincount(hmm_of, minlength=len(pdfs)), out=offsets[1:])
+	return HmmGroups(pdfs, contexts, members, offsets)
+
+
+def load_kaldi_hmms(fctx, phones2int):
+	"""Load HMMs from text output of context to pdf binary (file name or iterable of lines)"""
+	int2phones = dict((i, ph) for ph, i in phones2int.items())
+	return group_hmms(skip_contexts(read_context_text(fctx, phones2int), int2phones))
+
+
+def load_kaldi_hmms_binary(fctx, int2phones=None):
+	"""
+	Load HMMs from context-to-pdf --binary. Give int2phones to skip disambig and <eps>
+	triphones here, when context-to-pdf was not run with --skip-disambig.
+	"""
+	rec = read_context_records(fctx)
+	if int2phones is not None:
+		rec = skip_contexts(rec, int2phones)
+	return group_hmms(rec)
+
+
+def load_kaldi_hmms_shards(shards, int2phones=None):
+	"""
+	Load HMMs from records of all shards of context-to-pdf --shard=k/n, list of (N, 5) arrays
+	in shard order. Shards split the contexts at HMM boundaries, so their concatenation is the
+	output of one run and the HMMs are the same. Give int2phones to skip disambig and <eps> triphones.
+	"""
+	rec = np.concatenate(shards) if shards else np.zeros((0, RECORD_WIDTH), dtype=np.int32)
+	if int2phones is not None:
+		rec = skip_contexts(rec, int2phones)
+	return group_hmms(rec)
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Readers of Kaldi GMM models (TransitionModel + AmDiagGmm), as read by gmm-copy.
+
+Binary models are memory mapped and parsed without any text dump of the model, the
+transition table is the same one print-transitions writes out. Text models
+(gmm-copy --binary=false) are parsed by load_kaldi_gmms. Both return the GMMs in
+a compact DiagGmmSet and transitions in a dense TransitionTable. For conversion with
+bounded memory, iter_kaldi_gmms and iter_kaldi_model_gmms yield the GMM states one by one.
+"""
+
+import mmap
+import re
+import struct
+import sys
+
+import numpy as np
+
+
+class KaldiBinaryReader(object):
+	"""Sequential reader of Kaldi binary objects from memory mapped file"""
+
+	def __init__(self, fname):
+		with open(fname, "rb") as f:
+			self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.buf[:2] != b"\0B":
+			raise ValueError("%s is not a binary Kaldi file" % fname)
+		self.pos = 2
+
+	def token(self):
+		"""Read token, tokens are ended by single space"""
+		while self.buf[self.pos:self.pos + 1] in (b" ", b"\n"):
+			self.pos += 1
+		end = self.buf.find(b" ", self.pos)
+		if end < 0:
+			raise ValueError("Unexpected end of file at %d" % self.pos)
+		tok = self.buf[self.pos:end].decode("ascii")
+		self.pos = end + 1
+		return tok
+
+	def peek_token(self):
+		pos = self.pos
+		tok = self.token()
+		self.pos = pos
+		return tok
+
+	def expect(self, expected):
+		tok = self.token()
+		if tok != expected:
+			raise ValueError("Expected token %s, got %s at %d" % (expected, tok, self.pos))
+
+	def int32(self):
+		size = struct.unpack_from("b", self.buf, self.pos)[0]
+		if size != 4:
+			raise ValueError("Expected int32 at %d, got size %d" % (self.pos, size))
+		value = struct.unpack_from("<i", self.buf, self.pos + 1)[0]
+		self.pos += 5
+		return value
+
+	def uint32(self):
+		"""Unsigned 32-bit integer, its size byte is -4"""
+		size = struct.unpack_from("b", self.buf, self.pos)[0]
+		if size != -4:
+			raise ValueError("Expected uint32 at %d, got size %d" % (self.pos, size))
+		value = struct.unpack_from("<I", self.buf, self.pos + 1)[0]
+		self.pos += 5
+		return value
+
+	def float(self):
+		size = struct.unpack_from("b", self.buf, self.pos)[0]
+		if size == 4:
+			value = struct.unpack_from("<f", self.buf, self.pos + 1)[0]
+		elif size == 8:
+			value = struct.unpack_from("<d", self.buf, self.pos + 1)[0]
+		else:
+			raise ValueError("Expected float at %d, got size %d" % (self.pos, size))
+		self.pos += 1 + size
+		return value
+
+	def int32_vector(self):
+		size = struct.unpack_from("b", self.buf, self.pos)[0]
+		if size != 4:
+			raise ValueError("Expected int32 vector at %d" % self.pos)
+		n = struct.unpack_from("<i", self.buf, self.pos + 1)[0]
+		vec = np.frombuffer(self.buf, dtype="<i4", count=n, offset=self.pos + 5)
+		self.pos += 5 + 4 * n
+		return vec
+
+	def _array(self, count, kind):
+		dtype = {"F": "<f4", "D": "<f8"}[kind]
+		arr = np.frombuffer(self.buf, dtype=dtype, count=count, offset=self.pos)
+		self.pos += arr.nbytes
+		return arr
+
+	def vector(self):
+		tok = self.token()
+		if tok not in ("FV", "DV"):
+			raise ValueError("Expected vector at %d, got %s" % (self.pos, tok))
+		n = self.int32()
+		return self._array(n, tok[0])
+
+	def matrix(self):
+		tok = self.token()
+		if tok not in ("FM", "DM"):
+			raise ValueError("Expected (uncompressed) matrix at %d, got %s" % (self.pos, tok))
+		rows = self.int32()
+		cols = self.int32()
+		return self._array(rows * cols, tok[0]).reshape(rows, cols)
+
+
+class GmmState(object):
+	"""
+	View of one state of DiagGmmSet, accessed as the old dict of state:
+	state["Weights"], state["GConsts"], state["MeansInvVars"], state["InvVars"].
+	All values are numpy views into the set, nothing is copied.
+	"""
+	__slots__ = ("gmms", "begin", "end")
+
+	def __init__(self, gmms, begin, end):
+		self.gmms = gmms
+		self.begin = begin
+		self.end = end
+
+	def __getitem__(self, key):
+		return getattr(self, key)
+
+	def __len__(self):
+		return self.end - self.begin
+
+	@property
+	def Weights(self):
+		return self.gmms.weights[self.begin:self.end]
+
+	@property
+	def GConsts(self):
+		return self.gmms.gconsts[self.begin:self.end]
+
+	@property
+	def MeansInvVars(self):
+		return self.gmms.means_invvars[self.begin:self.end]
+
+	@property
+	def InvVars(self):
+		return self.gmms.inv_vars[self.begin:self.end]
+
+
+class DiagGmmSet(object):
+	"""
+	All Gaussians of the model in contiguous arrays, mixtures of state s are the rows
+	offsets[s]:offsets[s] + counts[s] (states may have different number of mixtures).
+
+	Memory budget for G Gaussians of dimension D in S states is
+	(2 * D + 2) * G * itemsize + 16 * S bytes, e.g. 8k states with 32 mixtures and
+	D = 39 takes 164 MB in float64 and 82 MB in float32 (nested lists of Python
+	floats took about 20 times more).
+
+	Works as the old states dict of load_kaldi_gmms: gmms[s]["MeansInvVars"] etc.
+	"""
+	__slots__ = ("dim", "weights", "gconsts", "means_invvars", "inv_vars", "offsets", "counts")
+
+	def __init__(self, weights, gconsts, means_invvars, inv_vars, counts):
+		self.dim = means_invvars.shape[1]
+		self.weights = weights
+		self.gconsts = gconsts
+		self.means_invvars = means_invvars
+		self.inv_vars = inv_vars
+		self.counts = np.asarray(counts, dtype=np.int64)
+		self.offsets = np.zeros(len(self.counts), dtype=np.int64)
+		np.cumsum(self.counts[:-1], out=self.offsets[1:])
+
+	def __len__(self):
+		return len(self.counts)
+
+	def __iter__(self):
+		return iter(range(len(self.counts)))
+
+	def __contains__(self, s):
+		return 0 <= s < len(self.counts)
+
+	def __getitem__(self, s):
+		if not 0 <= s < len(self.counts):
+			raise KeyError(s)
+		begin = int(self.offsets[s])
+		return GmmState(self, begin, begin + int(self.counts[s]))
+
+	def keys(self):
+		return range(len(self.counts))
+
+	@property
+	def nbytes(self):
+		return sum(a.nbytes for a in (self.weights, self.gconsts, self.means_invvars, self.inv_vars, self.offsets, self.counts))
+
+
+def iter_lines(source):
+	"""Lines of file given by name, or of any iterable of lines (e.g. helper pipe)"""
+	if isinstance(source, basestring):
+		return open(source)
+	return source
+
+
+class TransitionTable(object):
+	"""
+	Transition probabilities in dense array probs[pdf, hmm_state, transition_index],
+	valid marks the entries the model has. Works also as the old dict of load_kaldi_transitions:
+	table[pdf, hmm_state, transition_index] is the probability (KeyError if not valid).
+	tids[tid] are (pdf, phone, hmm_state) of every transition-id, -1 for tid 0.
+	"""
+	__slots__ = ("probs", "valid", "tids")
+
+	def __init__(self, probs, valid, tids=None):
+		self.probs = probs
+		self.valid = valid
+		self.tids = tids
+
+	@classmethod
+	def from_entries(cls, pdfs, hmm_states, trans_idx, probs, tids=None, phones=None):
+		"""Table from arrays of entries, a later entry of the same key wins (as in the dict)"""
+		pdfs, hmm_states, trans_idx = [np.asarray(x, dtype=np.int64) for x in (pdfs, hmm_states, trans_idx)]
+		shape = tuple([int(x.max()) + 1 if len(x) else 1 for x in (pdfs, hmm_states, trans_idx)])
+		table = cls(np.zeros(shape), np.zeros(shape, dtype=bool))
+		table.probs[pdfs, hmm_states, trans_idx] = probs
+		table.valid[pdfs, hmm_states, trans_idx] = True
+		if tids is not None:
+			tids = np.asarray(tids, dtype=np.int64)
+			table.tids = np.full((int(tids.max()) + 1 if len(tids) else 1, 3), -1, dtype=np.int32)
+			table.tids[tids] = np.column_stack([pdfs, phones, hmm_states])
+		return table
+
+	def lookup(self, pdfs, hmm_states, trans_idx):
+		"""Probabilities of (broadcast) arrays of keys and mask of keys found, missing probabilities are 0"""
+		keys = np.broadcast_arrays(*[np.asarray(x, dtype=np.int64) for x in (pdfs, hmm_states, trans_idx)])
+		inside = np.ones(keys[0].shape, dtype=bool)
+		for k, n in zip(keys, self.probs.shape):
+			inside &= (k >= 0) & (k < n)
+		idx = tuple([np.clip(k, 0, n - 1) for k, n in zip(keys, self.probs.shape)])
+		found = inside & self.valid[idx]
+		return np.where(found, self.probs[idx], 0.0), found
+
+	def __getitem__(self, key):
+		p, found = self.lookup(*key)
+		if not found:
+			raise KeyError(key)
+		return float(p)
+
+	def __contains__(self, key):
+		return bool(self.lookup(*key)[1])
+
+	def __len__(self):
+		return int(self.valid.sum())
+
+	def keys(self):
+		return [tuple(k) for k in np.argwhere(self.valid).tolist()]
+
+
+def load_kaldi_transitions(ftrans):
+	"""Load Kaldi transition model, from print-transitions output (all nine columns are numbers)"""
+	data = np.fromstring("".join(iter_lines(ftrans)), sep=" ")
+	if len(data) % 9:
+		raise ValueError("Data not understood.")
+	data = data.reshape(-1, 9)
+	return TransitionTable.from_entries(data[:, 1], data[:, 3], data[:, 4], data[:, 6], tids=data[:, 0], phones=data[:, 2])
+
+
+def iter_kaldi_gmms(fmdl, dtype=np.float64):
+	"""
+	GMM states of text .mdl file (or lines of gmm-copy --binary=false output) one by one,
+	as tuples (dim, weights, gconsts, means_invvars, inv_vars); nothing else is kept in memory
+	"""
+	dim = None
+	inTag = ""
+	st = None
+
+	def state(st):
+		return (dim, np.fromstring(" ".join(st["Weights"]), dtype=dtype, sep=" "),
+			np.fromstring(" ".join(st["GConsts"]), dtype=dtype, sep=" "),
+			np.fromstring(" ".join(st["MeansInvVars"]), dtype=dtype, sep=" ").reshape(-1, dim),
+			np.fromstring(" ".join(st["InvVars"]), dtype=dtype, sep=" ").reshape(-1, dim))
+
+	# Load model tags
+	for raw_line in iter_lines(fmdl):
+		line = raw_line.strip()
+
+		if line.startswith("</"):
+			inTag = ""
+		elif line.startswith("<"):
+			all_tags_in_line = re.findall("<([a-zA-Z_]+?)>", line)
+			if all_tags_in_line:
+				inTag = all_tags_in_line[-1]
+
+		# Get DIMs
+		if line.startswith("<DIMENSION>"):
+			dim = int(line.split()[1])
+
+		if inTag == "GCONSTS":
+			st["GConsts"].append(" ".join(line.split()[2:-1]))
+
+		elif inTag == "WEIGHTS":
+			st["Weights"].append(" ".join(line.split()[2:-1]))
+
+		elif inTag == "MEANS_INVVARS" and not line.startswith("<MEANS_INVVARS>"):
+			st["MeansInvVars"].append(line.replace("]", ""))
+
+		elif inTag == "INV_VARS" and not line.startswith("<INV_VARS>"):
+			st["InvVars"].append(line.replace("]", ""))
+
+		elif inTag == "DiagGMM":
+			if st is not None:
+				yield state(st)
+			st = {"Weights": [], "GConsts": [], "MeansInvVars": [], "InvVars": []}
+
+		elif line.startswith("</DiagGMM>") and st is not None:
+			yield state(st)
+			st = None
+
+	if st is not None:
+		yield state(st)
+
+
+def gmm_set(dim, states):
+	"""DiagGmmSet of states (as iter_kaldi_gmms yields them), with one copy into the compact arrays"""
+	states = list(states)
+	return DiagGmmSet(np.concatenate([st[1] for st in states]), np.concatenate([st[2] for st in states]),
+		np.concatenate([st[3] for st in states]).reshape(-1, dim), np.concatenate([st[4] for st in states]).reshape(-1, dim),
+		[len(st[1]) for st in states])
+
+
+def load_kaldi_gmms(fmdl, dtype=np.float64):
+	"""Load Kaldi GMM model, from text .mdl file (or lines of gmm-copy --binary=false output)"""
+	states = list(iter_kaldi_gmms(fmdl, dtype=dtype))
+	dim = states[0][0] if states else None
+	return {"vecSize": dim, "states": gmm_set(dim, states)}
+
+
+def prune_mixtures(weights, counts, min_weight=0.0, max_mixtures=0):
+	"""
+	Mixtures kept of states with counts mixtures (weights of all of them in one array): those
+	of weight at least min_weight, of them at most max_mixtures heaviest (0 for any number),
+	always at least the heaviest one. Returns mask of kept mixtures and their weights
+	renormalized to sum to one in every state.
+	"""
+	weights = np.asarray(weights, dtype=np.float64)
+	counts = np.asarray(counts, dtype=np.int64)
+	state_of = np.repeat(np.arange(len(counts)), counts)
+	offsets = np.cumsum(counts) - counts
+	order = np.lexsort((-weights, state_of))  # by state, heaviest first
+	rank = np.empty(len(weights), dtype=np.int64)
+	rank[order] = np.arange(len(weights)) - offsets[state_of[order]]
+	keep = (weights >= min_weight) | (rank == 0)
+	if max_mixtures > 0:
+		keep &= rank < max_mixtures
+	sums = np.bincount(state_of[keep], weights=weights[keep], minlength=len(counts))
+	sums[sums <= 0] = 1.0
+	return keep, weights[keep] / sums[state_of[keep]]
+
+
+def prune_gmm_set(gmms, min_weight=0.0, max_mixtures=0):
+	"""DiagGmmSet without mixtures pruned by prune_mixtures"""
+	keep, weights = prune_mixtures(gmms.weights, gmms.counts, min_weight=min_weight, max_mixtures=max_mixtures)
+	counts = np.bincount(np.repeat(np.arange(len(gmms)), gmms.counts)[keep], minlength=len(gmms))
+	return DiagGmmSet(weights.astype(gmms.weights.dtype), gmms.gconsts[keep], gmms.means_invvars[keep], gmms.inv_vars[keep], counts)
+
+
+def iter_pruned_gmms(states, min_weight=0.0, max_mixtures=0, sizes=None):
+	"""
+	States as iter_kaldi_gmms yields them, without mixtures pruned by prune_mixtures;
+	list sizes gets numbers of mixtures of every state before and after pruning
+	"""
+	for dim, weights, gconsts, means_invvars, inv_vars in states:
+		keep, pruned = prune_mixtures(weights, [len(weights)], min_weight=min_weight, max_mixtures=max_mixtures)
+		if sizes is not None:
+			sizes.append((len(weights), len(pruned)))
+		yield dim, pruned.astype(weights.dtype), gconsts[keep], means_invvars[keep], inv_vars[keep]
+
+
+def is_kaldi_binary(fname):
+	"""True if file starts with Kaldi binary header"""
+	with open(fname, "rb") as f:
+		return f.read(2) == b"\0B"
+
+
+def read_topology(r):
+	"""Read HmmTopology, returns phone -> list of (forward_pdf_class, self_loop_pdf_class, transitions)"""
+	r.expect("<Topology>")
+	phones = r.int32_vector()
+	phone2idx = r.int32_vector()
+	n = r.int32()
+	is_hmm = True
+	if n == -1:  # new format with self-loop pdf classes
+		is_hmm = False
+		n = r.int32()
+	entries = []
+	for e in range(n):
+		entry = []
+		for s in range(r.int32()):
+			forward_pdf_class = r.int32()
+			self_loop_pdf_class = forward_pdf_class if is_hmm else r.int32()
+			transitions = []
+			for t in range(r.int32()):
+				dst = r.int32()
+				transitions.append((dst, r.float()))
+			entry.append((forward_pdf_class, self_loop_pdf_class, transitions))
+		entries.append(entry)
+	r.expect("</Topology>")
+	return dict((int(ph), entries[phone2idx[ph]]) for ph in phones)
+
+
+def read_transition_model(r):
+	"""Read TransitionModel, returns topology, tuples (phone, hmm_state, forward_pdf, self_loop_pdf) and log-probs"""
+	r.expect("<TransitionModel>")
+	topo = read_topology(r)
+	tag = r.token()
+	if tag not in ("<Triples>", "<Tuples>"):
+		raise ValueError("Expected <Triples> or <Tuples>, got %s" % tag)
+	tuples = []
+	for i in range(r.int32()):
+		phone = r.int32()
+		hmm_state = r.int32()
+		forward_pdf = r.int32()
+		self_loop_pdf = forward_pdf if tag == "<Triples>" else r.int32()
+		tuples.append((phone, hmm_state, forward_pdf, self_loop_pdf))
+	r.expect(tag.replace("<", "</"))
+	r.expect("<LogProbs>")
+	log_probs = r.vector()
+	r.expect("</LogProbs>")
+	r.expect("</TransitionModel>")
+	return {"topology": topo, "tuples": tuples, "log_probs": log_probs}
+
+
+def iter_am_diag_gmm(r):
+	"""GMM states of AmDiagGmm one by one, tuples as iter_kaldi_gmms yields (views into the mapped file)"""
+	r.expect("<DIMENSION>")
+	dim = r.int32()
+	r.expect("<NUMPDFS>")
+	num_pdfs = r.int32()
+	for pdf in range(num_pdfs):
+		r.expect("<DiagGMM>")
+		st = {}
+		while True:
+			tag = r.token()
+			if tag == "</DiagGMM>":
+				break
+			elif tag == "<GCONSTS>":
+				st["GConsts"] = r.vector()
+			elif tag == "<WEIGHTS>":
+				st["Weights"] = r.vector()
+			elif tag == "<MEANS_INVVARS>":
+				st["MeansInvVars"] = r.matrix()
+			elif tag == "<INV_VARS>":
+				st["InvVars"] = r.matrix()
+			else:
+				raise ValueError("Unexpected token %s in DiagGMM %d" % (tag, pdf))
+		yield dim, st["Weights"], st["GConsts"], st["MeansInvVars"], st["InvVars"]
+
+
+def read_am_diag_gmm(r):
+	"""Read AmDiagGmm into the structure load_kaldi_gmms returns"""
+	states = list(iter_am_diag_gmm(r))
+	dim = states[0][0] if states else None
+	return {"vecSize": dim, "states": gmm_set(dim, states)}
+
+
+def transition_table(tm):
+	"""
+	Table of all transition-ids as print-transitions writes it:
+	tid, pdf, phone, hmm_state, transition_index, transition_state, prob, self_loop, final
+	"""
+	table = []
+	tid = 1
+	for tstate, (phone, hmm_state, forward_pdf, self_loop_pdf) in enumerate(tm["tuples"]):
+		entry = tm["topology"][phone]
+		for trans_idx, (dst, p) in enumerate(entry[hmm_state][2]):
+			self_loop = dst == hmm_state
+			pdf = self_loop_pdf if self_loop else forward_pdf
+			prob = np.exp(np.float32(tm["log_probs"][tid]))
+			table.append((tid, pdf, phone, hmm_state, trans_idx, tstate + 1, prob, int(self_loop), int(dst + 1 == len(entry))))
+			tid += 1
+	return table
+
+
+def format_transition_table(table):
+	"""Lines of transition table in print-transitions format"""
+	for row in table:
+		yield "%d %d %d %d %d %d %g %d %d\n" % row
+
+
+def transition_probs(table):
+	"""TransitionTable as load_kaldi_transitions returns it (probs rounded as print-transitions prints them)"""
+	rows = np.array([row[:6] for row in table], dtype=np.int64).reshape(-1, 6)
+	probs = [float("%g" % row[6]) for row in table]
+	return TransitionTable.from_entries(rows[:, 1], rows[:, 3], rows[:, 4], probs, tids=rows[:, 0], phones=rows[:, 2])
+
+
+def load_kaldi_model(fmdl, with_gmms=True):
+	"""Load binary Kaldi GMM model, returns transitions and GMMs (None without with_gmms) in the same form as text loaders"""
+	r = KaldiBinaryReader(fmdl)
+	tm = read_transition_model(r)
+	gmms = read_am_diag_gmm(r) if with_gmms else None
+	return transition_probs(transition_table(tm)), gmms
+
+
+def iter_kaldi_model_gmms(fmdl):
+	"""GMM states of binary Kaldi GMM model one by one, as iter_am_diag_gmm yields them"""
+	r = KaldiBinaryReader(fmdl)
+	read_transition_model(r)
+	return iter_am_diag_gmm(r)
+
+
+if __name__ == "__main__":
+
+	if len(sys.argv) != 2:
+		print >> sys.stderr, "Usage: kaldi_mdl.py <model.mdl>  (writes same output as print-transitions)"
+		sys.exit(1)
+
+	r = KaldiBinaryReader(sys.argv[1])
+	for line in format_transition_table(transition_table(read_transition_model(r))):
+		sys.stdout.write(line)
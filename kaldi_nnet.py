@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Readers of Kaldi nnet1 networks (final.nnet, final.feature_transform) and pdf counts.
+
+Binary networks are memory mapped and their matrices are views of the mapped file, text
+networks (nnet-copy --binary=false) are parsed in blocks of rows into memory mapped
+temporary files, so no layer is ever held in process memory as a whole.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+from kaldi_mdl import KaldiBinaryReader, is_kaldi_binary
+
+# Components: parameters read after the dimensions, in order
+COMPONENTS = {
+	"<AffineTransform>": ("linearity", "bias"),
+	"<LinearTransform>": ("linearity",),
+	"<Sigmoid>": (),
+	"<Tanh>": (),
+	"<Softmax>": (),
+	"<Splice>": ("offsets",),
+	"<AddShift>": ("shift",),
+	"<Rescale>": ("scale",),
+}
+
+# Optional settings before the parameters of a component, all of them single numbers
+OPTIONS = ("<LearnRateCoef>", "<BiasLearnRateCoef>", "<MaxNorm>")
+
+# Floats parsed at once from text matrix
+TEXT_BLOCK_VALUES = 1 << 20
+
+# Floor of priors, rarer pdfs get prior sqrt(FLT_MAX) as in nnet-forward (log-prior about 44.4)
+PRIOR_FLOOR = 1e-10
+
+_space = re.compile(r"\s+")
+
+
+class Component(object):
+	"""Component of network: kind (e.g. "<AffineTransform>"), dimensions and parameter arrays"""
+
+	def __init__(self, kind, dim_out, dim_in, params):
+		self.kind = kind
+		self.dim_out = dim_out
+		self.dim_in = dim_in
+		self.params = params
+
+	def __repr__(self):
+		return "%s %d %d" % (self.kind, self.dim_out, self.dim_in)
+
+
+class KaldiTextReader(object):
+	"""Sequential reader of Kaldi text objects, matrices go to memory mapped files in tmpdir"""
+
+	def __init__(self, fname, tmpdir):
+		self.f = open(fname)
+		self.tmpdir = tmpdir
+		self.tokens = []
+		self.arrays = 0
+
+	def _fill(self):
+		while not self.tokens:
+			line = self.f.readline()
+			if not line:
+				return False
+			self.tokens = _space.split(line.strip())[::-1] if line.strip() else []
+		return True
+
+	def at_end(self):
+		return not self._fill()
+
+	def token(self):
+		if not self._fill():
+			raise ValueError("Unexpected end of %s" % self.f.name)
+		return self.tokens.pop()
+
+	def peek_token(self):
+		if not self._fill():
+			return ""
+		return self.tokens[-1]
+
+	def expect(self, expected):
+		tok = self.token()
+		if tok != expected:
+			raise ValueError("Expected token %s, got %s" % (expected, tok))
+
+	def int32(self):
+		return int(self.token())
+
+	def float(self):
+		return float(self.token())
+
+	def _values(self):
+		"""Tokens of [ ... ] on one line"""
+		self.expect("[")
+		values = []
+		while self.tokens and self.tokens[-1] != "]":
+			values.append(self.tokens.pop())
+		self.expect("]")
+		return values
+
+	def int32_vector(self):
+		return np.array(self._values(), dtype=np.int32)
+
+	def vector(self):
+		return np.array(self._values(), dtype=np.float32)
+
+	def matrix(self, rows, cols):
+		"""Matrix of known shape, rows on their own lines, in memory mapped file"""
+		self.expect("[")
+		if rows == 0 or cols == 0:
+			self.expect("]")
+			return np.zeros((rows, cols), dtype=np.float32)
+		if self.tokens:
+			raise ValueError("Unexpected %s after [ of matrix" % self.tokens[-1])
+		self.arrays += 1
+		mat = np.memmap(os.path.join(self.tmpdir, "%d.f32" % self.arrays), dtype=np.float32, mode="w+", shape=(rows, cols))
+		step = max(1, TEXT_BLOCK_VALUES // cols)
+		for start in range(0, rows, step):
+			end = min(start + step, rows)
+			lines = [self.f.readline() for _ in range(end - start)]
+			if end == rows:
+				lines[-1] = lines[-1].replace("]", "")
+			block = np.fromstring(" ".join(lines), dtype=np.float32, sep=" ")
+			if block.size != (end - start) * cols:
+				raise ValueError("Expected %d x %d matrix, rows %d-%d have %d values" % (rows, cols, start, end, block.size))
+			mat[start:end] = block.reshape(end - start, cols)
+		return mat
+
+	def close(self):
+		self.f.close()
+
+
+class BinaryNnetReader(KaldiBinaryReader):
+	"""Kaldi binary reader with the calls of KaldiTextReader, matrices are views of the mapped file"""
+
+	def at_end(self):
+		"""No component follows, called only where a token may start"""
+		while self.buf[self.pos:self.pos + 1] in (b" ", b"\n"):
+			self.pos += 1
+		return self.pos >= len(self.buf)
+
+	def peek_token(self):
+		"""Next token, "" if raw data follows (binary data is never skipped as whitespace)"""
+		if self.buf[self.pos:self.pos + 1] != b"<":
+			return ""
+		return KaldiBinaryReader.peek_token(self)
+
+	def matrix(self, rows, cols):
+		mat = KaldiBinaryReader.matrix(self)
+		if mat.shape != (rows, cols):
+			raise ValueError("Expected %d x %d matrix, got %d x %d" % (rows, cols, mat.shape[0], mat.shape[1]))
+		return mat
+
+	def close(self):
+		pass  # the arrays are views of the mapped file
+
+
+def _read_component(r):
+	"""Next component of network, None at its end"""
+	tok = r.token() if not r.at_end() else "</Nnet>"
+	if tok == "<Nnet>":
+		tok = r.token()
+	if tok == "</Nnet>":
+		return None
+	if tok not in COMPONENTS:
+		raise ValueError("Component %s not supported" % tok)
+	dim_out = r.int32()
+	dim_in = r.int32()
+	while r.peek_token() in OPTIONS:
+		r.token()
+		r.float()
+	params = {}
+	for name in COMPONENTS[tok]:
+		if name == "linearity":
+			params[name] = r.matrix(dim_out, dim_in)
+		elif name == "offsets":
+			params[name] = r.int32_vector()
+		else:
+			params[name] = r.vector()
+			if len(params[name]) != dim_out:
+				raise ValueError("%s of %s has %d values, expected %d" % (name, tok, len(params[name]), dim_out))
+	if r.peek_token() == "<!EndOfComponent>":
+		r.token()
+	return Component(tok, dim_out, dim_in, params)
+
+
+class NnetReader(object):
+	"""
+	Components of Kaldi nnet1 network, binary or text, one by one. Arrays of text networks
+	live in memory mapped files in a temporary directory (in tmpdir), removed by close().
+	"""
+
+	def __init__(self, fname, tmpdir=None):
+		self.fname = fname
+		self.tmpdir = None
+		if is_kaldi_binary(fname):
+			self.r = BinaryNnetReader(fname)
+		else:
+			self.tmpdir = tempfile.mkdtemp(prefix="kaldi_nnet-", dir=tmpdir)
+			self.r = KaldiTextReader(fname, self.tmpdir)
+
+	def __iter__(self):
+		while True:
+			component = _read_component(self.r)
+			if component is None:
+				return
+			yield component
+
+	def close(self):
+		self.r.close()
+		if self.tmpdir is not None:
+			shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def load_kaldi_counts(fcounts):
+	"""Pdf counts (analyze-counts output), text or binary Kaldi vector"""
+	if is_kaldi_binary(fcounts):
+		return np.array(KaldiBinaryReader(fcounts).vector(), dtype=np.float64)
+	with open(fcounts) as f:
+		text = f.read().replace("[", " ").replace("]", " ")
+	return np.fromstring(text, dtype=np.float64, sep=" ")
+
+
+def log_priors(counts, floor=PRIOR_FLOOR):
+	"""
+	Log-priors of pdfs from their counts, returns them and number of floored pdfs. As PdfPrior of
+	nnet-forward, priors under floor are set to sqrt(FLT_MAX) before the log is taken.
+	"""
+	counts = np.asarray(counts, dtype=np.float64)
+	priors = counts / counts.sum()
+	floored = priors < floor
+	priors[floored] = np.sqrt(np.finfo(np.float32).max)
+	return np.log(priors), int(floored.sum())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Concurrent Kaldi helper binaries (print-transitions, context-to-pdf, gmm-copy).
+
+All helpers are started at once and the stdout of each one is parsed while it is
+produced, in its own thread, so no temporary files are written and the loading
+takes as long as the slowest helper.
+"""
+
+import subprocess
+import threading
+import time
+
+# Size of the pipe read buffer
+PIPE_BUFFER_SIZE = 1 << 20
+
+
+class HelperPipeline(object):
+	"""Run Kaldi helpers and feed their output to streaming parsers"""
+
+	def __init__(self):
+		self.jobs = {}
+		self.elapsed = {}
+
+	def start(self, name, cmd, parser):
+		"""Start cmd (list of arguments), parser gets iterable of its output lines"""
+		proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE)
+		job = {"cmd": cmd, "proc": proc, "result": None, "error": None, "start": time.time(), "end": None}
+		job["thread"] = threading.Thread(target=self._parse, args=(job, parser))
+		job["thread"].daemon = True
+		job["thread"].start()
+		self.jobs[name] = job
+
+	def open(self, name, cmd):
+		"""Start cmd, returns its output to be read by the caller (wait then checks its exit code)"""
+		proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE)
+		self.jobs[name] = {"cmd": cmd, "proc": proc, "result": None, "error": None, "start": time.time(), "end": None,
+			"thread": None}
+		return proc.stdout
+
+	def _parse(self, job, parser):
+		try:
+			job["result"] = parser(job["proc"].stdout)
+		except Exception as e:
+			job["error"] = e
+			job["proc"].kill()
+		finally:
+			job["end"] = time.time()
+			job["proc"].stdout.close()
+
+	def kill(self):
+		"""Stop all running helpers"""
+		for job in self.jobs.values():
+			if job["proc"].poll() is None:
+				job["proc"].kill()
+		self.jobs = {}
+
+	def wait(self):
+		"""Wait for all helpers, returns dict of parsed results (elapsed gets their run times)"""
+		results = {}
+		try:
+			for name, job in self.jobs.items():
+				if job["thread"] is not None:
+					job["thread"].join()
+				else:
+					job["end"] = time.time()
+					job["proc"].stdout.close()
+				ret = job["proc"].wait()
+				self.elapsed[name] = job["end"] - job["start"]
+				if job["error"] is not None:
+					raise job["error"]
+				if ret != 0:
+					raise subprocess.CalledProcessError(ret, " ".join(job["cmd"]))
+				results[name] = job["result"]
+		finally:
+			self.kill()
+		return results
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Per-stage instrumentation of the conversion.
+
+Profiler records for every stage of convert() its wall time, CPU time (including
+finished child processes, e.g. the --jobs pool), peak RSS and item counts, and writes
+them as a JSON report. Optionally the whole run is profiled by cProfile and, where
+the tracemalloc module is available, the largest allocations of every stage are listed.
+MemoryLimit stops the conversion when it grows over --max-memory.
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+
+def peak_rss():
+	"""Peak resident memory of the process in bytes"""
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss(anonymous=False):
+	"""
+	Resident memory of the process in bytes. With anonymous only memory not backed by
+	files (mapped models are left out, the kernel can drop their pages without swapping).
+	"""
+	key = "RssAnon:" if anonymous else "VmRSS:"
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith(key):
+					return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	return peak_rss()
+
+
+def reset_peak_rss():
+	"""Reset peak RSS to the current RSS (Linux), so every stage gets its own peak"""
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+	except IOError:
+		pass
+
+
+def cpu_time():
+	"""CPU time of the process and of its finished children"""
+	t = os.times()
+	return t[0] + t[1] + t[2] + t[3]
+
+
+def counted_lines(lines, counts, key):
+	"""Pass lines through, counting them in counts[key]"""
+	counts.setdefault(key, 0)
+	for line in lines:
+		counts[key] += 1
+		yield line
+
+
+class Stage(object):
+	"""
+	Context manager measuring one stage, counts of its items go to stage.counts and
+	times of its parts (e.g. of helpers running in parallel) to stage.times
+	"""
+
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+		self.counts = {}
+		self.times = {}
+
+	def __enter__(self):
+		if self.profiler.enabled:
+			reset_peak_rss()
+			if self.profiler.trace_malloc:
+				tracemalloc.clear_traces()
+			self.wall = time.time()
+			self.cpu = cpu_time()
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		if not self.profiler.enabled:
+			return False
+		report = {
+			"stage": self.name,
+			"wall": time.time() - self.wall,
+			"cpu": cpu_time() - self.cpu,
+			"peak_rss": peak_rss(),
+			"counts": self.counts,
+		}
+		if self.times:
+			report["times"] = self.times
+		if self.profiler.trace_malloc:
+			top = tracemalloc.take_snapshot().statistics("lineno")[:self.profiler.trace_top]
+			report["allocations"] = [{"where": str(s.traceback), "size": s.size, "count": s.count} for s in top]
+		self.profiler.stages.append(report)
+		return False
+
+
+class Profiler(object):
+	"""Collects stage reports; when not enabled, stages cost (almost) nothing"""
+
+	def __init__(self, enabled=True, cprofile=None, trace_malloc=False, trace_top=10):
+		self.enabled = enabled
+		self.stages = []
+		self.cprofile_file = cprofile
+		self.cprofile = None
+		self.trace_malloc = enabled and trace_malloc
+		self.trace_top = trace_top
+		if self.trace_malloc and tracemalloc is None:
+			print >> sys.stderr, "WARNING: tracemalloc not available, allocations are not traced"
+			self.trace_malloc = False
+
+	def stage(self, name):
+		return Stage(self, name)
+
+	def start(self):
+		"""Start whole-run hooks (cProfile, tracemalloc)"""
+		self.wall = time.time()
+		self.cpu = cpu_time()
+		if self.trace_malloc:
+			tracemalloc.start()
+		if self.cprofile_file:
+			import cProfile
+			self.cprofile = cProfile.Profile()
+			self.cprofile.enable()
+
+	def stop(self):
+		"""Stop whole-run hooks, cProfile stats are dumped to their file"""
+		if self.cprofile is not None:
+			self.cprofile.disable()
+			self.cprofile.dump_stats(self.cprofile_file)
+			self.cprofile = None
+		if self.trace_malloc:
+			tracemalloc.stop()
+		self.wall = time.time() - self.wall
+		self.cpu = cpu_time() - self.cpu
+
+	def report(self):
+		"""Report as dict: stages in order of their end, totals and all counts"""
+		counts = {}
+		for st in self.stages:
+			counts.update(st["counts"])
+		return {"stages": self.stages, "wall": self.wall, "cpu": self.cpu, "peak_rss": max([st["peak_rss"] for st in self.stages] or [0]),
+			"counts": counts}
+
+	def write(self, fname):
+		"""Write JSON report, "-" is stderr"""
+		if fname == "-":
+			json.dump(self.report(), sys.stderr, indent=1)
+			print >> sys.stderr
+		else:
+			with open(fname, "w") as f:
+				json.dump(self.report(), f, indent=1)
+
+
+# Profiler of runs without --profile
+NO_PROFILER = Profiler(enabled=False)
+
+
+class MemoryLimit(object):
+	"""Ceiling of anonymous resident memory, check raises MemoryError when the process is over it"""
+
+	def __init__(self, max_bytes=None):
+		self.max_bytes = max_bytes
+
+	def check(self, where):
+		if not self.max_bytes:
+			return
+		rss = current_rss(anonymous=True)
+		if rss > self.max_bytes:
+			raise MemoryError("%s: resident memory %.0f MB is over the limit of %.0f MB" % (where, rss / 1e6, self.max_bytes / 1e6))
+
+
+# Limit of runs without --max-memory
+NO_LIMIT = MemoryLimit()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Lookup tables of converted model, written next to the MMF as <model>.tables (--tables).
+
+All tables are int32 arrays, -1 where there is no value:
+
+	tid2pdf, tid2phone, tid2hmm_state   of every transition-id (tid 0 is not used)
+	pdf2state                           index of the ~s macro of pdf in the MMF
+	hmm_pdf_offsets, hmm_pdfs           pdfs of physical HMM h (the h-th ~h macro of the MMF)
+	                                    are hmm_pdfs[hmm_pdf_offsets[h]:hmm_pdf_offsets[h + 1]]
+
+Layout, little-endian: magic, number of tables, then name (16 bytes), offset and length
+of every table, and the tables, each starting at a multiple of 8 bytes.
+"""
+
+import mmap
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b"KTABLES1"
+HEADER = struct.Struct("<8sI")
+ENTRY = struct.Struct("<16sQQ")
+
+TABLES = ("tid2pdf", "tid2phone", "tid2hmm_state", "pdf2state", "hmm_pdf_offsets", "hmm_pdfs")
+
+
+def lookup_tables(trans, hmms, state_ids):
+	"""Tables of TransitionTable trans, HmmGroups hmms and pdfs of the ~s macros in the order of the MMF"""
+	tids = trans.tids
+	state_ids = np.asarray(state_ids, dtype=np.int64)
+	num_pdfs = max(int(tids[:, 0].max()) + 1, int(state_ids.max()) + 1 if len(state_ids) else 0)
+	pdf2state = np.full(num_pdfs, -1, dtype=np.int32)
+	pdf2state[state_ids] = np.arange(len(state_ids))
+	lengths = np.array([len(pdfs) for pdfs in hmms.pdfs], dtype=np.int64)
+	offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+	np.cumsum(lengths, out=offsets[1:])
+	flat = [pdf for pdfs in hmms.pdfs for pdf in pdfs]
+	return {
+		"tid2pdf": tids[:, 0],
+		"tid2phone": tids[:, 1],
+		"tid2hmm_state": tids[:, 2],
+		"pdf2state": pdf2state,
+		"hmm_pdf_offsets": offsets,
+		"hmm_pdfs": np.array(flat, dtype=np.int32),
+	}
+
+
+def write_tables(fname, tables):
+	"""Write dict of int32 tables"""
+	pos = HEADER.size + ENTRY.size * len(tables)
+	entries = []
+	for name in TABLES:
+		pos += -pos % 8
+		entries.append((name, pos, len(tables[name])))
+		pos += 4 * len(tables[name])
+	with open(fname, "wb") as f:
+		f.write(HEADER.pack(MAGIC, len(entries)))
+		for name, offset, length in entries:
+			f.write(ENTRY.pack(name, offset, length))
+		for name, offset, _ in entries:
+			f.write(b"\0" * (offset - f.tell()))
+			f.write(np.ascontiguousarray(tables[name], dtype="<i4").tostring())
+
+
+class LookupTables(object):
+	"""Memory mapped tables, tables[name] is a read-only int32 array"""
+
+	def __init__(self, fname):
+		with open(fname, "rb") as f:
+			self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, count = HEADER.unpack_from(self.buf, 0)
+		if magic != MAGIC:
+			raise ValueError("%s is not a file of lookup tables" % fname)
+		self.tables = {}
+		for i in range(count):
+			name, offset, length = ENTRY.unpack_from(self.buf, HEADER.size + i * ENTRY.size)
+			self.tables[name.rstrip(b"\0")] = np.frombuffer(self.buf, dtype="<i4", count=length, offset=offset)
+
+	def __getitem__(self, name):
+		return self.tables[name]
+
+	def hmm_pdfs(self, h):
+		"""Pdfs of physical HMM h"""
+		offsets = self.tables["hmm_pdf_offsets"]
+		return self.tables["hmm_pdfs"][offsets[h]:offsets[h + 1]]
+
+	def states(self, tids):
+		"""Indices of ~s macros of transition-ids (e.g. of Kaldi alignment), -1 for tids without pdf (tid 0)"""
+		pdfs = self.tables["tid2pdf"][np.asarray(tids)]
+		return np.where(pdfs >= 0, self.tables["pdf2state"][pdfs], -1)
+
+
+if __name__ == "__main__":
+
+	if len(sys.argv) != 2:
+		print >> sys.stderr, "Usage: kaldi_tables.py <model>.tables < ali.txt  (maps text alignments of transition-ids to indices of ~s macros)"
+		sys.exit(1)
+
+	tables = LookupTables(sys.argv[1])
+	for line in sys.stdin:
+		fields = line.split()
+		if fields:
+			states = tables.states(np.array(fields[1:], dtype=np.int64))
+			print fields[0], " ".join(map(str, states.tolist()))
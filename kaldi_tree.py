@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Kaldi decision tree (ContextDependency) evaluated without context-to-pdf.
+
+The tree is read from the binary or the text (copy-tree --binary=false) form. Its event map
+is made of SE (split on a set of values of a key), TE (table on a key) and CE (constant pdf)
+nodes; keys 0 .. N-1 are the phones of the context, -1 is the pdf-class. Instead of mapping
+every context on its own, sets of phones and pdf-classes go down the tree and are split by
+every question, so each leaf gets the box (product of sets) of the contexts reaching it.
+
+The contexts of one central phone are then grouped into classes of left and right phones
+that go to the same leaves, the pdf sequence of every pair of classes is read from the
+boxes, and the physical HMMs are built from those sequences. The result is the same as
+load_kaldi_hmms of context-to-pdf output (contexts with disambiguation phones or <eps>
+left out), only contexts that the tree does not map (context-to-pdf writes undefined
+pdfs for them) are also left out.
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+from kaldi_ctx import context_names, hmm_groups, skip_mask
+from kaldi_mdl import KaldiBinaryReader, is_kaldi_binary
+
+# Key of the pdf-class in events
+PDF_CLASS = -1
+
+# Event map nodes are tuples, (CONSTANT, pdf), (SPLIT, key, yes_values, yes, no) or
+# (TABLE, key, [node per value]); None is NULL (no pdf)
+CONSTANT, SPLIT, TABLE = "CE", "SE", "TE"
+
+
+class KaldiTextReader(object):
+	"""Reader of Kaldi text objects, with the tokens and integers of KaldiBinaryReader"""
+
+	def __init__(self, fname):
+		with open(fname) as f:
+			self.tokens = f.read().split()
+		self.pos = 0
+
+	def token(self):
+		if self.pos >= len(self.tokens):
+			raise ValueError("Unexpected end of file")
+		self.pos += 1
+		return self.tokens[self.pos - 1]
+
+	def expect(self, expected):
+		tok = self.token()
+		if tok != expected:
+			raise ValueError("Expected token %s, got %s at token %d" % (expected, tok, self.pos))
+
+	def int32(self):
+		return int(self.token())
+
+	uint32 = int32
+
+	def int32_vector(self):
+		self.expect("[")
+		try:
+			end = self.tokens.index("]", self.pos)
+		except ValueError:
+			raise ValueError("Unterminated vector at token %d" % self.pos)
+		vec = np.array(self.tokens[self.pos:end], dtype=np.int32)
+		self.pos = end + 1
+		return vec
+
+
+class ContextTree(object):
+	"""Decision tree of context width N and central position P"""
+	__slots__ = ("width", "central", "root")
+
+	def __init__(self, width, central, root):
+		self.width = width
+		self.central = central
+		self.root = root
+
+	def compute(self, ctx, pdf_class):
+		"""Pdf of context (phone ids) and pdf-class, None when the tree does not map it (as ContextDependency::Compute)"""
+		event = dict(enumerate(ctx))
+		event[PDF_CLASS] = pdf_class
+		node = self.root
+		while node is not None and node[0] != CONSTANT:
+			if node[1] not in event:
+				return None
+			value = event[node[1]]
+			if node[0] == SPLIT:
+				node = node[3] if value in node[2] else node[4]
+			else:
+				node = node[2][value] if 0 <= value < len(node[2]) else None
+		return None if node is None else node[1]
+
+	def leaves(self, num_phones, num_classes):
+		"""
+		Boxes of contexts reaching every leaf: list of (masks, pdf), masks[k] are bool arrays of
+		phones (num_phones) of context position k and masks[width] of pdf-classes (num_classes)
+		"""
+		leaves = []
+		domain = [np.ones(num_phones, dtype=bool)] * self.width + [np.ones(num_classes, dtype=bool)]
+		stack = [(self.root, domain)]
+		while stack:
+			node, masks = stack.pop()
+			if node is None:
+				continue
+			if node[0] == CONSTANT:
+				leaves.append((masks, node[1]))
+				continue
+			if node[1] == PDF_CLASS:
+				k = self.width
+			elif 0 <= node[1] < self.width:
+				k = node[1]
+			else:
+				continue
+			values = masks[k]
+			if node[0] == SPLIT:
+				yes = np.zeros(len(values), dtype=bool)
+				yes[node[2][(node[2] >= 0) & (node[2] < len(values))]] = True
+				branches = [(node[3], values & yes), (node[4], values & ~yes)]
+			else:
+				branches = []
+				for v in np.flatnonzero(values[:len(node[2])]).tolist():
+					single = np.zeros(len(values), dtype=bool)
+					single[v] = True
+					branches.append((node[2][v], single))
+			for child, mask in branches:
+				if child is not None and mask.any():
+					stack.append((child, masks[:k] + [mask] + masks[k + 1:]))
+		return leaves
+
+
+def read_event_map(r):
+	"""Read EventMap (as EventMap::Read) from KaldiBinaryReader or KaldiTextReader"""
+	tok = r.token()
+	if tok == "NULL":
+		return None
+	if tok == "CE":
+		return (CONSTANT, r.int32())
+	if tok == "SE":
+		key = r.int32()
+		values = r.int32_vector().astype(np.int64)
+		r.expect("{")
+		yes = read_event_map(r)
+		no = read_event_map(r)
+		r.expect("}")
+		return (SPLIT, key, values, yes, no)
+	if tok == "TE":
+		key = r.int32()
+		size = r.uint32()  # table size is written as uint32
+		r.expect("(")
+		table = [read_event_map(r) for i in range(size)]
+		r.expect(")")
+		return (TABLE, key, table)
+	raise ValueError("Unknown event map %s" % tok)
+
+
+def load_kaldi_tree(ftree):
+	"""Read ContextDependency from binary or text tree file"""
+	r = KaldiBinaryReader(ftree) if is_kaldi_binary(ftree) else KaldiTextReader(ftree)
+	r.expect("ContextDependency")
+	width = r.int32()
+	central = r.int32()
+	r.expect("ToPdf")
+	root = read_event_map(r)
+	r.expect("EndContextDependency")
+	return ContextTree(width, central, root)
+
+
+def _unique_rows(rows):
+	"""
+	Distinct rows of non-negative integers in lexicographic order (as np.unique with axis=0),
+	indices of their first rows and index of the distinct row of every row
+	"""
+	base = int(rows.max()) + 1 if rows.size else 1
+	if base ** rows.shape[1] < 1 << 63:
+		# rows as numbers of base, their order is the lexicographic one
+		key = np.zeros(len(rows), dtype=np.int64)
+		for k in range(rows.shape[1]):
+			key *= base
+			key += rows[:, k]
+		keys, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+		return rows[first], first, inverse
+	order = np.lexsort(rows.T[::-1])
+	sorted_rows = rows[order]
+	new = np.ones(len(rows), dtype=bool)
+	new[1:] = (sorted_rows[1:] != sorted_rows[:-1]).any(axis=1)
+	inverse = np.empty(len(rows), dtype=np.int64)
+	inverse[order] = np.cumsum(new) - 1
+	first = order[new]
+	return sorted_rows[new], first, inverse
+
+
+def _classes(covered):
+	"""Columns of bool matrix covered (leaves x phones) grouped into classes, returns class of every phone and representatives"""
+	uniq, first, inverse = _unique_rows(np.packbits(covered, axis=0).T)
+	return inverse, first
+
+
+def tree_hmms(tree, int2phones, silphones=(), sil_pdf_classes=5, nonsil_pdf_classes=3):
+	"""
+	HmmGroups of all contexts of triphone or monophone tree, the same ones as load_kaldi_hmms of
+	context-to-pdf output with the same silphones (phone ids) and numbers of pdf-classes
+	"""
+	if (tree.width, tree.central) == (3, 1):
+		outer = np.flatnonzero(~skip_mask(int2phones) & np.in1d(np.arange(max(int2phones) + 1), list(int2phones)))
+		centers = outer
+	elif (tree.width, tree.central) == (1, 0):
+		outer = np.array([-1])
+		centers = np.array([i for i in sorted(int2phones) if i > 0])
+	else:
+		raise ValueError("Only triphone and monophone trees, got context width %d, central position %d" % (tree.width, tree.central))
+
+	silset = set(silphones)
+	num_phones = max(int2phones) + 1
+	num_classes = max(sil_pdf_classes, nonsil_pdf_classes)
+	leaves = tree.leaves(num_phones, num_classes)
+	sizes = [num_phones] * tree.width + [num_classes]
+	masks = [np.array([m[k] for m, pdf in leaves], dtype=bool).reshape(len(leaves), sizes[k]) for k in range(tree.width + 1)]
+	leaf_pdfs = np.array([pdf for m, pdf in leaves], dtype=np.int32)
+	if tree.width == 3:
+		left, center, right, classes = masks[0][:, outer], masks[1], masks[2][:, outer], masks[3]
+	else:
+		left = right = np.ones((len(leaves), 1), dtype=bool)
+		center, classes = masks
+
+	# per central phone: pdf sequence of every pair of left and right phone classes
+	cells = []
+	for c in centers.tolist():
+		num = sil_pdf_classes if c in silset else nonsil_pdf_classes
+		sel = np.flatnonzero(center[:, c] & classes[:, :num].any(axis=1))
+		if not len(sel):
+			cells.append(None)
+			continue
+		lcls, lrep = _classes(left[sel])
+		rcls, rrep = _classes(right[sel])
+		grid = np.full((len(lrep), len(rrep), num), -1, dtype=np.int32)
+		lcov = left[sel][:, lrep]
+		rcov = right[sel][:, rrep]
+		kcov = classes[sel, :num]
+		for j in range(len(sel)):
+			grid[np.ix_(lcov[j], rcov[j], kcov[j])] = leaf_pdfs[sel[j]]
+		cells.append((lcls, rcls, grid.reshape(-1, num)))
+
+	# physical HMMs: distinct sequences of pdfs, per length in sorted order (as group_hmms)
+	pdfs = []
+	cell_hmms = [None] * len(cells)
+	lengths = sorted(set(cell[2].shape[1] for cell in cells if cell is not None))
+	for length in lengths:
+		sel = [i for i, cell in enumerate(cells) if cell is not None and cell[2].shape[1] == length]
+		seqs = np.concatenate([cells[i][2] for i in sel])
+		mapped = (seqs >= 0).all(axis=1)
+		hmm_of = np.full(len(seqs), -1, dtype=np.int64)
+		if mapped.any():
+			uniq, first, inverse = _unique_rows(seqs[mapped])
+			hmm_of[mapped] = len(pdfs) + inverse
+			pdfs.extend([tuple(row) for row in uniq.tolist()])
+		start = 0
+		for i in sel:
+			cell_hmms[i] = hmm_of[start:start + len(cells[i][2])]
+			start += len(cells[i][2])
+
+	# logical contexts in the order of context-to-pdf: left, central and right phone
+	hmm_of = np.full((len(outer), len(centers), len(outer)), -1, dtype=np.int32)
+	for i, cell in enumerate(cells):
+		if cell is not None:
+			lcls, rcls, seqs = cell
+			hmm_of[:, i, :] = cell_hmms[i][lcls[:, None] * (rcls.max() + 1) + rcls[None, :]]
+	mapped = hmm_of >= 0
+	contexts = np.empty((int(mapped.sum()), 3), dtype=np.int32)
+	contexts[:, 0] = np.broadcast_to(outer[:, None, None], hmm_of.shape)[mapped]
+	contexts[:, 1] = np.broadcast_to(centers[None, :, None], hmm_of.shape)[mapped]
+	contexts[:, 2] = np.broadcast_to(outer[None, None, :], hmm_of.shape)[mapped]
+	return hmm_groups(pdfs, contexts, hmm_of[mapped])
+
+
+if __name__ == "__main__":
+
+	DESCRIPTION = "Write pdfs of all contexts of Kaldi tree as context-to-pdf --skip-disambig, without Kaldi"
+
+	parser = argparse.ArgumentParser(description=DESCRIPTION, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--sil-phones', default="1,2,3", type=str,
+	                    help='Comma separated list of silence phones')
+	parser.add_argument('--sil-pdf-classes', default=5, type=int,
+	                    help='Number of pdf-classes for silence phones')
+	parser.add_argument('--non-sil-pdf-classes', default=3, type=int,
+	                    help='Number of pdf-classes for non-silence phones')
+	parser.add_argument("kaldi_phones")
+	parser.add_argument("kaldi_tree")
+	args = parser.parse_args()
+
+	from kaldi_convert import load_kaldi_phones
+	phones2int, int2phones = load_kaldi_phones(args.kaldi_phones)
+	hmms = tree_hmms(load_kaldi_tree(args.kaldi_tree), int2phones, silphones=[int(x) for x in args.sil_phones.split(",") if x],
+		sil_pdf_classes=args.sil_pdf_classes, nonsil_pdf_classes=args.non_sil_pdf_classes)
+	hmm_of = np.empty(hmms.num_logical, dtype=np.int64)
+	hmm_of[hmms.members] = np.repeat(np.arange(len(hmms)), np.diff(hmms.offsets))
+	for ctx, h in zip(hmms.contexts.tolist(), hmm_of.tolist()):
+		name = " ".join(context_names(ctx, int2phones))
+		for k, pdf in enumerate(hmms.pdfs[h]):
+			sys.stdout.write("%s %d %d\n" % (name, k, pdf))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""MMF text formatted in bulk is the same as formatted number by number, and in parallel chunks as serially"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import numpy as np
+
+from htk_writer import format_fake_gmm_state, format_gmm_state, format_transitions, list2str, mat2str, write_chunks
+from kaldi_bench import generate
+from kaldi_convert import load_kaldi_phones, write_mmf, APNaming, HtkNaming
+from kaldi_ctx import load_kaldi_hmms
+from kaldi_mdl import load_kaldi_gmms, load_kaldi_transitions
+
+
+def values_str(values):
+	"""Numbers one by one, as the writer did before the templates"""
+	s = ""
+	for i in range(len(values)):
+		s += "%.6e" % values[i]
+		if i < len(values) - 1:
+			s += " "
+	return s
+
+
+def gmm_state_str(weights, means, variances, gconsts):
+	"""Mixtures of one state, every line on its own"""
+	lines = ["<NUMMIXES> %d" % len(weights)]
+	for i in range(len(weights)):
+		lines.append("<MIXTURE> %d %e" % (i + 1, weights[i]))
+		lines.append("<MEAN> %d" % len(means[i]))
+		lines.append(values_str(means[i]))
+		lines.append("<VARIANCE> %d" % len(variances[i]))
+		lines.append(values_str(variances[i]))
+		lines.append("<GCONST> %e" % gconsts[i])
+	return "\n".join(lines) + "\n"
+
+
+class FormatTest(unittest.TestCase):
+
+	def setUp(self):
+		rng = np.random.RandomState(0)
+		special = [0.0, -0.0, 1.0, -1.0, 1e-300, -1e-300, 1e300, -1e300, 5e-324, 1.7976931348623157e308,
+			1.23456749e-10, 9.9999995e99, -9.9999995e-100, 0.5, 123456789.0]
+		self.values = np.concatenate([special, rng.randn(25) * 10.0 ** rng.randint(-40, 40, 25)])
+
+	def test_matrices(self):
+		mat = self.values.reshape(8, 5)
+		self.assertEqual(mat2str(mat), "\n".join(values_str(row) for row in mat.tolist()))
+		self.assertEqual(list2str(self.values.tolist()), values_str(self.values.tolist()))
+		trans = self.values[:16].reshape(4, 4)
+		self.assertEqual(format_transitions("1_2", trans), '~t "T_1_2"\n<TRANSP> 4\n%s\n' % "\n".join(
+			values_str(row) for row in trans.tolist()))
+
+	def test_gmm_state(self):
+		means = self.values.reshape(4, 10)
+		variances = np.abs(means[::-1])
+		weights = np.array([0.0, 1e-30, 0.25, -1.5e200])
+		gconsts = np.array([-0.0, 3e-310, -123.456, 1e250])
+		self.assertEqual(format_gmm_state(weights, means, variances, gconsts),
+			gmm_state_str(weights.tolist(), means.tolist(), variances.tolist(), gconsts.tolist()))
+		self.assertEqual(format_fake_gmm_state(3), gmm_state_str([1.0], [[0.0] * 3], [[1.0] * 3], [1.0]))
+
+
+class WriteChunksTest(unittest.TestCase):
+
+	def test_jobs(self):
+		formatter = lambda start, end: ["".join("%d\n" % i for i in range(start, end)), "%d-%d\n" % (start, end)]
+		texts = []
+		for jobs in (1, 3):
+			outputs = [StringIO(), StringIO()]
+			write_chunks(outputs, formatter, 100, jobs=jobs, chunk_size=7)
+			texts.append([fw.getvalue() for fw in outputs])
+		self.assertEqual(texts[0], texts[1])
+		self.assertEqual(texts[0][0], "".join("%d\n" % i for i in range(100)))
+
+
+class WriteMmfTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		# 330 states and more HMMs, in several chunks
+		files = generate(self.tmp, 6, 10, 2, 5)["files"]
+		phones2int, int2phones = load_kaldi_phones(files["phones.txt"])
+		self.model = {"phones2int": phones2int, "int2phones": int2phones, "trans": load_kaldi_transitions(files["transitions"]),
+			"hmms": load_kaldi_hmms(files["ctx"], phones2int), "gmms": load_kaldi_gmms(files["final.mdl.txt"])}
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def write(self, jobs, **options):
+		"""Bytes of the MMFs of both namings written by jobs processes"""
+		targets = [(naming, os.path.join(self.tmp, "%s-%d" % (naming.__class__.__name__, jobs)), None)
+			for naming in (HtkNaming(), APNaming())]
+		write_mmf(self.model, targets, jobs=jobs, **options)
+		out = []
+		for _, fname, _ in targets:
+			with open(fname, "rb") as f:
+				out.append(f.read())
+		return out
+
+	def test_jobs(self):
+		for options in ({"GMM": True}, {"GMM": True, "binary": True}, {"GMM": False}):
+			serial = self.write(1, **options)
+			self.assertEqual(serial, self.write(3, **options), options)
+			self.assertNotEqual(serial[0], serial[1])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""kaldi_batch runs the jobs of one tree and collects their outputs, with a stand-in converter"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from kaldi_batch import BatchConverter, Job
+
+# Converter with the command line of kaldi2AP.py: the first job of a tree caches its contexts
+# and then waits until another job of the tree has started, the others mark that they started.
+# Outputs of --index and --tables are written next to the model.
+CONVERTER = """
+import os, sys, time
+sys.path.insert(0, %r)
+import numpy as np
+from kaldi_cache import ModelCache
+
+args = sys.argv[1:]
+cache = ModelCache(args[args.index("--cache-dir") + 1])
+fmdl, fphones, ftree, fmodel, ftiedlist = args[-5:]
+marker = os.path.join(os.path.dirname(os.path.dirname(fmdl)), "follower")
+key = cache.key("ctx", [fphones, ftree])
+if cache.manifest(key) is None:
+	cache.store(key, {"contexts": np.zeros((1, 3), dtype=np.int32)}, sources=[cache.digest(fphones), cache.digest(ftree)])
+	start = time.time()
+	while not os.path.exists(marker):
+		if time.time() - start > 10:
+			sys.exit("No other job started")
+		time.sleep(0.05)
+else:
+	open(marker, "w").close()
+for fname, option in ((fmodel, None), (fmodel + ".idx", "--index"), (fmodel + ".tables", "--tables"), (ftiedlist, None)):
+	if option is None or option in args:
+		with open(fname, "w") as f:
+			f.write(fname)
+"""
+
+
+class BatchTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.script = os.path.join(self.tmp, "convert.py")
+		with open(self.script, "w") as f:
+			f.write(CONVERTER % os.path.dirname(os.path.abspath(__file__)))
+		self.dirs = []
+		for i in range(3):
+			directory = os.path.join(self.tmp, "exp", "tri%d" % i)
+			os.makedirs(directory)
+			for name, text in (("final.mdl", "model %d" % i), ("phones.txt", "<eps> 0\nSIL 1\n"), ("tree", "tree")):
+				with open(os.path.join(directory, name), "w") as f:
+					f.write(text)
+			self.dirs.append(directory)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_group_and_outputs(self):
+		batch = BatchConverter(self.script, ["--index", "--tables"], 3, 0, os.path.join(self.tmp, "cache"),
+			tmp_root=self.tmp)
+		jobs = batch.run([Job(directory) for directory in self.dirs])
+		# the first job finishes only when another one started, while it still ran
+		self.assertEqual([job.status for job in jobs], ["ok"] * 3, [job.error for job in jobs])
+		self.assertEqual(sum(job.leader for job in jobs), 1)
+		for directory in self.dirs:
+			for name in ("HTKmodels", "HTKmodels.idx", "HTKmodels.tables", "tiedlist"):
+				self.assertTrue(os.path.isfile(os.path.join(directory, name)), name)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Streamed conversion (--stream) writes the model of loaded GMMs in memory that does not grow with the GMMs"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from kaldi_bench import generate
+from kaldi_convert import load_kaldi_phones, write_mmf, GmmStream, HtkNaming
+from kaldi_ctx import load_kaldi_hmms
+from kaldi_mdl import load_kaldi_gmms, load_kaldi_transitions
+from kaldi_profile import current_rss, peak_rss, reset_peak_rss, MemoryLimit
+
+# Allowed growth of peak RSS of the streamed conversion from the small to the large model
+MAX_STREAM_GROWTH = 8 << 20
+
+
+def load(files, gmms=None):
+	phones2int, int2phones = load_kaldi_phones(files["phones.txt"])
+	return {"phones2int": phones2int, "int2phones": int2phones, "trans": load_kaldi_transitions(files["transitions"]),
+		"hmms": load_kaldi_hmms(files["ctx"], phones2int), "gmms": gmms}
+
+
+def _stream_rss(queue, files, fout):
+	"""Peak RSS growth of streamed conversion, run in its own process"""
+	try:
+		model = load(files)
+		reset_peak_rss()
+		rss = current_rss()
+		write_mmf(dict(model, gmms=GmmStream(files["final.mdl.txt"], read_text=True)), [(HtkNaming(), fout, None)], GMM=True)
+		queue.put(peak_rss() - rss)
+	except Exception as e:
+		queue.put(e)
+
+
+def stream_rss(files, fout):
+	queue = multiprocessing.Queue()
+	proc = multiprocessing.Process(target=_stream_rss, args=(queue, files, fout))
+	proc.start()
+	result = queue.get()
+	proc.join()
+	if isinstance(result, Exception):
+		raise result
+	return result
+
+
+class StreamTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def model(self, name, mixtures, dim):
+		"""Synthetic model of 330 pdfs, the same phones, contexts and transitions for all sizes"""
+		directory = os.path.join(self.tmp, name)
+		os.makedirs(directory)
+		return generate(directory, 6, 10, mixtures, dim)
+
+	def test_same_output(self):
+		files = self.model("small", 4, 13)["files"]
+		fout = os.path.join(self.tmp, "small", "HTKmodels")
+		model = load(files)
+		write_mmf(dict(model, gmms=GmmStream(files["final.mdl.txt"], read_text=True)), [(HtkNaming(), fout + ".stream", None)], GMM=True)
+		write_mmf(dict(model, gmms=load_kaldi_gmms(files["final.mdl.txt"])), [(HtkNaming(), fout, None)], GMM=True)
+		with open(fout) as f, open(fout + ".stream") as g:
+			self.assertEqual(f.read(), g.read())
+
+	def test_memory_limit(self):
+		files = self.model("small", 2, 13)["files"]
+		gmms = GmmStream(files["final.mdl.txt"], read_text=True)
+		with self.assertRaises(MemoryError):
+			write_mmf(dict(load(files), gmms=gmms), [(HtkNaming(), os.path.join(self.tmp, "HTKmodels"), None)], GMM=True,
+				memory=MemoryLimit(1 << 20))
+
+	def test_flat_rss(self):
+		small = self.model("small", 2, 13)
+		large = self.model("large", 128, 39)
+		# the loaded GMMs (means and inverse variances) of the large model would take about 26 MB
+		self.assertGreater(large["pdfs"] * 128 * 39 * 2 * 8, 3 * MAX_STREAM_GROWTH)
+		growth = [stream_rss(info["files"], os.path.join(self.tmp, name, "HTKmodels"))
+			for name, info in (("small", small), ("large", large))]
+		self.assertLess(growth[1] - growth[0], MAX_STREAM_GROWTH, "RSS grew by %.1f MB and %.1f MB" % (growth[0] / 1e6, growth[1] / 1e6))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Mixtures pruned at export (--min-weight, --max-mixtures)"""
+
+import re
+import unittest
+
+import numpy as np
+
+from htk_writer import format_state_body, gmm_state_arrays
+from kaldi_mdl import DiagGmmSet, iter_pruned_gmms, prune_gmm_set, prune_mixtures
+
+# Weights of three states: one over and under the floor, one all under it, one of equal weights
+WEIGHTS = [[0.5, 0.02, 0.3, 0.18], [0.004, 0.006], [0.25, 0.25, 0.25, 0.25]]
+
+
+def gmm_set(dim=2):
+	weights = np.concatenate(WEIGHTS)
+	rows = np.arange(len(weights), dtype=np.float64)
+	means_invvars = rows[:, None] + np.arange(dim) / 10.0
+	inv_vars = 1.0 + means_invvars
+	return DiagGmmSet(weights, -rows, means_invvars, inv_vars, [len(w) for w in WEIGHTS])
+
+
+class PruneTest(unittest.TestCase):
+
+	def prune(self, **options):
+		weights = np.concatenate(WEIGHTS)
+		keep, pruned = prune_mixtures(weights, [len(w) for w in WEIGHTS], **options)
+		return np.flatnonzero(keep).tolist(), pruned.tolist()
+
+	def test_weight_floor(self):
+		keep, weights = self.prune(min_weight=0.1)
+		# the heaviest mixture of the second state stays, though under the floor
+		self.assertEqual(keep, [0, 2, 3, 5, 6, 7, 8, 9])
+		self.assertTrue(np.allclose(weights, [0.5 / 0.98, 0.3 / 0.98, 0.18 / 0.98, 1.0, 0.25, 0.25, 0.25, 0.25]))
+
+	def test_top_n(self):
+		keep, weights = self.prune(max_mixtures=2)
+		self.assertEqual(keep, [0, 2, 4, 5, 6, 7])  # equal weights: the first ones
+		self.assertTrue(np.allclose(weights, [0.5 / 0.8, 0.3 / 0.8, 0.4, 0.6, 0.5, 0.5]))
+		keep, weights = self.prune(min_weight=0.2, max_mixtures=3)
+		self.assertEqual(keep, [0, 2, 5, 6, 7, 8])
+		self.assertTrue(np.allclose(weights, [0.625, 0.375, 1.0, 1 / 3.0, 1 / 3.0, 1 / 3.0]))
+
+	def test_nothing_pruned(self):
+		keep, weights = self.prune()
+		self.assertEqual(keep, range(10))
+		self.assertTrue(np.allclose(weights, np.concatenate(WEIGHTS) / np.repeat([1.0, 0.01, 1.0], [4, 2, 4])))
+
+	def test_gmm_set(self):
+		gmms = gmm_set()
+		pruned = prune_gmm_set(gmms, min_weight=0.1, max_mixtures=2)
+		keep = [0, 2, 5, 6, 7]
+		self.assertEqual(pruned.counts.tolist(), [2, 1, 2])
+		self.assertTrue(np.allclose(pruned.weights, [0.625, 0.375, 1.0, 0.5, 0.5]))
+		# kept mixtures unchanged, gconsts included (HTK GCONST is computed from the variances)
+		for name in ("gconsts", "means_invvars", "inv_vars"):
+			self.assertTrue(np.array_equal(getattr(pruned, name), getattr(gmms, name)[keep]), name)
+
+		sizes = []
+		states = [(gmms.dim, gmms[s].Weights, gmms[s].GConsts, gmms[s].MeansInvVars, gmms[s].InvVars) for s in gmms]
+		for s, (dim, weights, gconsts, means_invvars, inv_vars) in enumerate(iter_pruned_gmms(states, min_weight=0.1,
+				max_mixtures=2, sizes=sizes)):
+			self.assertEqual(dim, 2)
+			for got, name in ((weights, "Weights"), (gconsts, "GConsts"), (means_invvars, "MeansInvVars"), (inv_vars, "InvVars")):
+				self.assertTrue(np.allclose(got, pruned[s][name]), (s, name))
+		self.assertEqual(sizes, [(4, 2), (2, 1), (4, 2)])
+
+	def test_mmf(self):
+		pruned = prune_gmm_set(gmm_set(), min_weight=0.1, max_mixtures=2)
+		for s, count in enumerate([2, 1, 2]):
+			st = pruned[s]
+			means, variances, gconsts = gmm_state_arrays(st.MeansInvVars, st.InvVars, 2)
+			text = format_state_body(st.Weights, means, variances, gconsts)
+			self.assertTrue(text.startswith("<NUMMIXES> %d\n" % count))
+			mixtures = re.findall(r"<MIXTURE> (\d+) (\S+)", text)
+			self.assertEqual([int(i) for i, _ in mixtures], range(1, count + 1))
+			self.assertAlmostEqual(sum(float(w) for _, w in mixtures), 1.0, places=5)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Networks written as nnet-copy writes them are read by kaldi_nnet and converted by kaldi2NNImage"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from htk_writer import format_fake_state, write_header
+from kaldi2NNImage import COMPONENT_HEADER, HEADER, MAGIC, convert, state_order
+from kaldi_convert import make_naming
+from kaldi_nnet import NnetReader, load_kaldi_counts, log_priors
+
+FLT_MAX = np.finfo(np.float32).max
+
+
+def network(rng, components):
+	"""Components (kind, dim_out, dim_in, params) with random float32 parameters"""
+	out = []
+	for kind, dim_out, dim_in in components:
+		params = {}
+		if kind == "<Splice>":
+			params["offsets"] = np.arange(dim_out // dim_in, dtype=np.int32) - dim_out // dim_in // 2
+		elif kind in ("<AffineTransform>", "<LinearTransform>"):
+			params["linearity"] = rng.randn(dim_out, dim_in).astype(np.float32)
+			if kind == "<AffineTransform>":
+				params["bias"] = rng.randn(dim_out).astype(np.float32)
+		elif kind == "<AddShift>":
+			params["shift"] = rng.randn(dim_out).astype(np.float32)
+		elif kind == "<Rescale>":
+			params["scale"] = rng.rand(dim_out).astype(np.float32)
+		out.append((kind, dim_out, dim_in, params))
+	return out
+
+
+def write_nnet(fname, components, binary):
+	"""Write nnet1 network as Nnet::Write does, binary or text"""
+	out = []
+
+	def token(tok):
+		out.append(tok + " ")
+
+	def int32(value):
+		out.append(struct.pack("<bi", 4, value) if binary else "%d " % value)
+
+	def float32(value):
+		out.append(struct.pack("<bf", 4, value) if binary else "%g " % value)
+
+	def floats(values):
+		return " ".join("%.9g" % v for v in values.tolist())
+
+	def vector(vec):
+		if binary:
+			out.append("FV " + struct.pack("<bi", 4, len(vec)) + vec.astype("<f4").tostring())
+		else:
+			out.append(" [ %s ]\n" % floats(vec))
+
+	def matrix(mat):
+		if binary:
+			out.append("FM " + struct.pack("<bibi", 4, mat.shape[0], 4, mat.shape[1]) + mat.astype("<f4").tostring())
+		else:
+			out.append(" [\n" + "\n".join("  " + floats(row) for row in mat) + " ]\n")
+
+	if binary:
+		out.append("\0B")
+	token("<Nnet>")
+	if not binary:
+		out.append("\n")
+	for kind, dim_out, dim_in, params in components:
+		token(kind)
+		int32(dim_out)
+		int32(dim_in)
+		if kind == "<AffineTransform>":
+			token("<LearnRateCoef>")
+			float32(1.0)
+			token("<BiasLearnRateCoef>")
+			float32(1.0)
+			token("<MaxNorm>")
+			float32(0.0)
+		if kind == "<Splice>":
+			offsets = params["offsets"]
+			if binary:
+				out.append(struct.pack("<bi", 4, len(offsets)) + offsets.astype("<i4").tostring())
+			else:
+				out.append("\n[ %s ]\n" % " ".join(map(str, offsets.tolist())))
+		for name in ("linearity", "bias", "shift", "scale"):
+			if name == "linearity" and name in params:
+				matrix(params[name])
+			elif name in params:
+				vector(params[name])
+		token("<!EndOfComponent>")
+		if not binary:
+			out.append("\n")
+	token("</Nnet>")
+	if not binary:
+		out.append("\n")
+	with open(fname, "wb") as f:
+		f.write("".join(out))
+
+
+def read_image(fname):
+	"""Header and list of (code, dim_in, dim_out, float32 parameters or splice offsets) of image"""
+	with open(fname, "rb") as f:
+		buf = f.read()
+	magic, num, dim_in, dim_out = HEADER.unpack_from(buf, 0)
+	pos = HEADER.size
+	components = []
+	for i in range(num):
+		code, cin, cout = COMPONENT_HEADER.unpack_from(buf, pos)
+		pos += COMPONENT_HEADER.size
+		size = {"SPLC": None, "SHFT": cout, "SCAL": cout, "AFFN": cout * cin + cout, "LINR": cout * cin, "PRIO": cout}.get(code, 0)
+		if size is None:
+			count = struct.unpack_from("<i", buf, pos)[0]
+			params = np.frombuffer(buf, dtype="<i4", count=count, offset=pos + 4)
+			pos += 4 + 4 * count
+		else:
+			params = np.frombuffer(buf, dtype="<f4", count=size, offset=pos)
+			pos += 4 * size
+		components.append((code, cin, cout, params))
+	assert pos == len(buf)
+	return (magic, num, dim_in, dim_out), components
+
+
+class NnetTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		rng = np.random.RandomState(0)
+		self.transform = network(rng, [("<Splice>", 6, 2), ("<AddShift>", 6, 6), ("<Rescale>", 6, 6)])
+		self.nnet = network(rng, [("<AffineTransform>", 4, 6), ("<Sigmoid>", 4, 4), ("<AffineTransform>", 5, 4),
+			("<Softmax>", 5, 5)])
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def path(self, name):
+		return os.path.join(self.tmp, name)
+
+	def test_readers(self):
+		for binary in (True, False):
+			for components in (self.transform, self.nnet):
+				fname = self.path("nnet")
+				write_nnet(fname, components, binary)
+				with NnetReader(fname, tmpdir=self.tmp) as reader:
+					read = list(reader)
+					self.assertEqual([(c.kind, c.dim_out, c.dim_in) for c in read], [c[:3] for c in components])
+					for c, (_, _, _, params) in zip(read, components):
+						self.assertEqual(sorted(c.params), sorted(params))
+						for name in params:
+							self.assertTrue(np.array_equal(c.params[name], params[name]), (binary, c.kind, name))
+		self.assertEqual(os.listdir(self.tmp), ["nnet"])  # mapped matrices of text networks removed
+
+	def test_priors(self):
+		counts = [10.0, 30.0, 0.0, 60.0, 1e-12]
+		logs, floored = log_priors(counts, floor=1e-10)
+		self.assertEqual(floored, 2)
+		expected = np.log([0.1, 0.3, np.sqrt(FLT_MAX), 0.6, np.sqrt(FLT_MAX)])
+		self.assertTrue(np.allclose(logs, expected))
+		self.assertAlmostEqual(logs[2], 44.36142, places=4)
+
+		with open(self.path("counts.txt"), "w") as f:
+			f.write(" [ 10 30 0 60 ]\n")
+		with open(self.path("counts.bin"), "wb") as f:
+			f.write("\0BFV " + struct.pack("<bi4f", 4, 4, 10, 30, 0, 60))
+		for fname in ("counts.txt", "counts.bin"):
+			self.assertEqual(load_kaldi_counts(self.path(fname)).tolist(), [10, 30, 0, 60])
+
+	def write_mmf(self, states, naming):
+		"""HTK model with ~s macros of states (pdfs) in the given order"""
+		fname = self.path("HTKmodels")
+		with open(fname, "w") as fw:
+			write_header(fw, 3)
+			for s in states:
+				fw.write(format_fake_state(naming.state_name(s), 3))
+		return fname
+
+	def test_state_order(self):
+		for profile in ("ap", "htk"):
+			naming = make_naming(profile)
+			names, pdfs = state_order(self.write_mmf([3, 0, 4, 1], naming), 5, naming)
+			self.assertEqual(names, [naming.state_name(s) for s in (3, 0, 4, 1)])
+			self.assertEqual(pdfs.tolist(), [3, 0, 4, 1])
+			self.assertRaises(ValueError, state_order, self.write_mmf([3, 7], naming), 5, naming)
+
+	def test_convert(self):
+		naming = make_naming("ap")
+		fmmf = self.write_mmf([3, 0, 4, 1], naming)
+		with open(self.path("counts"), "w") as f:
+			f.write(" [ 10 20 30 0 40 ]\n")
+		write_nnet(self.path("final.feature_transform"), self.transform, False)
+		write_nnet(self.path("final.nnet"), self.nnet, True)
+		convert(fmmf, self.path("final.nnet"), self.path("final.feature_transform"), self.path("counts"),
+			self.path("NNimage"), self.path("stateOrder"), tmpdir=self.tmp)
+
+		with open(self.path("stateOrder")) as f:
+			self.assertEqual(f.read().split(), [naming.state_name(s) for s in (3, 0, 4, 1)])
+		header, components = read_image(self.path("NNimage"))
+		self.assertEqual(header, (MAGIC, 8, 2, 4))
+		self.assertEqual([c[0] for c in components], ["SPLC", "SHFT", "SCAL", "AFFN", "SIGM", "AFFN", "SMAX", "PRIO"])
+		self.assertEqual(components[0][3].tolist(), self.transform[0][3]["offsets"].tolist())
+		order = [3, 0, 4, 1]
+		last = self.nnet[2][3]
+		self.assertEqual(components[5][1:3], (4, 4))
+		self.assertTrue(np.array_equal(components[5][3], np.concatenate([last["linearity"][order].ravel(), last["bias"][order]])))
+		self.assertEqual(components[6][1:3], (4, 4))
+		# pdf 3 has no count, so it gets the floor prior
+		self.assertTrue(np.allclose(components[7][3], np.log([np.sqrt(FLT_MAX), 0.1, 0.4, 0.2]), rtol=1e-6))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Lookup tables written next to the MMF are mapped back by LookupTables"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from kaldi_bench import generate
+from kaldi_convert import load_kaldi_phones
+from kaldi_ctx import load_kaldi_hmms
+from kaldi_mdl import load_kaldi_transitions
+from kaldi_tables import LookupTables, lookup_tables, write_tables
+
+
+class TablesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		files = generate(self.tmp, 2, 2, 1, 3)["files"]
+		phones2int, _ = load_kaldi_phones(files["phones.txt"])
+		self.trans = load_kaldi_transitions(files["transitions"])
+		self.hmms = load_kaldi_hmms(files["ctx"], phones2int)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_states(self):
+		tid2pdf = self.trans.tids[:, 0]
+		num_pdfs = int(tid2pdf.max()) + 1
+		# ~s macros in reverse pdf order, pdf 1 has none
+		state_ids = [pdf for pdf in range(num_pdfs - 1, -1, -1) if pdf != 1]
+		fname = os.path.join(self.tmp, "HTKmodels.tables")
+		write_tables(fname, lookup_tables(self.trans, self.hmms, state_ids))
+		tables = LookupTables(fname)
+
+		self.assertEqual(tables["tid2pdf"][0], -1)
+		tids = np.arange(len(tid2pdf))
+		expected = [state_ids.index(pdf) if pdf in state_ids else -1 for pdf in tid2pdf.tolist()]
+		self.assertEqual(tables.states(tids).tolist(), expected)
+		self.assertEqual(tables.states([0, 0]).tolist(), [-1, -1])
+		for h in range(len(self.hmms)):
+			self.assertEqual(tuple(tables.hmm_pdfs(h).tolist()), self.hmms.pdfs[h])
+
+
+if __name__ == "__main__":
+	unittest.main()
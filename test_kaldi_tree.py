@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Daniel Soutner, University of West Bohemia, Czechia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+# and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Tree files written as Kaldi writes them (copy-tree) are read back by kaldi_tree"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from kaldi_ctx import group_hmms, skip_contexts
+from kaldi_tree import CONSTANT, SPLIT, TABLE, load_kaldi_tree, tree_hmms
+
+PHONES = ["<eps>", "SIL", "a", "b", "c", "#0"]
+
+
+def write_tree(fname, width, central, root, binary):
+	"""Write ContextDependency as Kaldi does: int32 with size byte 4, table sizes as uint32 (size byte -4)"""
+	out = []
+
+	def token(tok):
+		out.append(tok + " ")
+
+	def int32(value):
+		out.append(struct.pack("<bi", 4, value) if binary else "%d " % value)
+
+	def uint32(value):
+		out.append(struct.pack("<bI", -4, value) if binary else "%d " % value)
+
+	def event_map(node):
+		if node is None:
+			token("NULL")
+		elif node[0] == CONSTANT:
+			token("CE")
+			int32(node[1])
+		elif node[0] == SPLIT:
+			token("SE")
+			int32(node[1])
+			if binary:
+				out.append(struct.pack("<bi%di" % len(node[2]), 4, len(node[2]), *node[2]))
+			else:
+				out.append("[ %s ]\n" % " ".join(map(str, node[2])))
+			token("{")
+			event_map(node[3])
+			event_map(node[4])
+			token("}")
+		else:
+			token("TE")
+			int32(node[1])
+			uint32(len(node[2]))
+			token("(")
+			for child in node[2]:
+				event_map(child)
+			token(")")
+
+	if binary:
+		out.append("\0B")
+	token("ContextDependency")
+	int32(width)
+	int32(central)
+	token("ToPdf")
+	event_map(root)
+	token("EndContextDependency")
+	with open(fname, "wb") as f:
+		f.write("".join(out))
+
+
+def state_tree(c):
+	"""Pdfs of central phone c: pdf-class 0 split on left phone, 1 on right phone, 2 constant"""
+	base = 10 * c
+	return (TABLE, -1, [
+		(SPLIT, 0, [1, 5], (CONSTANT, base), (CONSTANT, base + 1)),
+		(SPLIT, 2, [2, 3], (CONSTANT, base + 2), (CONSTANT, base + 3)),
+		(CONSTANT, base + 4)])
+
+
+class TreeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.int2phones = dict(enumerate(PHONES))
+		# phone 4 (c) is not in the table, its contexts have no pdfs
+		self.root = (TABLE, 1, [None, state_tree(1), state_tree(2), state_tree(3)])
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def load(self, root, binary, width=3, central=1):
+		fname = os.path.join(self.tmp, "tree")
+		write_tree(fname, width, central, root, binary)
+		return load_kaldi_tree(fname)
+
+	def reference(self, tree):
+		"""HMMs from pdfs of every context one by one, as of context-to-pdf output"""
+		rec = []
+		for l in range(len(PHONES)):
+			for c in range(1, len(PHONES)):
+				for r in range(len(PHONES)):
+					pdfs = [tree.compute((l, c, r), k) for k in range(3)]
+					if None not in pdfs:
+						rec.extend([(l, c, r, k, pdf) for k, pdf in enumerate(pdfs)])
+		return group_hmms(skip_contexts(np.array(rec, dtype=np.int32), self.int2phones))
+
+	def test_binary_and_text(self):
+		for binary in (True, False):
+			tree = self.load(self.root, binary)
+			self.assertEqual((tree.width, tree.central), (3, 1))
+			self.assertEqual(tree.compute((1, 2, 3), 0), 20)
+			self.assertEqual(tree.compute((2, 2, 3), 0), 21)
+			self.assertEqual(tree.compute((2, 3, 3), 1), 32)
+			self.assertEqual(tree.compute((2, 3, 4), 1), 33)
+			self.assertEqual(tree.compute((2, 1, 4), 2), 14)
+			self.assertEqual(tree.compute((2, 4, 4), 2), None)
+
+			hmms = tree_hmms(tree, self.int2phones, silphones=[1], sil_pdf_classes=3)
+			ref = self.reference(tree)
+			self.assertEqual(hmms.pdfs, ref.pdfs)
+			self.assertTrue(np.array_equal(hmms.contexts, ref.contexts))
+			self.assertTrue(np.array_equal(hmms.members, ref.members))
+			self.assertTrue(np.array_equal(hmms.offsets, ref.offsets))
+
+	def test_key_out_of_context(self):
+		# key 3 is past the context of width 3, not the pdf-class, so no context is mapped
+		root = (TABLE, 1, [None] + [(SPLIT, 3, [0, 1, 2], (CONSTANT, c), (CONSTANT, c + 10)) for c in range(1, 4)])
+		tree = self.load(root, True)
+		self.assertEqual(tree.compute((1, 2, 3), 0), None)
+		self.assertEqual(tree.leaves(len(PHONES), 3), [])
+
+
+if __name__ == "__main__":
+	unittest.main()